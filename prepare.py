@@ -7,11 +7,14 @@
 
 import argparse
 import csv
+import json
 import os
-import stat
+import re
 import sys
-from filemapper import process_json_file
-from records import cli as records_cli
+import tempfile
+
+from utilities.profiling import add_profile_arguments, profiling, stage
+from utilities.shards import in_shard, parse_shard
 
 HERE = os.path.dirname(os.path.realpath(__file__))
 
@@ -62,6 +65,55 @@ def generate_parser():
         help=("Skip the file mapper step (only use if file-mapping is already done)."),
     )
 
+    parser.add_argument(
+        "--pack-small-files",
+        dest="pack_small_files",
+        metavar="N",
+        type=int,
+        default=None,
+        help=(
+            "Before records preparation, archive the leaf directories (e.g. DICOM series) "
+            "of every sourcedata child folder holding more than N small files, so the "
+            "manifest and upload list a few archives instead of every file."
+        ),
+    )
+
+    parser.add_argument(
+        "--small-file-size",
+        dest="small_file_size",
+        metavar="BYTES",
+        type=int,
+        default=1024 * 1024,
+        help=("Files under this size count as small for --pack-small-files (default 1 MiB)."),
+    )
+
+    parser.add_argument(
+        "--skip-link-check",
+        dest="skip_link_check",
+        action="store_true",
+        default=False,
+        help=(
+            "Skip checking for dangling symlinks, and symlinks pointing outside SOURCE, "
+            "before records preparation.  Parents with broken links are otherwise left "
+            "out of records preparation and listed in <parent>.broken_links.tsv."
+        ),
+    )
+
+    parser.add_argument(
+        "--shard",
+        dest="shard",
+        metavar="I/N",
+        type=parse_shard,
+        default=None,
+        help=(
+            "Only file-map and prepare records for the subject/sessions of shard I of N "
+            "(0 <= I < N), e.g. --shard $SLURM_ARRAY_TASK_ID/$SLURM_ARRAY_TASK_COUNT.  "
+            "Run `nda-records merge` on every parent once all shards are done."
+        ),
+    )
+
+    add_profile_arguments(parser, "DESTINATION")
+
     return parser
 
 
@@ -77,243 +129,391 @@ def input_check():
         sys.exit(1)
 
     dest_dir = args.dest.rstrip("/")
-    manifest_dir = os.path.join(os.path.dirname(__file__), "manifest-data")
     file_mapper = os.path.join(dest_dir, "file-mapper")
 
-    if not os.path.isdir(manifest_dir):
+    if not os.path.isdir(args.source_dir):
         print(
-            "Missing manifest directory "
-            + manifest_dir
-            + ", Exiting. Clone from https://github.com/NDAR/manifest-data"
+            "The provided source was not a directory " + args.source_dir + ", Exiting."
         )
-        sys.exit(2)
-    else:
-        manifest_script = os.path.join(manifest_dir, "nda_manifests.py")
+        sys.exit(6)
 
-        # make executable
-        manifest_status = os.stat(manifest_script)
-        try:
-            os.chmod(manifest_script, manifest_status.st_mode | stat.S_IEXEC)
-        except:
-            print(
-                "Warning: Unable to assign executable permissions to "
-                + manifest_script
-                + ", continuing anyway."
-            )
-            pass
+    source_dir = args.source_dir.rstrip("/")
 
-        if not os.path.isfile(manifest_script):
-            print("Missing NDA manifest script " + manifest_script + ", Exiting.")
-            sys.exit(3)
+    return (
+        dest_dir,
+        source_dir,
+        args.skip,
+        args.pack_small_files,
+        args.small_file_size,
+        args.shard,
+        args.skip_link_check,
+        args.profile,
+        args.profile_memory,
+    )
 
-    if not os.path.isdir(args.source_dir):
+
+def subject_session_labels(sub_ses):
+    """
+    The {SUBJECT} and {SESSION} labels of a bids_subject_session, e.g.
+    sub-s01_ses-screening -> ("s01", "screening"); the session is None
+    without one.
+    """
+    bids_subject, _, bids_session = sub_ses.partition("_")
+    subject = bids_subject.removeprefix("sub-")
+    if not bids_session:
+        return subject, None
+    return subject, bids_session.removeprefix("ses-")
+
+
+def expand_run_placeholders(json_data, source_dir, subject, session=None):
+    """
+    Replace every run-{RUN} mapping (written by nda-mapping --generalize-runs)
+    with one mapping per run label found for this subject/session in source_dir.
+    """
+    expanded = {}
+    for key, value in json_data.items():
+        if "{RUN}" not in key:
+            expanded[key] = value
+            continue
+        filled = key.replace("{SUBJECT}", subject)
+        if session is not None:
+            filled = filled.replace("{SESSION}", session)
+        directory, basename = os.path.split(filled)
+        pattern = re.compile(
+            re.escape(basename).replace(re.escape("{RUN}"), "([a-zA-Z0-9]+)") + "$"
+        )
+        try:
+            names = os.listdir(os.path.join(source_dir, directory))
+        except FileNotFoundError:
+            continue
+        runs = {match.group(1) for match in map(pattern.match, names) if match}
+        for run in sorted(runs):
+            expanded[key.replace("{RUN}", run)] = value.replace("{RUN}", run)
+    return expanded
+
+
+def pack_sourcedata_parents(dest_dir, max_small_files, small_file_bytes, shard=None):
+    """Pack small files in the children of every sourcedata parent in dest_dir."""
+    from utilities.packing import is_sourcedata_parent, pack_parent
+
+    for filename in sorted(os.listdir(dest_dir)):
+        parent_name = filename[: -len(".json")]
+        parent_dir = os.path.join(dest_dir, parent_name)
+        if not filename.endswith(".json") or not os.path.isdir(parent_dir):
+            continue
+        if not is_sourcedata_parent(parent_name):
+            continue
+        packed = pack_parent(
+            parent_dir, max_small_files, small_file_bytes, shard=shard
+        )
+        archived = sum(result["status"] == "archived" for result in packed)
+        files = sum(result["files"] for result in packed)
         print(
-            "The provided source was not a directory " + args.source_dir + ", Exiting."
+            f"Packed {files} files of {parent_name} into {len(packed)} archives "
+            f"({archived} new or changed)"
         )
-        sys.exit(6)
 
-    source_dir = args.source_dir.rstrip("/")
 
-    return dest_dir, manifest_script, source_dir, args.skip
+def read_lookup(dest_dir):
+    with open(os.path.join(dest_dir, "lookup.csv"), "r") as f:
+        return [row for row in csv.DictReader(f)]
+
+
+def filemap_parent(dest_dir, source_dir, filename, lookup, shard=None):
+    """
+    File-map one file mapper JSON (filename, in dest_dir) for every lookup
+    row, or only the rows whose child folder belongs to shard (i, N).
+    """
+    # imported here so that prepare.py --help and input checks start quickly
+    from filemapper import process_json_file
+
+    json_file_path = os.path.join(dest_dir, filename)
+    with open(json_file_path, "r") as infile:
+        json_data = json.load(infile)
+    print(json_data)
+
+    # BIDS toplevel: one folder, no subject/session; symlink top-level files only
+    if filename == "image03_sourcedata.bids.toplevel.json":
+        parent_name = filename[: -len(".json")]
+        parent_dir = os.path.join(dest_dir, parent_name)
+        os.makedirs(parent_dir, exist_ok=True)
+        child_dir = os.path.join(parent_dir, "toplevel.sourcedata.bids.toplevel")
+        if not in_shard(child_dir, shard):
+            return
+        os.makedirs(child_dir, exist_ok=True)
+        for key in json_data:
+            if "{" in key or "{" in str(json_data.get(key, "")):
+                continue
+            src = os.path.join(source_dir, key)
+            dst = os.path.join(child_dir, key)
+            if os.path.isfile(src):
+                if os.path.lexists(dst):
+                    os.remove(dst)
+                os.symlink(os.path.abspath(src), dst)
+        print("Starting " + parent_name + " file-mapping (toplevel)")
+        return
+
+    # Check if any path in the JSON contains session template
+    requires_sessions = any(
+        "ses-{SESSION}" in str(value) for value in json_data.values()
+    )
+    print(f"JSON {filename} requires sessions: {requires_sessions}")
+    has_runs = any("{RUN}" in key for key in json_data)
+
+    # Filter lookup entries based on session requirement
+    filtered_lookup = []
+    for entry in lookup:
+        sub_ses = entry["bids_subject_session"]
+        has_session = "_ses-" in sub_ses
+
+        if requires_sessions and has_session:
+            filtered_lookup.append(entry)
+        elif not requires_sessions and not has_session:
+            filtered_lookup.append(entry)
+
+    print(
+        f"Filtered lookup entries: {len(filtered_lookup)} out of {len(lookup)}"
+    )
+
+    # creating the parent and child directory for the files to get mapped to
+    parent_name = filename[: -len(".json")]
+    parent_dir = os.path.join(dest_dir, parent_name)
+    parent_head, parent_tail = parent_name.split("_", 1)
+
+    print("Starting " + parent_name + " file-mapping")
+
+    for i in range(len(filtered_lookup)):
+        sub_ses = filtered_lookup[i]["bids_subject_session"]
+        guid = filtered_lookup[i].get("subjectkey", "").replace("_", "")
+
+        if ("_" in sub_ses) and ("_ses-" not in sub_ses):
+            print(
+                'Improperly formatted "bids_subject_session": '
+                + sub_ses
+                + '. Requires "_ses-" between subject and session. Exiting.'
+            )
+            sys.exit(7)
+
+        char_count = sub_ses.count("_")
+        if char_count > 1:
+            print(
+                'Improperly formatted "bids_subject_session": '
+                + sub_ses
+                + '. Requires no more than one "_" (underscore). Exiting.'
+            )
+            sys.exit(8)
+
+        subject, session = subject_session_labels(sub_ses)
+        if "_ses-" in sub_ses:
+            bids_subject, bids_session = sub_ses.split("_")
+            subject_and_session_flag = True
+        else:
+            bids_subject = sub_ses
+            subject_and_session_flag = False
+
+        if subject_and_session_flag:
+            child_dir = os.path.join(
+                parent_dir,
+                "sub-" + guid + "_" + bids_session + "." + parent_tail,
+            )
+        else:
+            child_dir = os.path.join(
+                parent_dir, "sub-" + guid + "." + parent_tail
+            )
+
+        # other shards map the rest
+        if not in_shard(child_dir, shard):
+            continue
 
+        if os.path.isdir(parent_dir):
+            try:
+                os.mkdir(child_dir)
+            except FileExistsError:
+                print(child_dir + " exists")
 
-def filemap_and_recordsprep(dest_dir, source_dir, skip):
+        if not os.path.isdir(child_dir):
+            try:
+                os.makedirs(child_dir)
+            except FileExistsError:
+                print(child_dir + " exists")
+
+        # calling the file mapper function directly
+        print("Preparing " + bids_subject)
+
+        # creating the template string for the file mapper
+        if subject_and_session_flag:
+            template = f"SUBJECT={subject},SESSION={session},GUID={guid}"
+        else:
+            template = f"SUBJECT={subject},GUID={guid}"
+
+        # run-{RUN} mappings are expanded into a per-subject/session copy
+        json_file = os.path.join(dest_dir, filename)
+        if has_runs:
+            expanded = expand_run_placeholders(
+                json_data,
+                source_dir,
+                subject,
+                session if subject_and_session_flag else None,
+            )
+            with tempfile.NamedTemporaryFile(
+                "w", suffix=".json", delete=False
+            ) as outfile:
+                json.dump(expanded, outfile, indent=4)
+            json_file = outfile.name
 
+        # Call the file mapper function directly
+        try:
+            process_json_file(
+                json_file=json_file,
+                sourcepath=source_dir,
+                destpath=child_dir,
+                template=template,
+                action="symlink",
+                overwrite=False,
+                testdebug=False,
+                verbose=False,
+                relsym=False,
+                sidecars=False,
+                skip_errors=False,
+            )
+        except Exception as e:
+            if "File exists" in str(e):
+                pass
+            else:
+                print(f"Error processing {bids_subject}: {e}")
+            continue
+        finally:
+            if has_runs:
+                os.remove(json_file)
+
+        # if FM_cmd failed
+        if not os.path.isdir(child_dir):
+            # go to the next iteration of this loop and skip below lines
+            continue
+
+        child_check = False
+        for child_content in os.listdir(child_dir):
+            content_path = os.path.join(child_dir, child_content)
+            if os.path.isdir(content_path):
+                child_check = True
+                break
+
+        # Delete if content not found
+        if child_check == False:
+            for child_content in os.listdir(child_dir):
+                content_path = os.path.join(child_dir, child_content)
+                os.remove(content_path)
+            os.rmdir(child_dir)
+
+
+def verify_parent_links(parent_dir, source_dir, shard=None):
+    """Whether every symlink of the parent (of its shard) resolves into source_dir."""
+    from utilities.verify_links import verify_parent
+
+    children = [
+        child
+        for child in os.listdir(parent_dir)
+        if os.path.isdir(os.path.join(parent_dir, child)) and in_shard(child, shard)
+    ]
+    return not verify_parent(parent_dir, [source_dir], children)
+
+
+def records_parent(dest_dir, parent_name, shard=None, source_dir=None):
+    """
+    Records preparation for one parent, reporting instead of raising errors.
+    With source_dir, its links are checked first and a parent with broken
+    links gets no records.
+    """
+    from records import cli as records_cli
+
+    parent_dir = os.path.join(dest_dir, parent_name)
+
+    if source_dir is not None:
+        try:
+            with stage("verify:" + parent_name):
+                links_ok = verify_parent_links(parent_dir, source_dir, shard)
+            if not links_ok:
+                print(f"Skipping records for {parent_name}: it has broken links")
+                return False
+        except OSError as e:
+            print(f"Error checking links of {parent_name}: {e}")
+            return False
+
+    # Call the records function directly
+    try:
+        records_cli(parent_dir, shard=shard)
+    except Exception as e:
+        print(f"Error processing records for {parent_name}: {e}")
+        return False
+    return True
+
+
+def filemap_and_recordsprep(
+    dest_dir,
+    source_dir,
+    skip,
+    pack_small_files=None,
+    small_file_size=1024 * 1024,
+    shard=None,
+    verify_links=True,
+):
     if skip:
         print("Skipping file-mapping")
     else:
-        lookup_csv = os.path.join(dest_dir, "lookup.csv")
-        child_check = False
-
-        with open(lookup_csv, "r") as f:
-            lookup = [row for row in csv.DictReader(f)]
+        lookup = read_lookup(dest_dir)
 
         # go through all of the file_mapper json's using the current subject session pairing
         # assumes every JSON in the dest_dir is a file mapper JSON
-        import json
-
         for filename in os.listdir(dest_dir):
             if not filename.endswith(".json"):
                 continue
-            json_file_path = os.path.join(dest_dir, filename)
-            with open(json_file_path, "r") as infile:
-                json_data = json.load(infile)
-            print(json_data)
-
-            # BIDS toplevel: one folder, no subject/session; symlink top-level files only
-            if filename == "image03_sourcedata.bids.toplevel.json":
-                parent_name = filename.rstrip(".json")
-                parent_dir = os.path.join(dest_dir, parent_name)
-                os.makedirs(parent_dir, exist_ok=True)
-                child_dir = os.path.join(parent_dir, "toplevel.sourcedata.bids.toplevel")
-                os.makedirs(child_dir, exist_ok=True)
-                for key in json_data:
-                    if "{" in key or "{" in str(json_data.get(key, "")):
-                        continue
-                    src = os.path.join(source_dir, key)
-                    dst = os.path.join(child_dir, key)
-                    if os.path.isfile(src):
-                        if os.path.lexists(dst):
-                            os.remove(dst)
-                        os.symlink(os.path.abspath(src), dst)
-                print("Starting " + parent_name + " file-mapping (toplevel)")
-                continue
-
-            # Check if any path in the JSON contains session template
-            requires_sessions = any(
-                "ses-{SESSION}" in str(value) for value in json_data.values()
-            )
-            print(f"JSON {filename} requires sessions: {requires_sessions}")
-
-            # Filter lookup entries based on session requirement
-            filtered_lookup = []
-            for entry in lookup:
-                sub_ses = entry["bids_subject_session"]
-                has_session = "_ses-" in sub_ses
+            with stage("filemap:" + filename[: -len(".json")]):
+                filemap_parent(dest_dir, source_dir, filename, lookup, shard)
 
-                if requires_sessions and has_session:
-                    filtered_lookup.append(entry)
-                elif not requires_sessions and not has_session:
-                    filtered_lookup.append(entry)
-
-            print(
-                f"Filtered lookup entries: {len(filtered_lookup)} out of {len(lookup)}"
-            )
-
-            # creating the parent and child directory for the files to get mapped to
-            parent_name = filename.rstrip(".json")
-            parent_dir = os.path.join(dest_dir, parent_name)
-            parent_head, parent_tail = parent_name.split("_", 1)
-
-            print("Starting " + parent_name + " file-mapping")
-
-            for i in range(len(filtered_lookup)):
-                sub_ses = filtered_lookup[i]["bids_subject_session"]
-                guid = filtered_lookup[i].get("subjectkey", "").replace("_", "")
-
-                if ("_" in sub_ses) and ("_ses-" not in sub_ses):
-                    print(
-                        'Improperly formatted "bids_subject_session": '
-                        + sub_ses
-                        + '. Requires "_ses-" between subject and session. Exiting.'
-                    )
-                    sys.exit(7)
-
-                char_count = sub_ses.count("_")
-                if char_count > 1:
-                    print(
-                        'Improperly formatted "bids_subject_session": '
-                        + sub_ses
-                        + '. Requires no more than one "_" (underscore). Exiting.'
-                    )
-                    sys.exit(8)
-
-                if "_ses-" in sub_ses:
-                    bids_subject, bids_session = sub_ses.split("_")
-                    subject = bids_subject.lstrip("sub-")
-                    session = bids_session.lstrip("ses-")
-                    subject_and_session_flag = True
-                else:
-                    bids_subject = sub_ses
-                    subject = bids_subject.lstrip("sub-")
-                    subject_and_session_flag = False
-
-                if subject_and_session_flag:
-                    child_dir = os.path.join(
-                        parent_dir,
-                        "sub-" + guid + "_" + bids_session + "." + parent_tail,
-                    )
-                else:
-                    child_dir = os.path.join(
-                        parent_dir, "sub-" + guid + "." + parent_tail
-                    )
-
-                if os.path.isdir(parent_dir):
-                    try:
-                        os.mkdir(child_dir)
-                    except FileExistsError:
-                        print(child_dir + " exists")
-
-                if not os.path.isdir(child_dir):
-                    try:
-                        os.makedirs(child_dir)
-                    except FileExistsError:
-                        print(child_dir + " exists")
-
-                # calling the file mapper function directly
-                print("Preparing " + bids_subject)
-
-                # creating the template string for the file mapper
-                if subject_and_session_flag:
-                    template = f"SUBJECT={subject},SESSION={session},GUID={guid}"
-                else:
-                    template = f"SUBJECT={subject},GUID={guid}"
-
-                # Call the file mapper function directly
-                try:
-                    process_json_file(
-                        json_file=os.path.join(dest_dir, filename),
-                        sourcepath=source_dir,
-                        destpath=child_dir,
-                        template=template,
-                        action="symlink",
-                        overwrite=False,
-                        testdebug=False,
-                        verbose=False,
-                        relsym=False,
-                        sidecars=False,
-                        skip_errors=False,
-                    )
-                except Exception as e:
-                    if "File exists" in str(e):
-                        pass
-                    else:
-                        print(f"Error processing {bids_subject}: {e}")
-                    continue
-
-                # if FM_cmd failed
-                if not os.path.isdir(child_dir):
-                    # go to the next iteration of this loop and skip below lines
-                    continue
-
-                child_check = False
-                for child_content in os.listdir(child_dir):
-                    content_path = os.path.join(child_dir, child_content)
-                    if os.path.isdir(content_path):
-                        child_check = True
-                        break
-
-                # Delete if content not found
-                if child_check == False:
-                    for child_content in os.listdir(child_dir):
-                        content_path = os.path.join(child_dir, child_content)
-                        os.remove(content_path)
-                    os.rmdir(child_dir)
+    if pack_small_files is not None:
+        print("PACKING SMALL FILES IN SOURCEDATA PARENTS.")
+        with stage("pack"):
+            pack_sourcedata_parents(dest_dir, pack_small_files, small_file_size, shard)
 
     print("DATA PREPARED.  ATTEMPTING RECORDS PREPARATION.")
 
     for filename in os.listdir(dest_dir):
         if filename.endswith(".json"):
-
-            # creating the parent and child directory for the files to get mapped to
-            parent_name = filename.rstrip(".json")
-            parent_dir = os.path.join(dest_dir, parent_name)
-
-            # Call the records function directly
-            try:
-                records_cli(parent_dir)
-            except Exception as e:
-                print(f"Error processing records for {parent_name}: {e}")
-                continue
+            with stage("records:" + filename[: -len(".json")]):
+                records_parent(
+                    dest_dir,
+                    filename[: -len(".json")],
+                    shard,
+                    source_dir if verify_links else None,
+                )
 
 
 def main():
     """Main entry point for the nda-prepare command."""
     print("Starting input check")
-    dest_dir, manifest_script, source_dir, skip = input_check()
+    (
+        dest_dir,
+        source_dir,
+        skip,
+        pack_small_files,
+        small_file_size,
+        shard,
+        skip_link_check,
+        profile,
+        profile_memory,
+    ) = input_check()
 
     print("Starting file-mapping and records preparation")
-    filemap_and_recordsprep(dest_dir, source_dir, skip)
+    with profiling(profile, dest_dir, "prepare", profile_memory):
+        filemap_and_recordsprep(
+            dest_dir,
+            source_dir,
+            skip,
+            pack_small_files,
+            small_file_size,
+            shard,
+            not skip_link_check,
+        )
 
     print("Complete! Please review data prepared at: " + dest_dir)
 
@@ -8,17 +8,21 @@ Created  02/20/2020  Eric Earl (earl@ohsu.edu)
 
 import argparse
 import csv
-import math
 import os
 import sys
-import yaml
 from datetime import datetime
 from glob import glob
 import subprocess
 
-# load nda_manifests.py from submodule
-sys.path.append(os.path.abspath("manifest-data"))
-from nda_manifests import Manifest
+from utilities.batches import write_batches, write_folders_txt, write_records_csv
+from utilities.manifests import (
+    DEFAULT_DIGEST_STORE,
+    DigestStore,
+    create_manifest,
+    write_manifest,
+)
+from utilities.profiling import add_profile_arguments, profiling, stage
+from utilities.shards import in_shard, parse_shard, write_shard
 
 
 HERE = os.path.dirname(os.path.realpath(__file__))
@@ -56,11 +60,40 @@ def generate_parser():
         ),
     )
 
+    parser.add_argument(
+        "--digest-store",
+        dest="digest_store",
+        metavar="TSV",
+        default=DEFAULT_DIGEST_STORE,
+        help=(
+            "File digests to trust while a file's size and mtime are unchanged, "
+            "so manifests only read files without one (e.g. not written by "
+            "dicom2targz.py).  Digests computed here are added to it."
+        ),
+    )
+
+    parser.add_argument(
+        "--shard",
+        dest="shard",
+        metavar="I/N",
+        type=parse_shard,
+        default=None,
+        help=(
+            "Only prepare the child folders of shard I of N (0 <= I < N), by a hash "
+            "of their subject/session, and write shard records instead of the "
+            "complete records and batches.  Combine the shards with "
+            "`nda-records merge PARENT_DIR` once all are done."
+        ),
+    )
+
+    add_profile_arguments(parser, "the folder holding PARENT_DIR")
+
     return parser
 
 
 # Sanity check against user inputs
 def records_sanity_check(input):
+    import yaml
 
     # check if input is a directory
     if not os.path.isdir(input):
@@ -71,15 +104,6 @@ def records_sanity_check(input):
 
     dest_dir = os.path.dirname(parent)
     lookup_csv = os.path.join(dest_dir, "lookup.csv")
-    manifest_script = os.path.join(HERE, "manifest-data", "nda_manifests.py")
-
-    # check if manifest_script exists
-    if not os.path.isfile(manifest_script):
-        print(
-            manifest_script
-            + ' is not a file, contained a directory above "parent" in a directory called manifest-data.  Exiting...'
-        )
-        sys.exit(2)
 
     # check if lookup_csv exists
     if not os.path.isfile(lookup_csv):
@@ -210,12 +234,13 @@ def records_sanity_check(input):
         sys.exit(10)
 
 
-def cli(input):
+def cli(input, digest_store=DEFAULT_DIGEST_STORE, shard=None):
+    # yaml is imported here rather than at module level to keep startup fast
+    import yaml
 
     # setting easy use variables from argparse
     parent = os.path.abspath(os.path.realpath(input))
     dest_dir = os.path.dirname(parent)
-    manifest_script = os.path.join(HERE, "manifest-data", "nda_manifests.py")
     lookup_csv = os.path.join(dest_dir, "lookup.csv")
 
     # grab parent's basename
@@ -274,6 +299,8 @@ def cli(input):
         )  # Remove underscores like in prepare.py
         ndar_to_bids_mapping[ndar_guid] = row["bids_subject_session"]
 
+    store = DigestStore(digest_store)
+
     ### DO WORK ###
 
     # get original working dir (just to not break things)
@@ -294,6 +321,9 @@ def cli(input):
         # skip to the next iteration of the for loop if the upload_dir is not a directory
         if not os.path.isdir(upload_dir):
             continue
+        # other shards prepare the rest
+        if not in_shard(upload_dir, shard):
+            continue
 
         # create an NDA record for each folder using the content YAML file
         upload_basename = os.path.basename(upload_dir)
@@ -304,8 +334,7 @@ def cli(input):
         # BIDS toplevel: single folder, use first lookup row and top-level-only manifest
         if basename == "image03_sourcedata.bids.toplevel":
             lookup_record = lookup[0] if lookup else {}
-            manifest = Manifest()
-            manifest.create_from_dir(upload_dir, top_level_only=True)
+            manifest = create_manifest(upload_dir, store, top_level_only=True)
         else:
             # Extract NDAR GUID from the folder name (e.g., "sub-NDAR123456_ses-baseline" -> "NDAR123456")
             if bids_subject_session.startswith("sub-"):
@@ -335,10 +364,9 @@ def cli(input):
                 )
                 continue
 
-            manifest = Manifest()
-            manifest.create_from_dir(upload_dir)
-        manifest.output_as_file(
-            os.path.join(upload_dir, f"{bids_subject_session}.manifest.json")
+            manifest = create_manifest(upload_dir, store)
+        write_manifest(
+            os.path.join(upload_dir, f"{bids_subject_session}.manifest.json"), manifest
         )
 
         # correct the manifest contents to remove the leading "./" from each manifest element
@@ -387,61 +415,25 @@ def cli(input):
 
     os.chdir(original_working_dir)
 
-    with open(parent + ".complete_records.csv", "w") as f:
-        f.write(ndaheader + "\n")
-
-        writer = csv.DictWriter(f, fieldnames=header, quoting=csv.QUOTE_ALL)
-        writer.writeheader()
-        for record in records:
-            writer.writerow(record)
-
-    with open(parent + ".complete_folders.txt", "w") as f:
-        for folder in folders:
-            f.write(folder + "\n")
-
-    max_batch_size = 500  # @TODO this needs to become an integer input defaulted to 500
-    total = len(records)
-    print(f"total={total}")
-    count = math.ceil(float(total) / max_batch_size)
-    batch_size = math.ceil(float(total) / count)
-
-    low = 0
-    print(f"{datetime.now()} Creating batch files")
-    for i in range(1, count + 1):
-        if i < count or total == batch_size:
-            B = batch_size
+    with stage("write:" + basename):
+        if shard is None:
+            records_csv = parent + ".complete_records.csv"
+            write_records_csv(records_csv, ndaheader, header, records)
+            write_folders_txt(parent + ".complete_folders.txt", folders)
+            write_batches(parent, ndaheader, header, records, folders)
         else:
-            B = total % batch_size
-
-        records_subset = records[low : (low + B)]
-        folders_subset = folders[low : (low + B)]
-        low = i * batch_size
-
-        batchname = "_".join([str(total), str(max_batch_size), str(i)])
-        records_batch = parent + ".records_" + batchname + ".csv"
-        folders_batch = parent + ".folders_" + batchname + ".txt"
-
-        with open(records_batch, "w") as f:
-            f.write(ndaheader + "\n")
-
-            writer = csv.DictWriter(f, fieldnames=header, quoting=csv.QUOTE_ALL)
-            writer.writeheader()
-            for record in records_subset:
-                writer.writerow(record)
-
-        with open(folders_batch, "w") as f:
-            for folder in folders_subset:
-                f.write(folder + "\n")
+            records_csv = write_shard(parent, shard, ndaheader, header, records, folders)
 
     print("FINISHED " + basename + " RECORDS PREPARATION.")
 
-    validation = run_vtcmd_realtime(parent + ".complete_records.csv", input)
+    with stage("validate:" + basename):
+        validation = run_vtcmd_realtime(records_csv, input)
     if validation == 0:
-        print(f"Files prepped at {input} with {parent}.complete_records.csv are valid.")
+        print(f"Files prepped at {input} with {records_csv} are valid.")
     else:
         print(
-            f"Files prepped at {input} with {parent}.complete_records.csv are invalid, run\n"
-            f"vtcdm {input}.complete_records.csv -m {input} --verbose\n"
+            f"Files prepped at {input} with {records_csv} are invalid, run\n"
+            f"vtcdm {records_csv} -m {input} --verbose\n"
             f"for more details on how to fix"
         )
 
@@ -473,11 +465,30 @@ def run_vtcmd_realtime(csv_file, manifest_dir):
         return False
 
 
-if __name__ == "__main__":
+def main():
+    """Main entry point for the nda-records command."""
+    # `nda-records merge ...` combines the records of --shard runs
+    if sys.argv[1:2] == ["merge"]:
+        from utilities.shards import cli as merge_cli
+
+        return merge_cli(sys.argv[2:])
+
+    # `nda-records verify ...` reports broken links before records
+    if sys.argv[1:2] == ["verify"]:
+        from utilities.verify_links import cli as verify_cli
+
+        return verify_cli(sys.argv[2:])
+
     # command line interface parse
     parser = generate_parser()
     args = parser.parse_args()
 
     records_sanity_check(args.parent)
-    cli(args.parent)
+    parent = os.path.abspath(os.path.realpath(args.parent))
+    with profiling(args.profile, os.path.dirname(parent), "records", args.profile_memory):
+        cli(args.parent, args.digest_store, args.shard)
     sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
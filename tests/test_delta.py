@@ -0,0 +1,102 @@
+"""Tests for records batch files and delta releases between prepared destinations."""
+
+import json
+
+import upload
+
+from utilities.batches import read_folders_txt, read_records_csv, write_batches, write_records_csv
+from utilities.delta import CHANGED, NEW, UNCHANGED, delta_release
+
+NDAHEADER = '"image","03"'
+HEADER = ["subjectkey", "interview_age", "manifest"]
+
+
+def _prepare_release(destination, children):
+    """
+    Write a prepared parent like records.py does.  children maps a GUID to
+    (interview_age, {file path: md5sum}).
+    """
+    parent = destination / "image03_sourcedata.anat.T1w"
+    parent.mkdir(parents=True)
+    records, folders = [], []
+    for guid, (age, files) in children.items():
+        folder = f"sub-{guid}.sourcedata.anat.T1w"
+        (parent / folder).mkdir()
+        manifest = {"files": [{"path": p, "name": p, "size": 1, "md5sum": m} for p, m in files.items()]}
+        (parent / folder / f"sub-{guid}.manifest.json").write_text(json.dumps(manifest))
+        records.append({"subjectkey": guid, "interview_age": age, "manifest": f"{folder}/sub-{guid}.manifest.json"})
+        folders.append(folder)
+    write_records_csv(str(parent) + ".complete_records.csv", NDAHEADER, HEADER, records)
+    (destination / (parent.name + ".complete_folders.txt")).write_text("\n".join(folders) + "\n")
+    return parent
+
+
+def test_write_batches_splits_evenly(tmp_path):
+    parent = str(tmp_path / "image03_sourcedata.anat.T1w")
+    records = [{"subjectkey": str(i), "interview_age": "", "manifest": ""} for i in range(1000)]
+    folders = [f"sub-{i}" for i in range(1000)]
+    batchnames = write_batches(parent, NDAHEADER, HEADER, records, folders)
+    assert batchnames == ["1000_500_1", "1000_500_2"]
+    ndaheader, header, second = read_records_csv(parent + ".records_1000_500_2.csv")
+    assert ndaheader == NDAHEADER and header == HEADER
+    assert [r["subjectkey"] for r in second] == [str(i) for i in range(500, 1000)]
+    assert read_folders_txt(parent + ".folders_1000_500_2.txt") == folders[500:]
+    assert write_batches(parent, NDAHEADER, HEADER, [], []) == []
+
+
+def test_delta_release(tmp_path):
+    _prepare_release(
+        tmp_path / "previous",
+        {
+            "NDAR1": ("120", {"a.nii.gz": "x1"}),
+            "NDAR2": ("130", {"a.nii.gz": "x2"}),
+            "NDAR3": ("140", {"a.nii.gz": "x3"}),
+        },
+    )
+    parent = _prepare_release(
+        tmp_path / "new",
+        {
+            "NDAR1": ("120", {"a.nii.gz": "x1"}),
+            "NDAR2": ("130", {"a.nii.gz": "changed"}),
+            "NDAR3": ("141", {"a.nii.gz": "x3"}),
+            "NDAR4": ("150", {"a.nii.gz": "x4"}),
+        },
+    )
+
+    report = delta_release(tmp_path / "previous", tmp_path / "new")
+    status = {folder.split(".")[0]: label for _, folder, label in report}
+    assert status == {
+        "sub-NDAR1": UNCHANGED,
+        "sub-NDAR2": CHANGED,
+        "sub-NDAR3": CHANGED,
+        "sub-NDAR4": NEW,
+    }
+
+    _, _, delta = read_records_csv(str(parent) + ".records_delta_3_500_1.csv")
+    assert [r["subjectkey"] for r in delta] == ["NDAR2", "NDAR3", "NDAR4"]
+    assert len(read_folders_txt(str(parent) + ".delta_folders.txt")) == 3
+    assert (tmp_path / "new" / "delta_report.tsv").exists()
+    # upload.py --delta finds exactly the batches that were written
+    (description, records_batch, folders_batch), = upload.parent_batches(str(parent), delta=True)
+    assert records_batch == str(parent) + ".records_delta_3_500_1.csv"
+
+
+def test_delta_release_escapes_glob_characters_in_paths(tmp_path):
+    children = {"NDAR1": ("120", {"a.nii.gz": "x1"})}
+    _prepare_release(tmp_path / "previous", children)
+    # as a glob pattern, "release[1]" matches "release1", another destination
+    # its manifest differs, reading it instead would make NDAR1 changed
+    other = _prepare_release(tmp_path / "release1", {"NDAR1": ("120", {"a.nii.gz": "other"})})
+    kept = tmp_path / "release1" / (other.name + ".records_delta_1_500_1.csv")
+    kept.write_text("another destination's batch")
+    parent = _prepare_release(tmp_path / "release[1]", dict(children, NDAR2=("130", {"a.nii.gz": "x2"})))
+    stale = tmp_path / "release[1]" / (parent.name + ".records_delta_9_500_1.csv")
+    stale.write_text("left over from an earlier comparison")
+
+    report = delta_release(tmp_path / "previous", tmp_path / "release[1]")
+    assert sorted((folder.split(".")[0], label) for _, folder, label in report) == [
+        ("sub-NDAR1", UNCHANGED),
+        ("sub-NDAR2", NEW),
+    ]
+    assert not stale.exists()
+    assert kept.read_text() == "another destination's batch"
@@ -0,0 +1,398 @@
+"""Tests for utilities/dicom2targz.py archiving."""
+
+import csv
+import os
+import tarfile
+
+import pytest
+
+pydicom = pytest.importorskip("pydicom")
+
+from pydicom.dataset import FileDataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+from utilities import dicom2targz, dicom_index
+from utilities.manifests import DigestStore, md5_file
+
+
+def write_series(directory, series_number, n_files=3, description="T1w"):
+    """A directory of minimal DICOM files of one series."""
+    directory.mkdir(parents=True)
+    series_uid = generate_uid()
+    for i in range(n_files):
+        meta = FileMetaDataset()
+        meta.MediaStorageSOPClassUID = "1.2.840.10008.5.1.4.1.1.4"
+        meta.MediaStorageSOPInstanceUID = generate_uid()
+        meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        ds = FileDataset(str(directory / f"{i}.dcm"), {}, file_meta=meta, preamble=b"\0" * 128)
+        ds.SeriesNumber = series_number
+        ds.SeriesInstanceUID = series_uid
+        ds.SeriesDescription = description
+        ds.PatientID = "01"
+        ds.StudyDate = "20240101"
+        ds.PixelData = b"\0" * 4096
+        ds.Rows, ds.Columns, ds.BitsAllocated = 64, 32, 16
+        ds.save_as(directory / f"{i}.dcm", enforce_file_format=True)
+    return directory
+
+
+@pytest.fixture
+def series_csv(tmp_path):
+    rows = []
+    for number, name, modality in ((2, "T1w", "anat"), (5, "task-rest_bold", "func")):
+        source = write_series(tmp_path / "dicoms" / f"{number}-{name}", number)
+        rows.append(
+            {
+                "source": str(source),
+                "nda_bids_subject": "sub-01",
+                "bids_session": "ses-01",
+                "bids_name": name,
+                "bids_modality": modality,
+            }
+        )
+    input_csv = tmp_path / "series.csv"
+    with open(input_csv, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+    return input_csv
+
+
+@pytest.mark.parametrize("codec, extension", [("gzip", ".tar.gz"), ("store", ".tar")])
+def test_archive_all_in_parallel(series_csv, tmp_path, codec, extension):
+    output_dir = tmp_path / "out"
+    rows = dicom2targz.read_series_csv(series_csv)
+    store_path = tmp_path / "digests.tsv"
+    results, failures = dicom2targz.archive_all(
+        rows, str(output_dir), codec=codec, level=1, jobs=2, digest_store=str(store_path)
+    )
+
+    assert failures == []
+    outputs = sorted(r["output"] for r in results)
+    assert outputs == [
+        str(output_dir / "sourcedata/sub-01/ses-01/anat/sub-01_ses-01_T1w_series-2" ) + extension,
+        str(output_dir / "sourcedata/sub-01/ses-01/func/sub-01_ses-01_task-rest_bold_series-5") + extension,
+    ]
+    for result in results:
+        with tarfile.open(result["output"]) as tar:
+            assert sorted(n for n in tar.getnames() if n.endswith(".dcm")) == ["./0.dcm", "./1.dcm", "./2.dcm"]
+        assert result["files"] == 3
+        assert result["ratio"] == pytest.approx(result["input_bytes"] / result["output_bytes"], rel=1e-3)
+        if codec == "gzip":
+            assert result["ratio"] > 1
+        # the digest taken while streaming matches the file and is trusted by manifests
+        assert result["md5sum"] == md5_file(result["output"])
+        assert DigestStore(store_path).lookup(result["output"]) == result["md5sum"]
+
+    report = dicom2targz.write_report(results, str(output_dir))
+    with open(report) as f:
+        assert len(list(csv.DictReader(f, delimiter="\t"))) == 2
+
+
+def test_probe_series_reads_headers_and_is_cached(tmp_path, monkeypatch):
+    from utilities import dicom_probe
+
+    source = write_series(tmp_path / "7-rest", 7, description="rest")
+    probe = dicom_probe.probe_series(str(source))
+    assert probe["tags"]["SeriesNumber"] == "7"
+    assert probe["tags"]["SeriesDescription"] == "rest"
+    assert "PixelData" not in pydicom.dcmread(probe["file"], stop_before_pixels=True)
+
+    def no_read(*args, **kwargs):
+        raise AssertionError("cached probe should not read the file")
+
+    monkeypatch.setattr(dicom_probe, "probe_file", no_read)
+    assert dicom_probe.probe_series(str(source), probe) is probe
+
+    cache_path = str(tmp_path / "cache" / "probes.json")
+    dicom_probe.save_probe_cache(cache_path, {str(source): probe})
+    assert dicom_probe.load_probe_cache(cache_path) == {str(source): probe}
+
+
+def test_manifest_trusts_stored_digests_until_file_changes(tmp_path, monkeypatch):
+    from utilities import manifests
+
+    child = tmp_path / "sub-NDAR1_ses-01.sourcedata.anat.dicom"
+    (child / "sub-NDAR1" / "ses-01" / "anat").mkdir(parents=True)
+    archive = tmp_path / "archive.tar.gz"
+    archive.write_bytes(b"archive")
+    (child / "sub-NDAR1" / "ses-01" / "anat" / "a.tar.gz").symlink_to(archive)
+    (child / "sub-NDAR1.manifest.json").write_text("{}")
+
+    store = manifests.DigestStore(tmp_path / "digests.tsv")
+    store.add(archive, "0" * 32)
+
+    read = []
+    monkeypatch.setattr(manifests, "md5_file", lambda path: read.append(path) or "f" * 32)
+    manifest = manifests.create_manifest(str(child), store)
+    assert manifest == {
+        "files": [{"path": "./sub-NDAR1/ses-01/anat/a.tar.gz", "name": "a.tar.gz", "size": 7, "md5sum": "0" * 32}]
+    }
+    assert read == []
+
+    archive.write_bytes(b"changed archive")
+    assert manifests.create_manifest(str(child), store)["files"][0]["md5sum"] == "f" * 32
+    assert len(read) == 1
+    assert manifests.DigestStore(tmp_path / "digests.tsv").lookup(archive) == "f" * 32
+
+
+def test_records_manifest_keeps_the_nda_manifests_format(tmp_path, monkeypatch):
+    """records.py writes manifests as nda_manifests.Manifest did, after stripping its leading "./"."""
+    import json
+
+    import records
+
+    monkeypatch.setattr(records, "run_vtcmd_realtime", lambda csv_file, manifest_dir: True)
+    elsewhere = tmp_path / "elsewhere"
+    elsewhere.mkdir()
+    (elsewhere / "linked.dcm").write_bytes(b"linked")
+
+    parent = tmp_path / "dest" / "image03_sourcedata.anat.T1w"
+    child = parent / "sub-NDAR1_ses-1.sourcedata.anat.T1w"
+    anat = child / "sub-NDAR1" / "ses-1" / "anat"
+    anat.mkdir(parents=True)
+    (anat / "T1w.nii.gz").write_bytes(b"image")
+    (anat / "T1w.json").symlink_to(elsewhere / "linked.dcm")
+    # file-mapper symlinks files; a symlinked folder is not descended into
+    (child / "sub-NDAR1" / "ses-1" / "dicom").symlink_to(elsewhere)
+    (tmp_path / "dest" / "lookup.csv").write_text(
+        "subjectkey,src_subject_id,bids_subject_session,interview_age\nNDAR1,sub-01,sub-01_ses-1,20\n"
+    )
+    (tmp_path / "dest" / "image03_sourcedata.anat.T1w.yaml").write_text("scan_type: MR structural (T1)\n")
+
+    for run in range(2):
+        records.cli(str(parent), digest_store=str(tmp_path / "digests.tsv"))
+        manifest = json.loads((child / "sub-NDAR1_ses-1.manifest.json").read_text())
+        assert sorted(manifest["files"], key=lambda entry: entry["path"]) == [
+            {"path": "sub-NDAR1/ses-1/anat/T1w.json", "name": "T1w.json", "size": 6, "md5sum": md5_file(elsewhere / "linked.dcm")},
+            {"path": "sub-NDAR1/ses-1/anat/T1w.nii.gz", "name": "T1w.nii.gz", "size": 5, "md5sum": md5_file(anat / "T1w.nii.gz")},
+        ]
+
+
+def test_digest_store_buffers_appends_and_skips_malformed_lines(tmp_path, capsys, monkeypatch):
+    from utilities import manifests
+
+    child = tmp_path / "sub-NDAR1_ses-01.inputs.anat.T1w"
+    child.mkdir()
+    for name in ("a.nii.gz", "b.nii.gz", "c.json"):
+        (child / name).write_text(name)
+    store_path = tmp_path / "digests.tsv"
+    # an interrupted writer left a truncated line without a newline
+    store_path.write_text(f"{tmp_path}/old.nii.gz\t12\t1700000000\tabc\n{tmp_path}/cut.nii.gz\t1")
+
+    store = manifests.DigestStore(store_path)
+    assert "skipped 1 malformed line(s)" in capsys.readouterr().out
+    assert store.lookup(tmp_path / "cut.nii.gz") is None
+
+    writes = []
+    os_write = os.write
+
+    def counting_write(fd, data):
+        writes.append(data)
+        return os_write(fd, data)
+
+    monkeypatch.setattr(manifests.os, "write", counting_write)
+    manifest = manifests.create_manifest(str(child), store)
+    monkeypatch.undo()
+    assert len(manifest["files"]) == 3
+    assert len(writes) == 1
+
+    reloaded = manifests.DigestStore(store_path)
+    assert "malformed" in capsys.readouterr().out
+    assert all(reloaded.lookup(child / name) == md5_file(child / name) for name in ("a.nii.gz", "b.nii.gz", "c.json"))
+    assert store_path.read_text().count("\n") == 5
+
+
+def _flush_digests(store_path, worker):
+    """Add and flush 50 batches of 40 digests, as one prepare stage of nda-pipeline would."""
+    store = DigestStore(store_path)
+    for batch in range(50):
+        for i in range(40):
+            store.add(f"/w{worker}/{batch}/{i}.nii.gz", "0" * 32, 1, 1)
+        store.flush()
+
+
+def test_digest_store_takes_concurrent_appends(tmp_path):
+    from concurrent.futures import ProcessPoolExecutor
+
+    store_path = str(tmp_path / "digests.tsv")
+    with ProcessPoolExecutor(max_workers=4) as pool:
+        list(pool.map(_flush_digests, [store_path] * 4, range(4)))
+    lines = open(store_path).read().splitlines()
+    assert len(lines) == 4 * 50 * 40
+    assert all(len(line.split("\t")) == 4 for line in lines)
+    assert len(DigestStore(store_path).digests) == 4 * 50 * 40
+
+
+def test_index_dicom_tree_builds_the_series_csv(tmp_path):
+    dicom_root = tmp_path / "raw"
+    write_series(dicom_root / "study" / "a", 2, description="MPRAGE")
+    write_series(dicom_root / "study" / "b", 5, n_files=2, description="rest fMRI")
+    write_series(dicom_root / "study" / "c", 7, description="localizer")
+    (dicom_root / "study" / "notes.txt").write_text("not a DICOM file")
+    rules_path = tmp_path / "rules.json"
+    rules_path.write_text(
+        '[{"match": "(?i)mprage", "bids_name": "T1w", "bids_modality": "anat"},'
+        ' {"match": "(?i)rest", "bids_name": "task-rest_bold", "bids_modality": "func"}]'
+    )
+
+    rows, skipped = dicom_index.index_dicom_tree(
+        dicom_root, dicom_index.load_rules(rules_path), jobs=2
+    )
+
+    assert [(r["source"], r["bids_name"], r["bids_modality"], r["files"]) for r in rows] == [
+        (str(dicom_root / "study" / "a"), "T1w", "anat", 3),
+        (str(dicom_root / "study" / "b"), "task-rest_bold", "func", 2),
+    ]
+    assert {(r["nda_bids_subject"], r["bids_session"]) for r in rows} == {("sub-01", "ses-20240101")}
+    assert len(skipped) == 1 and "localizer" in skipped[0][1]
+
+    input_csv = tmp_path / "series.csv"
+    dicom_index.write_series_csv(rows, input_csv)
+    results, failures, report = dicom2targz.convert(
+        input_csv, tmp_path / "out", level=1, jobs=2, digest_store=None
+    )
+    assert failures == []
+    assert sorted(os.path.basename(r["output"]) for r in results) == [
+        "sub-01_ses-20240101_T1w_series-2.tar.gz",
+        "sub-01_ses-20240101_task-rest_bold_series-5.tar.gz",
+    ]
+    assert os.path.isfile(report)
+
+
+def test_rerun_skips_unchanged_series(series_csv, tmp_path):
+    output_dir = tmp_path / "out"
+    first, _, _ = dicom2targz.convert(series_csv, output_dir, level=1, jobs=2, digest_store=None)
+    assert {r["status"] for r in first} == {"archived"}
+    mtimes = {r["output"]: r["mtime_ns"] for r in first}
+
+    second, failures, _ = dicom2targz.convert(series_csv, output_dir, level=1, jobs=2, digest_store=None)
+    assert failures == []
+    assert {r["status"] for r in second} == {"up-to-date"}
+    assert {r["output"]: r["mtime_ns"] for r in second} == mtimes
+    assert {r["md5sum"] for r in second} == {r["md5sum"] for r in first}
+
+    # a new slice in one series archives that series only
+    (tmp_path / "dicoms" / "5-task-rest_bold" / "3.dcm").write_bytes(
+        (tmp_path / "dicoms" / "5-task-rest_bold" / "2.dcm").read_bytes()
+    )
+    third, _, _ = dicom2targz.convert(series_csv, output_dir, level=1, jobs=2, digest_store=None)
+    status = {os.path.basename(r["output"]): (r["status"], r["files"]) for r in third}
+    assert status == {
+        "sub-01_ses-01_T1w_series-2.tar.gz": ("up-to-date", 3),
+        "sub-01_ses-01_task-rest_bold_series-5.tar.gz": ("archived", 4),
+    }
+
+    forced, _, _ = dicom2targz.convert(
+        series_csv, output_dir, level=1, jobs=2, digest_store=None, force=True
+    )
+    assert {r["status"] for r in forced} == {"archived"}
+
+
+class FullDisk:
+    """An md5 whose update() fails like a write to a full disk."""
+
+    def update(self, chunk):
+        raise OSError(28, "No space left on device")
+
+
+@pytest.mark.parametrize("failure", ["tar exits non-zero", "writing fails"])
+def test_failed_archive_leaves_no_partial_file(tmp_path, monkeypatch, failure):
+    source = tmp_path / "series"
+    source.mkdir()
+    (source / "1.dcm").write_bytes(b"x" * 100)
+    output = tmp_path / "out" / "series.tar.gz"
+
+    if failure == "tar exits non-zero":
+        command = ["sh", "-c", "printf partial; exit 2"]
+        expected = dicom2targz.subprocess.CalledProcessError
+    else:
+        # never ends by itself: only killing it lets pack_directory return
+        command = ["yes"]
+        monkeypatch.setattr(dicom2targz.hashlib, "md5", FullDisk)
+        expected = OSError
+    monkeypatch.setattr(dicom2targz, "archive_command", lambda *args: command)
+
+    with pytest.raises(expected):
+        dicom2targz.pack_directory(str(source), str(output), str(tmp_path / "fingerprint"))
+    assert os.listdir(output.parent) == []
+    assert not (tmp_path / "fingerprint").exists()
+
+
+def test_manifest_after_conversion_lists_only_archives(series_csv, tmp_path):
+    from utilities.manifests import create_manifest
+
+    output_dir = tmp_path / "out"
+    results, _, _ = dicom2targz.convert(series_csv, output_dir, level=1, jobs=2, digest_store=None)
+    subject_dir = output_dir / "sourcedata" / "sub-01"
+    # bookkeeping stays outside the tree that is mapped, manifested and uploaded
+    assert not [p for p in (output_dir / "sourcedata").rglob("*") if p.name.startswith(".")]
+    paths = [entry["path"] for entry in create_manifest(str(subject_dir))["files"]]
+    assert sorted(paths) == sorted(
+        "./" + os.path.relpath(r["output"], subject_dir) for r in results
+    )
+    assert all(path.endswith(".tar.gz") for path in paths)
+
+
+def test_pack_parent_archives_small_file_leaves(tmp_path):
+    from utilities.packing import pack_parent
+
+    source = tmp_path / "source" / "sub-01" / "ses-01" / "dicom" / "series-2"
+    source.mkdir(parents=True)
+    for i in range(5):
+        (source / f"{i}.dcm").write_bytes(bytes([i]) * 100)
+
+    parent = tmp_path / "dest" / "image03_sourcedata.dicom.raw"
+    children = {}
+    for guid, n_files in (("NDARA", 5), ("NDARB", 2)):
+        child = parent / f"sub-{guid}_ses-01.sourcedata.dicom.raw"
+        leaf = child / "sub-01" / "ses-01" / "dicom" / "series-2"
+        leaf.mkdir(parents=True)
+        for i in range(n_files):
+            (leaf / f"{i}.dcm").symlink_to(source / f"{i}.dcm")
+        children[guid] = leaf
+
+    store_path = tmp_path / "digests.tsv"
+    results = pack_parent(parent, max_small_files=3, jobs=2, digest_store=str(store_path))
+
+    # only the child above the threshold is packed, through its symlinks
+    assert [(r["leaf"], r["status"], r["files"]) for r in results] == [
+        (str(children["NDARA"]), "archived", 5)
+    ]
+    output = str(children["NDARA"]) + ".tar.gz"
+    assert not children["NDARA"].exists() and children["NDARB"].is_dir()
+    with tarfile.open(output) as tar:
+        assert tar.extractfile("./4.dcm").read() == bytes([4]) * 100
+    assert sorted(p.name for p in source.iterdir()) == [f"{i}.dcm" for i in range(5)]
+    assert DigestStore(store_path).lookup(output) == md5_file(output)
+    assert not any(p.name.endswith(".fingerprint") for p in parent.rglob("*"))
+
+    # file mapping again recreates the leaf, which is unchanged
+    children["NDARA"].mkdir()
+    for i in range(5):
+        (children["NDARA"] / f"{i}.dcm").symlink_to(source / f"{i}.dcm")
+    again = pack_parent(parent, max_small_files=3, jobs=2, digest_store=str(store_path))
+    assert [r["status"] for r in again] == ["up-to-date"]
+    assert not children["NDARA"].exists()
+
+
+def test_pack_parent_leaves_symlinked_session_folders_alone(tmp_path):
+    """Leaves reached through a symlinked folder live in the source and must not be packed or removed."""
+    from utilities.packing import pack_parent
+
+    series = tmp_path / "src" / "sub-01" / "ses-1" / "dicom" / "series1"
+    series.mkdir(parents=True)
+    for i in range(5):
+        (series / f"{i}.dcm").write_bytes(bytes([i]) * 100)
+
+    parent = tmp_path / "dest" / "image03_sourcedata.dicom.raw"
+    child = parent / "sub-NDARA_ses-1.sourcedata.dicom.raw"
+    (child / "sub-01").mkdir(parents=True)
+    (child / "sub-01" / "ses-1").symlink_to(tmp_path / "src" / "sub-01" / "ses-1")
+
+    results = pack_parent(parent, max_small_files=3, jobs=1, digest_store=None)
+
+    assert results == []
+    assert sorted(p.name for p in series.iterdir()) == [f"{i}.dcm" for i in range(5)]
+    assert not (series.parent / "series1.tar.gz").exists()
+    assert (child / "sub-01" / "ses-1").is_symlink()
@@ -0,0 +1,86 @@
+"""Tests for the make-style pipeline runner."""
+
+import os
+
+from utilities.pipeline import BLOCKED, FAILED, RAN, UP_TO_DATE, Pipeline, Stage
+
+
+def _concatenate(output, *inputs):
+    with open(output, "a") as out:
+        for path in inputs:
+            with open(path) as f:
+                out.write(f.read())
+
+
+def _fail():
+    raise RuntimeError("broken stage")
+
+
+def test_pipeline_skips_stages_with_unchanged_inputs(tmp_path):
+    source = tmp_path / "source.txt"
+    source.write_text("a\n")
+    lookup, first, second = (str(tmp_path / name) for name in ("lookup", "first", "second"))
+
+    def stages():
+        return [
+            Stage("lookup", _concatenate, (lookup, str(source)), [source], [lookup]),
+            Stage("prepare:first", _concatenate, (first, lookup), [lookup], [first], ["lookup"]),
+            Stage("prepare:second", _concatenate, (second, lookup), [lookup], [second], ["lookup"]),
+        ]
+
+    pipeline = Pipeline(tmp_path, jobs=2)
+    assert pipeline.run(stages()) == {"lookup": RAN, "prepare:first": RAN, "prepare:second": RAN}
+    assert open(second).read() == "a\n"
+
+    # unchanged inputs: nothing runs, outputs are not appended to again
+    assert set(Pipeline(tmp_path, jobs=2).run(stages()).values()) == {UP_TO_DATE}
+    assert open(first).read() == "a\n"
+
+    # a missing output reruns only its stage
+    os.remove(first)
+    assert Pipeline(tmp_path, jobs=2).run(stages()) == {
+        "lookup": UP_TO_DATE,
+        "prepare:first": RAN,
+        "prepare:second": UP_TO_DATE,
+    }
+
+    # a changed input reruns everything downstream of it
+    source.write_text("b\n")
+    assert set(Pipeline(tmp_path, jobs=2).run(stages()).values()) == {RAN}
+    assert open(second).read() == "a\na\nb\n"
+
+
+def test_pipeline_failure_blocks_only_dependent_stages(tmp_path):
+    done = str(tmp_path / "done")
+    source = tmp_path / "source.txt"
+    source.write_text("a\n")
+    statuses = Pipeline(tmp_path).run(
+        [
+            Stage("broken", _fail),
+            Stage("after-broken", _concatenate, (done, str(source)), after=["broken"]),
+            Stage("independent", _concatenate, (done, str(source)), [source], [done]),
+        ]
+    )
+    assert statuses == {"broken": FAILED, "after-broken": BLOCKED, "independent": RAN}
+    assert not os.path.exists(tmp_path / ".pipeline" / "broken.stamp")
+
+
+def test_pipeline_reruns_stages_when_a_dataset_file_is_edited_in_place(tmp_path):
+    dataset = tmp_path / "bids"
+    sidecar = dataset / "sub-01" / "anat" / "sub-01_T1w.json"
+    sidecar.parent.mkdir(parents=True)
+    sidecar.write_text('{"RepetitionTime": 2}')
+    output = str(tmp_path / "records")
+
+    def stages():
+        return [Stage("prepare:anat", _concatenate, (output, str(sidecar)), [dataset], [output])]
+
+    assert Pipeline(tmp_path).run(stages()) == {"prepare:anat": RAN}
+    assert Pipeline(tmp_path).run(stages()) == {"prepare:anat": UP_TO_DATE}
+
+    # no file is added or removed, so no directory mtime changes
+    directory_mtimes = {d: os.stat(d).st_mtime_ns for d in (dataset, sidecar.parent)}
+    sidecar.write_text('{"RepetitionTime": 2.5}')
+    os.utime(sidecar, ns=(sidecar.stat().st_atime_ns, sidecar.stat().st_mtime_ns + 10**9))
+    assert {d: os.stat(d).st_mtime_ns for d in directory_mtimes} == directory_mtimes
+    assert Pipeline(tmp_path).run(stages()) == {"prepare:anat": RAN}
@@ -0,0 +1,92 @@
+"""Tests for sharded records, merging the shards and verifying them."""
+
+import os
+
+import pytest
+
+import records
+from utilities.batches import read_folders_txt, read_records_csv, write_folders_txt, write_records_csv
+from utilities.shards import in_shard, merge_shards, shard_paths
+
+
+def _prepare(destination):
+    """A file-mapped parent of 12 children and the lookup.csv and yaml records.py reads."""
+    parent = destination / "image03_sourcedata.anat.T1w"
+    lookup = ["subjectkey,src_subject_id,bids_subject_session,interview_age"]
+    for i in range(12):
+        child = parent / f"sub-NDAR{i:03d}_ses-1.sourcedata.anat.T1w"
+        child.mkdir(parents=True)
+        (child / "T1w.nii.gz").write_text(str(i))
+        lookup.append(f"NDAR{i:03d},sub-{i:02d},sub-{i:02d}_ses-1,{20 + i}")
+    (destination / "lookup.csv").write_text("\n".join(lookup) + "\n")
+    (destination / "image03_sourcedata.anat.T1w.yaml").write_text("scan_type: MR structural (T1)\n")
+    return str(parent)
+
+
+@pytest.fixture(autouse=True)
+def no_vtcmd(monkeypatch):
+    # without vtcmd installed, validation only prints an error
+    monkeypatch.setattr(records, "run_vtcmd_realtime", lambda csv_file, manifest_dir: True)
+
+
+def test_sharded_records_merge_like_a_single_run(tmp_path):
+    single = _prepare(tmp_path / "single")
+    records.cli(single, digest_store=str(tmp_path / "digests.tsv"))
+
+    sharded = _prepare(tmp_path / "sharded")
+    owners = {}
+    for index in range(3):
+        records.cli(sharded, digest_store=str(tmp_path / "digests.tsv"), shard=(index, 3))
+        for folder in read_folders_txt(f"{sharded}.shard_folders_{index}_3.txt"):
+            assert in_shard(folder, (index, 3))
+            owners.setdefault(folder, []).append(index)
+    assert len(owners) == 12 and all(len(o) == 1 for o in owners.values())
+    assert not (tmp_path / "sharded" / "image03_sourcedata.anat.T1w.complete_records.csv").exists()
+
+    assert merge_shards(sharded) == 12
+    _, header, merged = read_records_csv(sharded + ".complete_records.csv")
+    _, _, expected = read_records_csv(single + ".complete_records.csv")
+    assert sorted(merged, key=lambda r: r["subjectkey"]) == sorted(expected, key=lambda r: r["subjectkey"])
+    assert read_folders_txt(sharded + ".complete_folders.txt") == sorted(owners)
+    assert (tmp_path / "sharded" / "image03_sourcedata.anat.T1w.records_12_500_1.csv").is_file()
+
+    os.remove(f"{sharded}.shard_records_1_3.csv")
+    with pytest.raises(ValueError, match="1/3"):
+        merge_shards(sharded)
+
+
+def test_records_verify_reports_missing_and_duplicated_shard_rows(tmp_path, monkeypatch, capsys):
+    parent = _prepare(tmp_path)
+    for index in range(2):
+        records.cli(parent, digest_store=str(tmp_path / "digests.tsv"), shard=(index, 2))
+
+    def verify():
+        """Exit code and output of `nda-records verify <parent>`."""
+        monkeypatch.setattr("sys.argv", ["nda-records", "verify", parent])
+        try:
+            records.main()
+        except SystemExit as e:
+            return e.code, capsys.readouterr().out
+        return 0, capsys.readouterr().out
+
+    assert verify()[0] == 0
+
+    records_path, folders_path = shard_paths(os.path.realpath(parent), (0, 2))
+    ndaheader, header, rows = read_records_csv(records_path)
+    folders = read_folders_txt(folders_path)
+
+    # a record lost from shard 0
+    write_records_csv(records_path, ndaheader, header, rows[1:])
+    code, out = verify()
+    assert code == 1
+    assert f"Shard 0/2 of {os.path.realpath(parent)} has {len(rows) - 1} records but {len(folders)} folders" in out
+
+    # a folder of shard 1 listed by shard 0 as well
+    other = read_folders_txt(shard_paths(os.path.realpath(parent), (1, 2))[1])[0]
+    write_records_csv(records_path, ndaheader, header, rows + rows[:1])
+    write_folders_txt(folders_path, folders + [other])
+    code, out = verify()
+    assert code == 1
+    assert f"{other} of {os.path.realpath(parent)} is listed 2 times, by shards 0/2, 1/2" in out
+    with pytest.raises(ValueError, match="listed 2 times"):
+        merge_shards(parent)
@@ -0,0 +1,221 @@
+"""Tests for upload.py batch planning and the upload scheduler."""
+
+import json
+import os
+import threading
+from datetime import datetime, time
+
+import pytest
+
+import upload
+from utilities.claims import ClaimBoard
+from utilities.digests import DigestLedger
+from utilities.scheduler import BandwidthScheduler, parse_bandwidth, parse_schedule
+
+
+def _at(hour, minute=0):
+    """Epoch seconds for today at hour:minute local time."""
+    return datetime.now().replace(hour=hour, minute=minute, second=0, microsecond=0).timestamp()
+
+
+def test_parse_bandwidth():
+    assert parse_bandwidth("200") == 200
+    assert parse_bandwidth("1K") == 1024
+    assert parse_bandwidth("50MB") == 50 * 1024**2
+    assert parse_bandwidth("1.5g/s") == 1.5 * 1024**3
+    with pytest.raises(ValueError):
+        parse_bandwidth("fast")
+
+
+def test_parse_schedule():
+    windows, default = parse_schedule("20:00-06:00=100%,*=20%")
+    assert windows == [(time(20, 0), time(6, 0), 1.0)]
+    assert default == pytest.approx(0.2)
+    assert parse_schedule("") == ([], 1.0)
+    with pytest.raises(ValueError):
+        parse_schedule("20:00-06:00")
+
+
+def test_schedule_window_wraps_midnight():
+    scheduler = BandwidthScheduler(max_bandwidth=100, schedule="20:00-06:00=100%,*=20%")
+    assert scheduler.bandwidth_cap(_at(23)) == 100
+    assert scheduler.bandwidth_cap(_at(3)) == 100
+    assert scheduler.bandwidth_cap(_at(12)) == pytest.approx(20)
+
+
+def test_paused_window_blocks_new_batches():
+    scheduler = BandwidthScheduler(max_concurrent=4, schedule="08:00-18:00=0%")
+    assert not scheduler.may_start(0, now=_at(9))
+    assert scheduler.may_start(3, now=_at(19))
+    assert not scheduler.may_start(4, now=_at(19))
+
+
+def test_concurrency_follows_measured_throughput():
+    scheduler = BandwidthScheduler(max_bandwidth=100, max_concurrent=8)
+    # nothing measured yet: one batch at a time
+    assert scheduler.concurrency_limit(now=_at(12)) == 1
+    # batches move 20 bytes/s each, so five fit under the cap
+    scheduler.record(200, 10, now=_at(12))
+    assert scheduler.concurrency_limit(now=_at(12)) == 5
+
+
+def test_fast_batch_triggers_cooldown():
+    scheduler = BandwidthScheduler(max_bandwidth=100, max_concurrent=2)
+    now = _at(12)
+    # 1000 bytes in 2 s is 500 B/s; at 100 B/s it should have taken 10 s
+    scheduler.record(1000, 2, now=now)
+    assert not scheduler.may_start(0, now=now + 7)
+    assert scheduler.may_start(0, now=now + 8)
+
+
+def _prepared_parent(root, n_records, sizes=(10, 20)):
+    """Write a complete_records.csv, one batch and manifests like records.py does."""
+    parent = root / "image03_sourcedata.anat.T1w"
+    parent.mkdir()
+    lines = ['"image","03"\n', '"subjectkey"\n'] + [f'"NDAR{i}"\n' for i in range(n_records)]
+    (root / (parent.name + ".complete_records.csv")).write_text("".join(lines))
+    folders = []
+    for i in range(n_records):
+        child = parent / f"sub-NDAR{i}.sourcedata.anat.T1w"
+        child.mkdir()
+        files = [{"path": f"f{j}", "name": f"f{j}", "size": s} for j, s in enumerate(sizes)]
+        (child / f"sub-NDAR{i}.manifest.json").write_text(json.dumps({"files": files}))
+        folders.append(child.name)
+    (root / (parent.name + f".folders_{n_records}_500_1.txt")).write_text("\n".join(folders) + "\n")
+    return parent
+
+
+def test_parent_batches_and_bytes(tmp_path):
+    parent = _prepared_parent(tmp_path, 3)
+    batches = upload.parent_batches(str(parent))
+    assert len(batches) == 1
+    description, records_batch, folders_batch = batches[0]
+    assert description == "image03_sourcedata.anat.T1w.batch_3_500_1"
+    assert records_batch == str(parent) + ".records_3_500_1.csv"
+    assert upload.batch_bytes(str(parent), folders_batch) == 3 * 30
+
+
+def test_find_parents_and_order_jobs(tmp_path):
+    parent = _prepared_parent(tmp_path, 2)
+    (tmp_path / "image03_inputs.anat.T2w").mkdir()  # no complete records yet
+    assert upload.find_parents(str(tmp_path)) == [str(parent)]
+    # glob characters in the destination are taken literally: "release[1]"
+    # must not find the parents of "release1"
+    (tmp_path / "release1").mkdir()
+    _prepared_parent(tmp_path / "release1", 1)
+    (tmp_path / "release[1]").mkdir()
+    assert upload.find_parents(str(tmp_path / "release[1]")) == []
+
+    jobs = [
+        {"parent": "image03_inputs.anat.T1w", "nbytes": 10},
+        {"parent": "fmriresults01_derivatives.func.runs", "nbytes": 5},
+        {"parent": "image03_inputs.anat.T1w", "nbytes": 30},
+    ]
+    assert [j["nbytes"] for j in upload.order_jobs(jobs)] == [30, 10, 5]
+    ordered = upload.order_jobs(jobs, ["fmriresults01_*"])
+    assert [j["nbytes"] for j in ordered] == [5, 30, 10]
+
+
+def test_digest_ledger_round_trip(tmp_path):
+    ledger_path = tmp_path / "ledger" / "digests.tsv"
+    files = [{"md5sum": "aa", "size": 10}, {"md5sum": "bb", "size": 20}]
+    ledger = DigestLedger(ledger_path)
+    assert not ledger.folder_delivered(files, 1234)
+
+    ledger.add(files[:1], 1234, "batch_1")
+    assert not ledger.folder_delivered(files, 1234)
+    ledger.add(files, 1234, "batch_2")
+
+    reloaded = DigestLedger(ledger_path)
+    assert reloaded.folder_delivered(files, 1234)
+    # delivered to a different collection does not count
+    assert not reloaded.folder_delivered(files, 999)
+    # entries without checksums can never be deduplicated
+    assert not reloaded.folder_delivered([{"size": 10}], 1234)
+    assert len(ledger_path.read_text().splitlines()) == 2
+
+
+def test_write_batch_subset(tmp_path):
+    records = tmp_path / "p.records_3_500_1.csv"
+    records.write_text('"image","03"\n"subjectkey"\n"A"\n"B"\n"C"\n')
+    folders = tmp_path / "p.folders_3_500_1.txt"
+    folders.write_text("a\nb\nc\n")
+    subset_records, subset_folders = upload.write_batch_subset(str(records), str(folders), [0, 2])
+    assert open(subset_records).read() == '"image","03"\n"subjectkey"\n"A"\n"C"\n'
+    assert open(subset_folders).read() == "a\nc\n"
+
+
+def test_claims_between_workers(tmp_path):
+    batch = "/mnt/a/image03_inputs.anat.T1w.records_3_500_1.csv"
+    first = ClaimBoard(tmp_path, worker_id="host-a", lease_timeout=60)
+    second = ClaimBoard(tmp_path, worker_id="host-b", lease_timeout=60)
+
+    assert first.claim(batch)
+    assert first.holder(batch) == "host-a"
+    # same batch seen through a different mount point on the second host
+    assert not second.claim("/mnt/b/image03_inputs.anat.T1w.records_3_500_1.csv")
+
+    first.complete(batch)
+    assert second.is_done(batch)
+    assert not second.claim(batch)
+
+
+def test_expired_claim_is_taken_over(tmp_path):
+    batch = "image03_inputs.anat.T1w.records_3_500_1.csv"
+    crashed = ClaimBoard(tmp_path, worker_id="host-a", lease_timeout=60)
+    survivor = ClaimBoard(tmp_path, worker_id="host-b", lease_timeout=60)
+
+    assert crashed.claim(batch)
+    claim = tmp_path / (batch + ".claim")
+    stale = claim.stat().st_mtime - 120
+    os.utime(claim, (stale, stale))
+
+    assert survivor.claim(batch)
+    assert survivor.holder(batch) == "host-b"
+    # the crashed worker can no longer renew or release someone else's claim
+    crashed.release(batch)
+    assert survivor.holder(batch) == "host-b"
+    assert sorted(p.name for p in tmp_path.iterdir()) == [batch + ".claim"]
+
+
+def _job(tmp_path, batch):
+    return {
+        "cmd": "true",
+        "description": batch,
+        "records_batch": str(tmp_path / batch),
+        "nbytes": 0,
+        "files": [],
+        "collection_id": 1234,
+    }
+
+
+def test_run_batches_waits_for_claims_held_by_other_workers(tmp_path):
+    ledger_dir = tmp_path / "claims"
+    crashed = ClaimBoard(ledger_dir, worker_id="host-a", lease_timeout=0.3)
+    busy = ClaimBoard(ledger_dir, worker_id="host-b", lease_timeout=60)
+    worker = ClaimBoard(ledger_dir, worker_id="host-c", lease_timeout=0.3)
+    jobs = [_job(tmp_path, f"parent.records_3_500_{i}.csv") for i in (1, 2, 3)]
+
+    # host-a crashed holding batch 1, host-b is uploading batch 2 and finishes it
+    assert crashed.claim(jobs[0]["records_batch"])
+    assert busy.claim(jobs[1]["records_batch"])
+    timer = threading.Timer(0.2, busy.complete, [jobs[1]["records_batch"]])
+    timer.start()
+
+    upload_record = tmp_path / "uploaded_batches.upload"
+    failed = upload.run_batches(
+        jobs,
+        BandwidthScheduler(max_concurrent=1),
+        str(upload_record),
+        claims=worker,
+        poll_interval=0.05,
+    )
+    timer.join()
+
+    assert failed == []
+    # batch 3 right away, batch 1 once host-a's lease expired; host-b did batch 2
+    assert sorted(upload_record.read_text().split()) == sorted(
+        [jobs[0]["records_batch"], jobs[2]["records_batch"]]
+    )
+    assert all(worker.is_done(job["records_batch"]) for job in jobs)
+    assert not list(ledger_dir.glob("*.claim"))
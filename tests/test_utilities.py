@@ -1,8 +1,21 @@
+import asyncio
+import os
+import pstats
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+
 import pandas as pd
 import pytest
 from bids import BIDSLayout
+from math import floor
 from tempfile import TemporaryDirectory
+from utilities.aiofs import AsyncFS, parse_io_limit
 from utilities.lookup import LookUpTable
+from utilities.profiling import PROFILE_DIR, profiling, stage
+from utilities.verify_links import DANGLING, LOOP, OUTSIDE, verify_parent
 
 # Expected lookup table for bids-examples/pet002 (from running create_lookup_table).
 EXPECTED_PET002_LOOKUP = pd.DataFrame([
@@ -117,3 +130,434 @@ def test_write_lookup_table(bids_pet_fixture_fresh):
     assert "bids_subject_session" in content
     assert "interview_age" in content
     assert "sub-01" in content
+
+
+def test_layout_cache_reused_until_dataset_changes(bids_pet_fixture_fresh, tmp_path_factory, capsys):
+    """The pybids index is cached and only rebuilt when a directory mtime changes."""
+    cache = tmp_path_factory.mktemp("upload") / ".pybids_cache"
+    first = LookUpTable(str(bids_pet_fixture_fresh), layout_cache=cache)
+    n_files = len(first.bids_layout.get())
+    assert (cache / "layout_index.sqlite").exists()
+    assert "Indexing" in capsys.readouterr().out
+
+    second = LookUpTable(str(bids_pet_fixture_fresh), layout_cache=cache)
+    assert "Using cached BIDS index" in capsys.readouterr().out
+    assert len(second.bids_layout.get()) == n_files
+
+    (bids_pet_fixture_fresh / "sub-01" / "ses-baseline" / "anat" / "sub-01_ses-baseline_run-03_T1w.json").write_text("{}")
+    third = LookUpTable(str(bids_pet_fixture_fresh), layout_cache=cache)
+    assert "Indexing" in capsys.readouterr().out
+    assert len(third.bids_layout.get()) == n_files + 1
+
+
+def test_scandir_backend_matches_pybids(bids_pet_fixture):
+    """The scandir scanner yields the same lookup table and entities as pybids."""
+    from utilities.scanner import BIDSScanner, parse_filename
+
+    pybids_table = LookUpTable(str(bids_pet_fixture)).create_lookup_table()
+    scandir_table = LookUpTable(str(bids_pet_fixture), backend="scandir").create_lookup_table()
+    pd.testing.assert_frame_equal(pybids_table.reset_index(drop=True), scandir_table.reset_index(drop=True))
+
+    scanner = BIDSScanner(bids_pet_fixture)
+    layout = BIDSLayout(str(bids_pet_fixture))
+    assert scanner.get_subjects() == layout.get_subjects()
+    assert scanner.get_datatypes() == layout.get_datatypes()
+    assert sorted(f.relpath for f in scanner.get(subject="01", datatype="pet")) == sorted(
+        f.relpath for f in layout.get(subject="01", datatype="pet")
+    )
+    assert parse_filename("sub-01_ses-a_run-02_T1w.nii.gz") == {
+        "subject": "01", "session": "a", "run": "02", "suffix": "T1w", "extension": ".nii.gz"
+    }
+
+
+def _small_bids_dataset(root, subjects):
+    """A dataset with sessioned and sessionless subjects and a gender (not sex) column."""
+    (root / "dataset_description.json").write_text('{"Name": "small", "BIDSVersion": "1.8.0"}')
+    (root / "participants.tsv").write_text(
+        "participant_id\tage\tgender\nsub-01\t20.5\tF\nsub-02\t31\tM\n"
+    )
+    (root / "participants.json").write_text('{"age": {"Units": "years"}, "gender": {"Description": "sex"}}')
+    for subject, session, datatype, suffix in subjects:
+        folder = root / f"sub-{subject}"
+        name = f"sub-{subject}"
+        if session:
+            folder = folder / f"ses-{session}"
+            name += f"_ses-{session}"
+        (folder / datatype).mkdir(parents=True, exist_ok=True)
+        for extension in (".nii.gz", ".json"):
+            (folder / datatype / f"{name}_{suffix}{extension}").write_text("{}" if extension == ".json" else "")
+    return root
+
+
+def _per_subject_lookup_rows(bids_dataset):
+    """The rows of the per-subject loop create_lookup_table replaced, as a set."""
+    layout = BIDSLayout(str(bids_dataset))
+    participants = pd.read_csv(bids_dataset / "participants.tsv", sep="\t", index_col="participant_id")
+    participants = participants.rename(columns={"gender": "sex"})
+    rows = set()
+    for s in layout.get_subjects():
+        for entities in layout.get(subject=s):
+            ents = entities.get_entities()
+            bids_subject_session = "sub-" + ents.get("subject")
+            if ents.get("session"):
+                bids_subject_session += f'_ses-{ents.get("session")}'
+            if ents.get("datatype", ""):
+                rows.add((
+                    bids_subject_session,
+                    "",
+                    f"sub-{s}",
+                    "",
+                    floor(12 * float(participants["age"][f"sub-{s}"])),
+                    participants["sex"][f"sub-{s}"],
+                    ents.get("datatype", ""),
+                ))
+    return rows
+
+
+@pytest.mark.parametrize("backend", ["pybids", "scandir"])
+def test_create_lookup_table_matches_per_subject_loop(tmp_path, backend):
+    """The vectorized join yields the rows of the old per-subject loop, without empty _ses- suffixes."""
+    dataset = _small_bids_dataset(tmp_path, [
+        ("01", "1", "anat", "T1w"),
+        ("01", "2", "anat", "T1w"),
+        ("01", "2", "pet", "pet"),
+        ("02", None, "anat", "T1w"),
+    ])
+    table = LookUpTable(str(dataset), backend=backend).create_lookup_table()
+
+    assert list(table.columns) == [
+        "bids_subject_session", "subjectkey", "src_subject_id", "interview_date", "interview_age", "sex", "datatype"
+    ]
+    assert set(table.itertuples(index=False, name=None)) == _per_subject_lookup_rows(dataset)
+    assert len(table) == 4
+    assert sorted(table["bids_subject_session"].unique()) == ["sub-01_ses-1", "sub-01_ses-2", "sub-02"]
+    assert not table["bids_subject_session"].str.contains("_ses-$").any()
+    assert table.set_index("src_subject_id")["sex"].to_dict() == {"sub-01": "F", "sub-02": "M"}
+    assert table.set_index("src_subject_id")["interview_age"].to_dict() == {"sub-01": 246, "sub-02": 372}
+
+
+def test_create_lookup_table_subject_missing_from_participants(tmp_path):
+    """A subject folder without a participants.tsv row is a KeyError, as it was per subject."""
+    dataset = _small_bids_dataset(tmp_path, [("01", "1", "anat", "T1w"), ("03", "1", "anat", "T1w")])
+    with pytest.raises(KeyError):
+        LookUpTable(str(dataset), backend="scandir").create_lookup_table()
+
+
+def test_async_fs_bounds_operations_in_flight_per_filesystem(tmp_path):
+    """--io-limit parsing, and no more calls in flight per filesystem than its limit."""
+    assert parse_io_limit("8") == (None, 8)
+    assert parse_io_limit("/mnt/lustre=64") == ("/mnt/lustre", 64)
+    with pytest.raises(Exception):
+        parse_io_limit("=4")
+
+    lustre = tmp_path / "lustre"
+    in_flight = {"default": 0, "lustre": 0}
+    peak = dict(in_flight)
+    lock = threading.Lock()
+
+    def slow_stat(name, path):
+        with lock:
+            in_flight[name] += 1
+            peak[name] = max(peak[name], in_flight[name])
+        time.sleep(0.02)
+        with lock:
+            in_flight[name] -= 1
+        return path
+
+    with AsyncFS({None: 2, str(lustre): 5}) as fs:
+        assert fs.filesystem(lustre / "sub-01") == str(lustre)
+        assert fs.filesystem(tmp_path / "lustre2") is None
+
+        async def main():
+            calls = [fs.call(lustre / str(i), slow_stat, "lustre", i) for i in range(20)]
+            calls += [fs.call(tmp_path / str(i), slow_stat, "default", i) for i in range(20)]
+            return await asyncio.gather(*calls)
+
+        assert fs.run(main()) == list(range(20)) * 2
+    assert peak == {"default": 2, "lustre": 5}
+
+
+def test_verify_links_reports_dangling_outside_and_looping_links(tmp_path):
+    """Dangling, out-of-source and looping links are reported and listed in <parent>.broken_links.tsv."""
+    source = tmp_path / "bids" / "sub-01" / "anat"
+    source.mkdir(parents=True)
+    for name in ("a.nii.gz", "b.nii.gz"):
+        (source / name).write_text("data")
+    (tmp_path / "elsewhere.txt").write_text("data")
+    # a source reached through a symlinked folder still counts as inside
+    os.symlink(tmp_path / "bids", tmp_path / "bids-link")
+
+    parent = tmp_path / "image03_anat.T1w.nii"
+    child = parent / "sub-NDAR_ses-1.anat.T1w.nii" / "sub-01" / "anat"
+    child.mkdir(parents=True)
+    os.symlink(source / "a.nii.gz", child / "a.nii.gz")
+    os.symlink(tmp_path / "bids-link" / "sub-01" / "anat" / "b.nii.gz", child / "b.nii.gz")
+    os.symlink(os.path.relpath(source / "c.nii.gz", child), child / "c.nii.gz")
+    os.symlink(tmp_path / "elsewhere.txt", child / "elsewhere.txt")
+    os.symlink(child / "loop", child / "loop")
+
+    problems = verify_parent(parent, [tmp_path / "bids"], io_limits={None: 4})
+    assert {(os.path.basename(link), problem) for link, _, problem in problems} == {
+        ("c.nii.gz", DANGLING),
+        ("elsewhere.txt", OUTSIDE),
+        ("loop", LOOP),
+    }
+    report = str(parent) + ".broken_links.tsv"
+    assert len(open(report).read().splitlines()) == 4
+
+    for name in ("c.nii.gz", "elsewhere.txt", "loop"):
+        os.remove(child / name)
+    assert verify_parent(parent, [tmp_path / "bids"]) == []
+    assert not os.path.exists(report)
+
+
+def test_profiling_writes_stage_stats_memory_and_collapsed_stacks(tmp_path):
+    """--profile writes per-stage cProfile statistics, memory peaks and collapsed stacks, and nothing without it."""
+
+    def busy(seconds):
+        end = time.perf_counter() + seconds
+        while time.perf_counter() < end:
+            pass
+
+    # without --profile stages do nothing and nothing is written
+    with profiling(False, tmp_path, "prepare"):
+        with stage("records:image03_sourcedata.anat.T1w"):
+            busy(0.01)
+    assert not os.path.exists(tmp_path / PROFILE_DIR)
+
+    with profiling(True, tmp_path, "prepare", memory=True) as profiler:
+        busy(0.05)
+        with stage("records:image03_sourcedata.anat.T1w"):
+            blocks = [bytearray(1024) for _ in range(2048)]
+            busy(0.1)
+            del blocks
+
+    output_dir = profiler.output_dir
+    files = set(os.listdir(output_dir))
+    assert {
+        "prepare.pstats",
+        "records:image03_sourcedata.anat.T1w.pstats",
+        "records:image03_sourcedata.anat.T1w.txt",
+        "records:image03_sourcedata.anat.T1w.tracemalloc",
+        "stacks.collapsed",
+        "memory.tsv",
+    } <= files
+    stats = pstats.Stats(os.path.join(output_dir, "records:image03_sourcedata.anat.T1w.pstats"))
+    assert any(function == "busy" for _, _, function in stats.stats)
+
+    stacks = open(os.path.join(output_dir, "stacks.collapsed")).read().splitlines()
+    assert {line.split(";", 1)[0] for line in stacks} == {"prepare", "records:image03_sourcedata.anat.T1w"}
+    assert all(line.rsplit(" ", 1)[1].isdigit() for line in stacks)
+
+    peaks = dict(line.split("\t") for line in open(os.path.join(output_dir, "memory.tsv")).read().splitlines()[1:])
+    assert int(peaks["records:image03_sourcedata.anat.T1w"]) > 2 * 1024 * 1024
+    assert int(peaks["prepare"]) >= int(peaks["records:image03_sourcedata.anat.T1w"])
+    assert not tracemalloc.is_tracing()
+
+
+@pytest.mark.parametrize("script", ["delta", "dicom2targz", "dicom_index", "lookup", "mapping", "pipeline"])
+def test_utilities_run_as_scripts(script, tmp_path):
+    """`python utilities/<script>.py` works from any directory, not only as an nda-* entry point."""
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "utilities", script + ".py")
+    result = subprocess.run([sys.executable, path, "--help"], cwd=tmp_path, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.startswith("usage:")
+
+
+def test_cli_modules_import_without_heavy_dependencies():
+    """Importing the nda-* entry points does not load pandas, pybids or yaml."""
+    import subprocess
+    import sys
+    from pathlib import Path
+
+    code = (
+        "import sys, prepare, records, utilities.lookup, utilities.mapping, utilities.delta; "
+        "print(' '.join(m for m in ('pandas', 'bids', 'yaml', 'toga') if m in sys.modules))"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=Path(__file__).resolve().parent.parent,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert result.stdout.strip() == ""
+
+
+def test_update_lookup_table_keeps_edits_and_adds_new_subjects(bids_pet_fixture_fresh, capsys):
+    """--update scans only new or changed subjects and keeps entered GUIDs and dates."""
+    from utilities.lookup import update_lookup_table
+
+    out_path = bids_pet_fixture_fresh / "upload" / "lookup.csv"
+    out_path.parent.mkdir()
+    LookUpTable(str(bids_pet_fixture_fresh), destination_path=str(out_path), backend="scandir").write_lookup_table()
+    edited = pd.read_csv(out_path, dtype=str, keep_default_na=False)
+    edited.loc[edited["src_subject_id"] == "sub-01", ["subjectkey", "interview_date"]] = ["NDAR_INV01", "01/02/2020"]
+    edited.to_csv(out_path, index=False)
+
+    update_lookup_table(str(bids_pet_fixture_fresh), str(out_path), backend="scandir")
+    assert "is up to date" in capsys.readouterr().out
+    pd.testing.assert_frame_equal(pd.read_csv(out_path, dtype=str, keep_default_na=False), edited)
+
+    # a new session for sub-01 and a new subject sub-03
+    for sub, ses in (("01", "followup"), ("03", "baseline"), ("03", "rescan")):
+        for datatype, suffix in (("anat", "T1w"), ("pet", "pet")):
+            d = bids_pet_fixture_fresh / f"sub-{sub}" / f"ses-{ses}" / datatype
+            d.mkdir(parents=True)
+            (d / f"sub-{sub}_ses-{ses}_{suffix}.json").write_text("{}")
+    participants = pd.read_csv(bids_pet_fixture_fresh / "participants.tsv", sep="\t")
+    participants.loc[2] = ["sub-03", 160, 50, 30.0, "M"]
+    participants.to_csv(bids_pet_fixture_fresh / "participants.tsv", sep="\t", index=False)
+
+    update_lookup_table(str(bids_pet_fixture_fresh), str(out_path), backend="scandir")
+    assert "Scanning 2 new or changed subjects: 01, 03" in capsys.readouterr().out
+    updated = pd.read_csv(out_path, dtype=str, keep_default_na=False)
+    pd.testing.assert_frame_equal(updated.iloc[: len(edited)], edited)
+    added = updated.iloc[len(edited):]
+    assert set(added["bids_subject_session"]) == {"sub-01_ses-followup", "sub-03_ses-baseline", "sub-03_ses-rescan"}
+    assert set(added.loc[added["src_subject_id"] == "sub-01", "subjectkey"]) == {"NDAR_INV01"}
+    assert set(added.loc[added["src_subject_id"] == "sub-03", "interview_age"]) == {"360"}
+
+
+def test_attach_fills_guids_and_dates_and_reports(tmp_path):
+    """attach joins GUID exports and scans.tsv files into lookup.csv, reporting conflicts and unmatched rows."""
+    from utilities.lookup_attach import attach_tables
+
+    lookup_path = tmp_path / "lookup.csv"
+    pd.DataFrame(
+        {
+            "bids_subject_session": ["sub-01_ses-a", "sub-01_ses-b", "sub-02_ses-a", "sub-03_ses-a"],
+            "subjectkey": ["", "", "NDAR_OLD02", ""],
+            "src_subject_id": ["sub-01", "sub-01", "sub-02", "sub-03"],
+            "interview_date": ["", "", "", ""],
+        }
+    ).to_csv(lookup_path, index=False)
+    pd.DataFrame(
+        {"participant_id": ["sub-01", "sub-02", "sub-09"], "GUID": ["NDAR_INV01", "NDAR_INV02", "NDAR_INV09"]}
+    ).to_csv(tmp_path / "guids.tsv", sep="\t", index=False)
+    pd.DataFrame(
+        {"filename": ["anat/a.nii.gz", "pet/b.nii.gz"], "acq_time": ["2020-03-04T10:00:00", "2020-03-03T09:00:00"]}
+    ).to_csv(tmp_path / "sub-01_ses-b_scans.tsv", sep="\t", index=False)
+
+    filled, conflicts, unmatched = attach_tables(
+        lookup_path,
+        [tmp_path / "guids.tsv"],
+        keys=["src_subject_id=participant_id"],
+        columns=["subjectkey=GUID"],
+    )
+    assert filled == 2
+    assert conflicts[["src_subject_id", "lookup_value", "table_value"]].values.tolist() == [
+        ["sub-02", "NDAR_OLD02", "NDAR_INV02"]
+    ]
+    assert sorted(unmatched["src_subject_id"]) == ["sub-03", "sub-09"]
+
+    filled, conflicts, unmatched = attach_tables(
+        lookup_path, [tmp_path / "sub-01_ses-b_scans.tsv"], keys=["bids_subject_session"]
+    )
+    result = pd.read_csv(lookup_path, dtype=str, keep_default_na=False)
+    assert filled == 1 and conflicts.empty
+    assert result["subjectkey"].tolist() == ["NDAR_INV01", "NDAR_INV01", "NDAR_OLD02", ""]
+    assert result["interview_date"].tolist() == ["", "03/03/2020", "", ""]
+
+
+def test_lookup_pages_search_and_round_trip(tmp_path):
+    """The editor's paged model searches, pages and saves edits without touching other rows."""
+    from utilities.lookup_pages import LookupPages, load_lookup_csv, save_lookup_csv
+
+    csv_path = tmp_path / "lookup.csv"
+    pd.DataFrame(
+        {
+            "bids_subject_session": [f"sub-{i:04d}_ses-a" for i in range(120)],
+            "subjectkey": ["NDAR_X" if i % 2 else "" for i in range(120)],
+            "interview_age": [str(200 + i) for i in range(120)],
+        }
+    ).to_csv(csv_path, index=False)
+
+    pages = LookupPages(*load_lookup_csv(csv_path), page_size=50)
+    assert pages.page_count == 3
+    assert pages.go_to(7) == 2 and len(pages.visible()) == 20
+    assert pages.search("sub-0042") == 1 and pages.visible() == [42]
+    assert pages.search("subjectkey:") == 60
+    assert pages.search("interview_age:31") == 11  # 231 and 310-319
+
+    pages.set_value(42, "subjectkey", " NDAR_INV42 ")
+    assert pages.modified
+    save_lookup_csv(csv_path, pages.columns, pages.rows)
+    saved = pd.read_csv(csv_path, dtype=str, keep_default_na=False)
+    assert saved.loc[42, "subjectkey"] == "NDAR_INV42"
+    assert saved.loc[43, "subjectkey"] == "NDAR_X" and len(saved) == 120
+
+
+def test_mapping_templates_generalize_subject_session_and_run(bids_pet_fixture, tmp_path):
+    """Mapping keys carry {SUBJECT}/{SESSION} (and optionally {RUN}); prepare expands {RUN} again."""
+    import json
+    from prepare import expand_run_placeholders, subject_session_labels
+    from utilities.mapping import MappingTemplator, generalize_path
+
+    assert generalize_path("sub-01/ses-a/anat/sub-01_ses-a_acq-sub-x_run-02_T1w.json", ("sub", "ses", "run")) == (
+        "sub-{SUBJECT}/ses-{SESSION}/anat/sub-{SUBJECT}_ses-{SESSION}_acq-sub-x_run-{RUN}_T1w.json"
+    )
+
+    MappingTemplator(bids_pet_fixture, tmp_path / "sessions", backend="scandir")
+    pet = json.loads((tmp_path / "sessions" / "image03_sourcedata.pet.pet.json").read_text())
+    assert pet == {
+        f"sub-{{SUBJECT}}/ses-{{SESSION}}/pet/sub-{{SUBJECT}}_ses-{{SESSION}}_run-0{run}_pet.json":
+        f"sub-{{GUID}}/ses-{{SESSION}}/pet/sub-{{GUID}}_ses-{{SESSION}}_run-0{run}_pet.json"
+        for run in (1, 2)
+    }
+
+    MappingTemplator(bids_pet_fixture, tmp_path / "runs", backend="scandir", generalize_runs=True)
+    anat = json.loads((tmp_path / "runs" / "image03_sourcedata.anat.anat.json").read_text())
+    assert list(anat) == ["sub-{SUBJECT}/ses-{SESSION}/anat/sub-{SUBJECT}_ses-{SESSION}_run-{RUN}_T1w.json"]
+    assert expand_run_placeholders(anat, str(bids_pet_fixture), "01", "rescan") == {
+        f"sub-{{SUBJECT}}/ses-{{SESSION}}/anat/sub-{{SUBJECT}}_ses-{{SESSION}}_run-0{run}_T1w.json":
+        f"sub-{{GUID}}/ses-{{SESSION}}/anat/sub-{{GUID}}_ses-{{SESSION}}_run-0{run}_T1w.json"
+        for run in (1, 2)
+    }
+
+    # labels that start with letters of "sub-"/"ses-" keep them
+    assert subject_session_labels("sub-01_ses-rescan") == ("01", "rescan")
+    assert subject_session_labels("sub-s01_ses-screening") == ("s01", "screening")
+    assert subject_session_labels("sub-bert") == ("bert", None)
+    anat_dir = tmp_path / "screening" / "sub-s01" / "ses-screening" / "anat"
+    anat_dir.mkdir(parents=True)
+    (anat_dir / "sub-s01_ses-screening_run-01_T1w.json").write_text("{}")
+    subject, session = subject_session_labels("sub-s01_ses-screening")
+    assert list(expand_run_placeholders(anat, str(tmp_path / "screening"), subject, session)) == [
+        "sub-{SUBJECT}/ses-{SESSION}/anat/sub-{SUBJECT}_ses-{SESSION}_run-01_T1w.json"
+    ]
+
+
+def test_mapping_coverage_counts_and_splits_rare_keys(bids_pet_fixture, tmp_path):
+    """coverage counts subject/sessions per key, flags unmatched keys and splits rare ones out."""
+    import json
+    from utilities.mapping_coverage import mapping_coverage, split_mapping
+    from utilities.scanner import BIDSScanner
+
+    (tmp_path / "extra").mkdir()
+    mapping = tmp_path / "image03_sourcedata.anat.anat.json"
+    keys = {
+        "sub-{SUBJECT}/ses-{SESSION}/anat/sub-{SUBJECT}_ses-{SESSION}_run-01_T1w.json": "a",
+        "sub-{SUBJECT}/ses-baseline/anat/sub-{SUBJECT}_ses-baseline_run-{RUN}_T1w.json": "b",
+        "sub-01/ses-rescan/pet/sub-01_ses-rescan_run-02_pet.json": "c",
+        "sub-{SUBJECT}/ses-{SESSION}/anat/sub-{SUBJECT}_ses-{SESSION}_T2w.nii.gz": "d",
+        "dataset_description.json": "e",
+    }
+    mapping.write_text(json.dumps(keys))
+    (tmp_path / "image03_sourcedata.anat.anat.yaml").write_text("image_modality: MRI\n")
+
+    rows = mapping_coverage(BIDSScanner(bids_pet_fixture), [mapping])
+    assert [(hits, fraction) for _, _, hits, _, fraction in rows] == [(4, 1.0), (2, 0.5), (1, 0.25), (0, 0.0), (1, 1.0)]
+
+    rare = split_mapping(mapping, [rows[2][1]], [rows[3][1]])
+    assert rare.name == "image03_sourcedata.anat.anatrare.json"
+    assert rare.with_suffix(".yaml").read_text() == "image_modality: MRI\n"
+    assert list(json.loads(rare.read_text())) == [rows[2][1]]
+    assert len(json.loads(mapping.read_text())) == 3
+
+    # a second split adds to the rare mapping instead of replacing it
+    rare.with_suffix(".yaml").write_text("image_modality: PET\n")
+    assert split_mapping(mapping, [rows[1][1]], []) == rare
+    assert list(json.loads(rare.read_text())) == [rows[2][1], rows[1][1]]
+    assert len(json.loads(mapping.read_text())) == 2
+    assert rare.with_suffix(".yaml").read_text() == "image_modality: PET\n"
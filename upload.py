@@ -8,12 +8,21 @@ Modified 03/18/2020  Eric Earl (earl@ohsu.edu)
 """
 
 import argparse
+import csv
 import math
 import os
 import subprocess
 import sys
+import time
 
-from glob import glob
+from datetime import datetime
+from fnmatch import fnmatch
+from glob import escape, glob
+
+from utilities.claims import DEFAULT_LEASE_TIMEOUT, ClaimBoard
+from utilities.digests import DEFAULT_LEDGER, DigestLedger, load_manifest_files
+from utilities.profiling import add_profile_arguments, profiling, stage
+from utilities.scheduler import BandwidthScheduler, parse_bandwidth
 
 __doc__ = """
 This python command-line tool allows the user a more
@@ -34,7 +43,8 @@ def generate_parser():
         required=True,
         help=("The collection ID that files are being uploaded to."),
     )
-    parser.add_argument(
+    targets = parser.add_mutually_exclusive_group(required=True)
+    targets.add_argument(
         "-s",
         "--source",
         "-p",
@@ -42,7 +52,6 @@ def generate_parser():
         dest="source",
         metavar="SOURCE_DIR",
         type=str,
-        required=True,
         help=(
             "Path to the folder that were prepared for upload. "
             'Folder should be of the format: ".../ndastructure_type.class.subset" '
@@ -56,6 +65,31 @@ def generate_parser():
             ".../imagingcollection01_inputs.anat.T1w/sub-NDARABC123_ses-baseline.inputs.anat.T1w"
         ),
     )
+    targets.add_argument(
+        "-d",
+        "--destination",
+        dest="destination",
+        metavar="DESTINATION_DIR",
+        type=str,
+        help=(
+            "Path to a prepared destination directory.  Every parent with a "
+            '".complete_records.csv" is uploaded from one global queue, tracked '
+            'in a single "uploaded_batches.upload" ledger in the destination, '
+            "so the whole release resumes with the same command."
+        ),
+    )
+    parser.add_argument(
+        "--priority",
+        dest="priority",
+        metavar="PATTERN",
+        action="append",
+        default=[],
+        help=(
+            "With --destination, upload parents whose names match this glob "
+            "pattern first.  May be repeated; earlier patterns go first.  "
+            "Within the same priority, the largest batches go first."
+        ),
+    )
     parser.add_argument(
         "-vt",
         "--ndavtcmd",
@@ -67,21 +101,119 @@ def generate_parser():
             "Path to the vtcmd located in the virtual environment being used for the upload."
         ),
     )
+    parser.add_argument(
+        "--max-bandwidth",
+        dest="max_bandwidth",
+        metavar="RATE",
+        type=parse_bandwidth,
+        default=None,
+        help=(
+            "Aggregate bandwidth cap per second, e.g. 50MB or 1G.  Batches are "
+            "started and run concurrently so the measured throughput stays under this cap."
+        ),
+    )
+    parser.add_argument(
+        "--max-concurrent",
+        dest="max_concurrent",
+        metavar="N",
+        type=int,
+        default=1,
+        help=("Maximum number of vtcmd batches to run at once.  Default: 1."),
+    )
+    parser.add_argument(
+        "--schedule",
+        dest="schedule",
+        metavar="WINDOWS",
+        type=str,
+        default="",
+        help=(
+            "Time windows scaling the bandwidth cap (or the concurrency if no cap "
+            'is given), e.g. "20:00-06:00=100%%,*=20%%" for full speed overnight '
+            "and 20%% otherwise.  A window at 0%% pauses new batches."
+        ),
+    )
+    parser.add_argument(
+        "--delta",
+        dest="delta",
+        action="store_true",
+        default=False,
+        help=(
+            "Upload the delta batches written by nda-delta (only child folders "
+            "new or changed since the previous release) instead of the complete batches."
+        ),
+    )
+    parser.add_argument(
+        "--shared-ledger",
+        dest="shared_ledger",
+        metavar="DIR",
+        type=str,
+        default=None,
+        help=(
+            "Directory on a filesystem shared by several upload hosts.  Workers "
+            "pointed at the same directory claim batches through lock files in it, "
+            "so each batch is uploaded by exactly one worker."
+        ),
+    )
+    parser.add_argument(
+        "--worker-id",
+        dest="worker_id",
+        metavar="ID",
+        type=str,
+        default=None,
+        help=("Name of this worker in the shared ledger.  Default: <hostname>-<pid>."),
+    )
+    parser.add_argument(
+        "--lease-timeout",
+        dest="lease_timeout",
+        metavar="SECONDS",
+        type=int,
+        default=DEFAULT_LEASE_TIMEOUT,
+        help=(
+            "Seconds without renewal after which another worker may take over a "
+            "claimed batch, e.g. from a crashed host.  Default: "
+            + str(DEFAULT_LEASE_TIMEOUT)
+            + "."
+        ),
+    )
+    parser.add_argument(
+        "--digest-ledger",
+        dest="digest_ledger",
+        metavar="LEDGER",
+        type=str,
+        default=DEFAULT_LEDGER,
+        help=(
+            "Tab-separated ledger of manifest checksums already delivered, shared "
+            "across parents and releases.  Default: " + DEFAULT_LEDGER.replace("%", "%%")
+        ),
+    )
+    parser.add_argument(
+        "--skip-delivered",
+        dest="skip_delivered",
+        action="store_true",
+        default=False,
+        help=(
+            "Leave out records whose files were all already delivered to this "
+            "collection according to the digest ledger.  Without this flag they "
+            "are only reported."
+        ),
+    )
+    add_profile_arguments(parser, "DESTINATION_DIR (or the folder holding SOURCE_DIR)")
     return parser
 
 
-def input_checks():
+def find_parents(destination):
+    """Return every prepared parent (one with a .complete_records.csv) in a destination."""
 
-    # command line interface parse
-    parser = generate_parser()
-    args = parser.parse_args()
+    suffix = ".complete_records.csv"
+    parents = []
+    for complete_csv in sorted(glob(os.path.join(escape(destination), "*" + suffix))):
+        parent = complete_csv[: -len(suffix)]
+        if os.path.isdir(parent):
+            parents.append(parent)
+    return parents
 
-    # check if args.source is a directory
-    if not os.path.isdir(args.source):
-        print(args.source + " is not a directory!  Exiting...")
-        sys.exit(1)
-    else:
-        source = os.path.abspath(os.path.realpath(args.source))
+
+def parent_checks(source):
 
     basename = os.path.basename(source)
     nda_struct, file_config = basename.split("_", 1)
@@ -124,45 +256,84 @@ def input_checks():
         sys.exit(5)
 
     problem_child_flag = False
-
-    for root, dirs, files in os.walk(source):
-        if root == source:
-            for directory in dirs:
-                if not directory.startswith("sub-NDAR"):
-                    problem_child_flag = True
-                    print(
-                        "Improper child folder name: "
-                        + directory
-                        + '.  Child directories MUST start with "sub-NDAR".  Exiting after full check...'
-                    )
-                else:
-                    sub_ses, sub_directory_config = directory.split(".", 1)
-                    if sub_directory_config != file_config:
-                        problem_child_flag = True
-                        print(
-                            "Improper child folder name.  Sections X.Y.Z MUST match between parent and child folders.  Exiting after full check..."
-                        )
+    is_bids_toplevel = basename == "image03_sourcedata.bids.toplevel"
+
+    # only the immediate children matter, no need to walk the whole tree
+    for entry in os.scandir(source):
+        if not entry.is_dir():
+            continue
+        directory = entry.name
+        if is_bids_toplevel and directory == "toplevel.sourcedata.bids.toplevel":
+            continue
+        if not directory.startswith("sub-NDAR"):
+            problem_child_flag = True
+            print(
+                "Improper child folder name: "
+                + directory
+                + '.  Child directories MUST start with "sub-NDAR".  Exiting after full check...'
+            )
+        else:
+            sub_ses, sub_directory_config = directory.split(".", 1)
+            if sub_directory_config != file_config:
+                problem_child_flag = True
+                print(
+                    "Improper child folder name.  Sections X.Y.Z MUST match between parent and child folders.  Exiting after full check..."
+                )
 
     if problem_child_flag:
         sys.exit(6)
 
-    if not os.path.isfile(args.vtcmd):
-        print(args.vtcmd + " is not a file!  Exiting...")
-        sys.exit(7)
-
 
-def nda_vt():
+def input_checks():
 
     # command line interface parse
     parser = generate_parser()
     args = parser.parse_args()
 
-    source = os.path.abspath(args.source)
-    basename = os.path.basename(source)
+    if args.destination:
+        if not os.path.isdir(args.destination):
+            print(args.destination + " is not a directory!  Exiting...")
+            sys.exit(1)
+        parents = find_parents(os.path.abspath(os.path.realpath(args.destination)))
+        if not parents:
+            print(
+                "No prepared parents (*.complete_records.csv) found in "
+                + args.destination
+                + ".  Exiting..."
+            )
+            sys.exit(1)
+    # check if args.source is a directory
+    elif not os.path.isdir(args.source):
+        print(args.source + " is not a directory!  Exiting...")
+        sys.exit(1)
+    else:
+        parents = [os.path.abspath(os.path.realpath(args.source))]
+
+    for source in parents:
+        parent_checks(source)
+
+    if not os.path.isfile(args.vtcmd):
+        print(args.vtcmd + " is not a file!  Exiting...")
+        sys.exit(7)
+
 
+def parent_batches(source, delta=False):
+    """
+    Return the (description, records_batch, folders_batch) triples records.py
+    wrote for a parent, or the delta batches utilities/delta.py wrote when delta is set.
+    """
+
+    basename = os.path.basename(source)
     ndastructure, data_subset = basename.split("_", 1)
-    complete_csv = source + ".complete_records.csv"
-    glob_string = os.path.join(source, "*." + data_subset)
+    if delta:
+        complete_csv = source + ".delta_records.csv"
+        prefix = "delta_"
+        if not os.path.isfile(complete_csv):
+            print("No delta records for " + basename + ", run nda-delta first.  Skipping...")
+            return []
+    else:
+        complete_csv = source + ".complete_records.csv"
+        prefix = ""
 
     with open(complete_csv) as f:
         all_records = f.readlines()
@@ -172,67 +343,356 @@ def nda_vt():
         len(all_records) - 2
     )  # minus two because of two header lines in the complete records file
     count = int(math.ceil(float(total) / max_batch_size))
-    upload_record = source + ".uploaded_" + data_subset + ".upload"
 
-    with open(upload_record, "a+") as upload_file:
-        file_list = [line.rstrip() for line in upload_file]
+    batches = []
+    for i in range(1, count + 1):
+        batchname = prefix + "_".join([str(total), str(max_batch_size), str(i)])
+
+        description = basename + ".batch_" + batchname
+        records_batch = source + ".records_" + batchname + ".csv"
+        folders_batch = source + ".folders_" + batchname + ".txt"
+        batches.append((description, records_batch, folders_batch))
+
+    return batches
+
+
+def read_folders(folders_batch):
+    """Return the child folder names listed in a folders batch file."""
+
+    with open(folders_batch) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def folder_bytes(folder_path, files=None):
+    """
+    Bytes a prepared folder will send, from its manifest entries when given,
+    otherwise by stat-ing the files under it.
+    """
+
+    if files is not None:
+        return sum(int(entry.get("size", 0)) for entry in files)
+
+    total = 0
+    for root, dirs, filenames in os.walk(folder_path, followlinks=True):
+        for filename in filenames:
+            try:
+                total += os.stat(os.path.join(root, filename)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def batch_bytes(source, folders_batch):
+    """Estimate the bytes a batch will send from the manifests of its folders."""
+
+    total = 0
+    for folder in read_folders(folders_batch):
+        folder_path = os.path.join(source, folder)
+        total += folder_bytes(folder_path, load_manifest_files(folder_path))
+    return total
+
+
+def write_batch_subset(records_batch, folders_batch, keep):
+    """
+    Write copies of a records/folders batch pair holding only the rows at the
+    indices in keep, and return their paths.
+    """
+
+    with open(records_batch, newline="") as f:
+        rows = list(csv.reader(f))
+    folders = read_folders(folders_batch)
+
+    subset_records = records_batch[: -len(".csv")] + ".pending.csv"
+    subset_folders = folders_batch[: -len(".txt")] + ".pending.txt"
+
+    with open(subset_records, "w", newline="") as f:
+        writer = csv.writer(f, quoting=csv.QUOTE_ALL)
+        # two header lines: the NDA structure line and the column names
+        writer.writerows(rows[:2])
+        writer.writerows(rows[2 + i] for i in keep)
+
+    with open(subset_folders, "w") as f:
+        for i in keep:
+            f.write(folders[i] + "\n")
+
+    return subset_records, subset_folders
+
+
+def vtcmd_command(vtcmd, collection_id, source, description, records_batch, folders_batch):
+    """
+    this is the most important command, vtcmd is a direct input for nda tools upload command
+    records batch is at most 500 records to be uploaded at once, this had to do with the stability an upload (may be fixed)
+    but realistically if it works chill out.
+
+    Note: you need to login with the nda tool/file in home directory to enable auto login (~/.nda)
+
+    -c collection id (this is pre-assigned and you will need to have access to it)
+    -m root folder containg data to upload (working_directory in this repo/codebase)
+    -t title (name of the json and yaml ) image03_sourcedata....
+    -d also name of the json and yaml image03_sourcedata... (will find out)
+    -l points to a batch file of folder e.g. working_directory/image03_sourcedata.pet.pet.complete_folders.txt that contains
+       all folders that have a manifest.json file and will be uploaded to the collection
+    -b batch (NDA's definition)
+    """
+    return (
+        vtcmd
+        + " "
+        + records_batch
+        + " -c "
+        + str(collection_id)
+        + " -m "
+        + source
+        + " -t "
+        + description
+        + " -d "
+        + description
+        + " -l `cat "
+        + folders_batch
+        + "` "
+        + " -b"
+    )
 
-        for i in range(1, count + 1):
-            batchname = "_".join([str(total), str(max_batch_size), str(i)])
 
-            description = basename + ".batch_" + batchname
-            records_batch = source + ".records_" + batchname + ".csv"
-            folders_batch = source + ".folders_" + batchname + ".txt"
+def run_batches(jobs, scheduler, upload_record, ledger=None, claims=None, poll_interval=5):
+    """
+    Run upload jobs through the scheduler.  Each job is a dict with "cmd",
+    "description", "records_batch" and "nbytes".  Successful batches are
+    appended to upload_record as they finish, and their manifest digests
+    to the digest ledger when one is given.  With a claim board, a batch
+    is only started once this worker holds its claim; batches claimed by
+    other workers are polled until they are done there, or until their
+    claim is released or expires and this worker takes them over.
+    """
+
+    pending = list(jobs)
+    running = []
+    failed = []
+    # batches reported as held by other workers, to only report changes
+    waiting_on = set()
+
+    with open(upload_record, "a") as upload_file:
+        while pending or running:
+            for job in list(running):
+                returncode = job["process"].poll()
+                if returncode is None:
+                    continue
+                running.remove(job)
+                if job["log"] is not None:
+                    job["log"].close()
+                elapsed = time.time() - job["started"]
+                scheduler.record(job["nbytes"], elapsed)
+                if returncode == 0:
+                    upload_file.write(job["records_batch"] + "\n")
+                    upload_file.flush()
+                    if claims is not None:
+                        claims.complete(job["records_batch"])
+                    if ledger is not None:
+                        ledger.add(job["files"], job["collection_id"], job["description"])
+                    print(
+                        f"{datetime.now()} Finished: {job['description']} "
+                        f"({job['nbytes']} bytes in {elapsed:.0f}s)"
+                    )
+                else:
+                    failed.append(job)
+                    if claims is not None:
+                        claims.release(job["records_batch"])
+                    print(
+                        f"{datetime.now()} FAILED (exit {returncode}): {job['description']}"
+                    )
 
-            if records_batch in file_list:
-                print(
-                    "WARNING: "
-                    + records_batch
-                    + " appears in "
-                    + upload_file
-                    + " so may already have been uploaded to the NDA."
+            held = []
+            while pending and scheduler.may_start(len(running)):
+                job = pending.pop(0)
+                if claims is not None and not claims.claim(job["records_batch"]):
+                    # done or being uploaded by another worker, look again later
+                    if not claims.is_done(job["records_batch"]):
+                        held.append(job)
+                    continue
+                print(f"{datetime.now()} Uploading: {job['description']}")
+                print(job["cmd"])
+                if scheduler.max_concurrent > 1:
+                    # keep concurrent vtcmd output apart, one log per batch
+                    job["log"] = open(job["records_batch"] + ".log", "w")
+                else:
+                    job["log"] = None
+                job["started"] = time.time()
+                job["process"] = subprocess.Popen(
+                    job["cmd"], shell=True, stdout=job["log"], stderr=job["log"]
                 )
-                continue
+                running.append(job)
+            pending.extend(held)
+
+            if claims is not None:
+                for job in running:
+                    claims.renew(job["records_batch"])
+                held_batches = {job["records_batch"] for job in held}
+                if held and not running and len(held) == len(pending) and held_batches != waiting_on:
+                    print(
+                        f"{datetime.now()} Waiting for {len(held)} batch(es) claimed by other "
+                        "workers to finish or for their claims to expire:"
+                    )
+                    for job in held:
+                        print(f"  {job['description']} (claimed by {claims.holder(job['records_batch'])})")
+                waiting_on = held_batches
+
+            if pending or running:
+                time.sleep(poll_interval)
+
+    return failed
+
+
+def read_upload_record(upload_record):
+    """Return the set of records batches already listed in an upload record."""
+
+    if not os.path.isfile(upload_record):
+        return set()
+    with open(upload_record) as f:
+        return set(line.rstrip() for line in f)
+
 
-            subprocess.call(("echo `date` Uploading: " + description), shell=True)
-            """
-            this is the most important command, args.vtcmd is a direct input for nda tools upload command
-            records batch is at most 500 records to be uploaded at once, this had to do with the stability an upload (may be fixed)
-            but realistically if it works chill out.
-
-            Note: you need to login with the nda tool/file in home directory to enable auto login (~/.nda) 
-
-            -c collection id (this is pre-assigned and you will need to have access to it)
-            -m root folder containg data to upload (working_directory in this repo/codebase)
-            -t title (name of the json and yaml ) image03_sourcedata....
-            -d also name of the json and yaml image03_sourcedata... (will find out)
-            -l points to a batch file of folder e.g. working_directory/image03_sourcedata.pet.pet.complete_folders.txt that contains 
-               all folders that have a manifest.json file and will be uploaded to the collection
-            -b batch (NDA's definition) 
-            """
-            cmd = (
-                args.vtcmd
-                + " "
+def parent_jobs(args, source, already_uploaded, ledger):
+    """
+    Build the upload jobs for one parent, skipping batches already in an
+    upload record.  Records whose files are all in the digest ledger for this
+    collection are reported, and left out of the batch with --skip-delivered.
+    """
+
+    jobs = []
+    for description, records_batch, folders_batch in parent_batches(source, args.delta):
+        if records_batch in already_uploaded:
+            print(
+                "WARNING: "
                 + records_batch
-                + " -c "
-                + str(args.collection_id)
-                + " -m "
-                + source
-                + " -t "
-                + description
-                + " -d "
-                + description
-                + " -l `cat "
-                + folders_batch
-                + "` "
-                + " -b"
+                + " appears in an upload record so may already have been uploaded to the NDA."
+            )
+            continue
+
+        folders = read_folders(folders_batch)
+        manifests = [load_manifest_files(os.path.join(source, f)) for f in folders]
+        keep = [
+            i
+            for i, files in enumerate(manifests)
+            if not ledger.folder_delivered(files, args.collection_id)
+        ]
+        delivered = len(folders) - len(keep)
+
+        if delivered:
+            kept = set(keep)
+            delivered_bytes = sum(
+                folder_bytes(None, manifests[i])
+                for i in range(len(folders))
+                if i not in kept
+            )
+            print(
+                f"{description}: {delivered} of {len(folders)} records already "
+                f"delivered to collection {args.collection_id} ({delivered_bytes} bytes)."
+            )
+
+        if args.skip_delivered and delivered:
+            if not keep:
+                print("Skipping " + description + ", every record was already delivered.")
+                continue
+            send_records, send_folders = write_batch_subset(
+                records_batch, folders_batch, keep
             )
+        else:
+            keep = list(range(len(folders)))
+            send_records, send_folders = records_batch, folders_batch
+
+        jobs.append(
+            {
+                "cmd": vtcmd_command(
+                    args.vtcmd,
+                    args.collection_id,
+                    source,
+                    description,
+                    send_records,
+                    send_folders,
+                ),
+                "collection_id": args.collection_id,
+                "description": description,
+                "parent": os.path.basename(source),
+                "records_batch": records_batch,
+                "nbytes": sum(
+                    folder_bytes(os.path.join(source, folders[i]), manifests[i])
+                    for i in keep
+                ),
+                "files": [
+                    entry for i in keep if manifests[i] for entry in manifests[i]
+                ],
+            }
+        )
+    return jobs
+
 
-            subprocess.call(("echo " + cmd), shell=True)
-            subprocess.call(cmd, shell=True)
-            upload_file.write(records_batch + "\n")
+def order_jobs(jobs, priority=()):
+    """
+    Order jobs by priority pattern (earlier patterns first, unmatched last),
+    then largest batch first so long uploads start early and small ones fill in.
+    """
+
+    def rank(job):
+        for i, pattern in enumerate(priority):
+            if fnmatch(job["parent"], pattern):
+                return i
+        return len(priority)
+
+    return sorted(jobs, key=lambda job: (rank(job), -job["nbytes"]))
+
+
+def nda_vt():
+
+    # command line interface parse
+    parser = generate_parser()
+    args = parser.parse_args()
+
+    if args.destination:
+        destination = os.path.abspath(args.destination)
+        parents = find_parents(destination)
+        upload_record = os.path.join(destination, "uploaded_batches.upload")
+    else:
+        source = os.path.abspath(args.source)
+        parents = [source]
+        ndastructure, data_subset = os.path.basename(source).split("_", 1)
+        upload_record = source + ".uploaded_" + data_subset + ".upload"
+
+    profile_dir = destination if args.destination else os.path.dirname(source)
+    with profiling(args.profile, profile_dir, "upload", args.profile_memory):
+        claims = None
+        if args.shared_ledger:
+            claims = ClaimBoard(args.shared_ledger, args.worker_id, args.lease_timeout)
+            # each worker keeps its own record, appends from several hosts could interleave
+            upload_record = os.path.join(args.shared_ledger, claims.worker_id + ".upload")
+
+        ledger = DigestLedger(args.digest_ledger)
+        with stage("queue"):
+            jobs = []
+            for source in parents:
+                ndastructure, data_subset = os.path.basename(source).split("_", 1)
+                # batches in either the per-parent record or the destination ledger are done
+                done = read_upload_record(
+                    source + ".uploaded_" + data_subset + ".upload"
+                ) | read_upload_record(
+                    os.path.join(os.path.dirname(source), "uploaded_batches.upload")
+                )
+                jobs.extend(parent_jobs(args, source, done, ledger))
+
+            if claims is not None:
+                jobs = [job for job in jobs if not claims.is_done(job["records_batch"])]
+            jobs = order_jobs(jobs, args.priority)
+            print(f"{len(jobs)} batch(es) from {len(parents)} parent(s) queued for upload.")
+
+        scheduler = BandwidthScheduler(
+            max_bandwidth=args.max_bandwidth,
+            max_concurrent=args.max_concurrent,
+            schedule=args.schedule,
+        )
+        with stage("batches"):
+            failed = run_batches(jobs, scheduler, upload_record, ledger, claims)
 
-    upload_file.close()
+    if failed:
+        print(str(len(failed)) + " batch(es) failed and can be retried by re-running upload.py.")
+        sys.exit(8)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,128 @@
+"""
+Filesystem metadata operations issued concurrently, for high-latency storage.
+
+On NFS or Lustre every stat, listdir, readlink or symlink is a round trip
+of a few milliseconds, so a tree walked one call at a time is bound by
+latency, not bandwidth.  AsyncFS runs these calls in executor threads from
+asyncio coroutines, with at most a fixed number in flight per filesystem:
+
+    with AsyncFS({None: 16, "/mnt/lustre": 128}) as fs:
+        entries = fs.run(fs.entries("/mnt/lustre/bids"))
+
+A path belongs to the filesystem of the longest configured path it is
+under; paths under none of them share the default limit (the None key, or
+DEFAULT_LIMIT).  Tools take the limits as repeated --io-limit N or
+--io-limit PATH=N options, see parse_io_limit().
+"""
+import asyncio
+import os
+from argparse import ArgumentTypeError
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_LIMIT = 16
+
+
+def parse_io_limit(value):
+    """argparse type for N (the default limit) or PATH=N, returning (path or None, N)."""
+    path, equals, limit = value.rpartition("=")
+    try:
+        limit = int(limit)
+    except ValueError:
+        limit = 0
+    if limit < 1 or (equals and not path):
+        raise ArgumentTypeError(f"{value} is not N or PATH=N with N >= 1")
+    return (os.path.abspath(path) if path else None), limit
+
+
+def _entries(directory):
+    # is_dir() is resolved here, it may need another stat when d_type is unknown
+    with os.scandir(directory) as it:
+        return [(entry.name, entry.path, entry.is_dir()) for entry in it]
+
+
+def _lentries(directory):
+    with os.scandir(directory) as it:
+        return [
+            (entry.name, entry.path, entry.is_dir(follow_symlinks=False), entry.is_symlink())
+            for entry in it
+        ]
+
+
+class AsyncFS:
+    def __init__(self, limits=None):
+        """limits: {path or None: operations in flight}, e.g. from parse_io_limit()."""
+        limits = dict(limits or {})
+        self.default_limit = limits.pop(None, DEFAULT_LIMIT)
+        self.limits = {os.path.abspath(path): limit for path, limit in limits.items()}
+        # the longest path first, so nested mounts win over their parents
+        self._mounts = sorted(self.limits, key=len, reverse=True)
+        self._semaphores = {}
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.default_limit + sum(self.limits.values())
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    def filesystem(self, path):
+        """Configured path whose limit applies to path, or None for the default."""
+        path = os.path.abspath(path)
+        for mount in self._mounts:
+            if path == mount or path.startswith(mount.rstrip(os.sep) + os.sep):
+                return mount
+        return None
+
+    def _semaphore(self, path):
+        mount = self.filesystem(path)
+        if mount not in self._semaphores:
+            self._semaphores[mount] = asyncio.Semaphore(
+                self.default_limit if mount is None else self.limits[mount]
+            )
+        return self._semaphores[mount]
+
+    async def call(self, path, function, *args):
+        """function(*args) in an executor thread, counted against path's filesystem."""
+        async with self._semaphore(path):
+            return await asyncio.get_running_loop().run_in_executor(
+                self._executor, function, *args
+            )
+
+    def run(self, coroutine):
+        """Run a coroutine using this AsyncFS to completion from synchronous code."""
+        try:
+            return asyncio.run(coroutine)
+        finally:
+            # semaphores belong to the event loop they were first used in
+            self._semaphores = {}
+
+    async def entries(self, directory):
+        """(name, path, is_dir) of every entry in directory."""
+        return await self.call(directory, _entries, directory)
+
+    async def lentries(self, directory):
+        """(name, path, is_dir, is_symlink) of every entry in directory, not following symlinks."""
+        return await self.call(directory, _lentries, directory)
+
+    async def stat(self, path):
+        return await self.call(path, os.stat, path)
+
+    async def lstat(self, path):
+        return await self.call(path, os.lstat, path)
+
+    async def readlink(self, path):
+        return await self.call(path, os.readlink, path)
+
+    async def exists(self, path):
+        return await self.call(path, os.path.exists, path)
+
+    async def symlink(self, source, link):
+        return await self.call(link, os.symlink, source, link)
+
+    async def makedirs(self, path, exist_ok=True):
+        return await self.call(path, os.makedirs, path, 0o777, exist_ok)
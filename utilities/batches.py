@@ -0,0 +1,78 @@
+"""
+Reading and writing the records/folders files that records.py produces for
+a prepared parent and upload.py consumes:
+
+    <parent>.complete_records.csv     NDA structure line, column header, one row per child folder
+    <parent>.complete_folders.txt     the child folder of each row, in the same order
+    <parent>.records_<total>_<max>_<i>.csv / .folders_<total>_<max>_<i>.txt
+                                      the same rows split into upload batches
+"""
+import csv
+import math
+
+from datetime import datetime
+
+MAX_BATCH_SIZE = 500
+
+
+def write_records_csv(path, ndaheader, header, records):
+    with open(path, "w") as f:
+        f.write(ndaheader + "\n")
+
+        writer = csv.DictWriter(f, fieldnames=header, quoting=csv.QUOTE_ALL)
+        writer.writeheader()
+        for record in records:
+            writer.writerow(record)
+
+
+def read_records_csv(path):
+    """Return (ndaheader, header, records) from a records CSV written by write_records_csv."""
+    with open(path, "r", newline="") as f:
+        ndaheader = f.readline().rstrip("\r\n")
+        reader = csv.DictReader(f)
+        records = [row for row in reader]
+        header = reader.fieldnames or []
+    return ndaheader, header, records
+
+
+def write_folders_txt(path, folders):
+    with open(path, "w") as f:
+        for folder in folders:
+            f.write(folder + "\n")
+
+
+def read_folders_txt(path):
+    with open(path, "r") as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def write_batches(
+    parent, ndaheader, header, records, folders, max_batch_size=MAX_BATCH_SIZE, prefix=""
+):
+    """
+    Split records and their folders into evenly sized batches of at most
+    max_batch_size and write one records CSV and one folders list per batch.
+    prefix is inserted before the batch name, e.g. "delta_" gives
+    <parent>.records_delta_<total>_<max>_<i>.csv.  Returns the batch names.
+    """
+    total = len(records)
+    if total == 0:
+        return []
+    count = math.ceil(float(total) / max_batch_size)
+    batch_size = math.ceil(float(total) / count)
+
+    batchnames = []
+    print(f"{datetime.now()} Creating {count} batch file(s) for {total} records")
+    for i in range(1, count + 1):
+        low = (i - 1) * batch_size
+        records_subset = records[low : (low + batch_size)]
+        folders_subset = folders[low : (low + batch_size)]
+
+        batchname = prefix + "_".join([str(total), str(max_batch_size), str(i)])
+        write_records_csv(
+            parent + ".records_" + batchname + ".csv", ndaheader, header, records_subset
+        )
+        write_folders_txt(parent + ".folders_" + batchname + ".txt", folders_subset)
+        batchnames.append(batchname)
+
+    return batchnames
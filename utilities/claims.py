@@ -0,0 +1,116 @@
+"""
+Shared-filesystem claims so several upload.py workers on different hosts can
+split one prepared destination without uploading a batch twice.
+
+Every batch is identified by the basename of its records CSV (mount points
+may differ between hosts).  In the shared ledger directory a worker
+
+    claims a batch    by hard-linking a private file to <batch>.claim, which
+                      either succeeds or fails atomically, also over NFS
+    renews the lease  by touching the claim while the batch uploads
+    finishes it       by creating <batch>.done and removing the claim
+
+A claim whose mtime is older than the lease timeout belongs to a crashed
+worker.  It is broken by renaming it to a unique name, which only one
+worker can do, after which the batch can be claimed again.
+"""
+import os
+import socket
+import time
+
+DEFAULT_LEASE_TIMEOUT = 1800
+
+
+def default_worker_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class ClaimBoard:
+    def __init__(self, ledger_dir, worker_id=None, lease_timeout=DEFAULT_LEASE_TIMEOUT):
+        self.ledger_dir = str(ledger_dir)
+        self.worker_id = worker_id or default_worker_id()
+        self.lease_timeout = lease_timeout
+        os.makedirs(self.ledger_dir, exist_ok=True)
+
+    def _path(self, batch, suffix):
+        return os.path.join(self.ledger_dir, os.path.basename(batch) + suffix)
+
+    def is_done(self, batch) -> bool:
+        return os.path.exists(self._path(batch, ".done"))
+
+    def holder(self, batch):
+        """Worker id currently holding the claim on a batch, or None."""
+        try:
+            with open(self._path(batch, ".claim"), "r") as f:
+                return f.readline().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def _expired(self, claim) -> bool:
+        try:
+            return time.time() - os.stat(claim).st_mtime > self.lease_timeout
+        except FileNotFoundError:
+            return True
+
+    def claim(self, batch) -> bool:
+        """Try to take a batch for this worker.  False if it is done or held by a live claim."""
+        if self.is_done(batch):
+            return False
+
+        claim = self._path(batch, ".claim")
+        private = claim + "." + self.worker_id
+        with open(private, "w") as f:
+            f.write(self.worker_id + "\n" + str(time.time()) + "\n")
+
+        try:
+            for attempt in range(2):
+                try:
+                    os.link(private, claim)
+                except FileExistsError:
+                    if attempt or not self._expired(claim):
+                        return False
+                    holder = self.holder(batch)
+                    stale = claim + ".expired." + self.worker_id
+                    try:
+                        # only one worker wins the rename of a stale claim
+                        os.rename(claim, stale)
+                    except FileNotFoundError:
+                        continue
+                    if not self._expired(stale):
+                        # another worker broke it first and reclaimed; put theirs back
+                        try:
+                            os.link(stale, claim)
+                        except FileExistsError:
+                            pass
+                        os.remove(stale)
+                        return False
+                    os.remove(stale)
+                    print(f"Claim on {os.path.basename(batch)} by {holder} expired, reclaiming.")
+                    continue
+
+                if self.is_done(batch):
+                    # finished by another worker between the done check and the link
+                    os.remove(claim)
+                    return False
+                return True
+            return False
+        finally:
+            os.remove(private)
+
+    def renew(self, batch) -> None:
+        """Extend the lease on a batch this worker holds."""
+        if self.holder(batch) == self.worker_id:
+            os.utime(self._path(batch, ".claim"))
+
+    def complete(self, batch) -> None:
+        with open(self._path(batch, ".done"), "w") as f:
+            f.write(self.worker_id + "\n" + str(time.time()) + "\n")
+        self.release(batch)
+
+    def release(self, batch) -> None:
+        """Give up a claim (e.g. after a failed upload) so another worker can retry it."""
+        if self.holder(batch) == self.worker_id:
+            try:
+                os.remove(self._path(batch, ".claim"))
+            except FileNotFoundError:
+                pass
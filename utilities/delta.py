@@ -0,0 +1,186 @@
+"""
+Delta release: upload only what changed since a previous prepared destination.
+
+Both destinations must already have been through records.py.  For every
+parent in the new destination, each child folder listed in
+<parent>.complete_folders.txt is classified against the same parent in the
+previous destination:
+
+    new        the child folder did not exist in the previous release
+    changed    its manifest (path, md5sum, size of every file) or its record row differs
+    unchanged  neither differs
+
+Only manifests and records are compared, file contents are never re-read.
+New and changed children are written to
+
+    <parent>.delta_records.csv / <parent>.delta_folders.txt
+    <parent>.records_delta_<total>_<max>_<i>.csv / .folders_delta_<total>_<max>_<i>.txt
+
+which `upload.py --delta` uploads instead of the complete batches.  A
+per-child classification is written to delta_report.tsv in the new destination.
+"""
+import csv
+import hashlib
+import json
+import os
+import sys
+
+from argparse import ArgumentParser
+from glob import escape, glob
+from pathlib import Path
+
+if __package__ in (None, ""):
+    # run as `python utilities/delta.py`: make the utilities package importable
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utilities.batches import (
+    read_folders_txt,
+    read_records_csv,
+    write_batches,
+    write_folders_txt,
+    write_records_csv,
+)
+from utilities.digests import load_manifest_files
+
+# manifest locations depend on where the release was prepared, the manifest
+# fingerprint already covers their contents
+LOCATION_COLUMNS = ("manifest", "image_manifest")
+
+NEW = "new"
+CHANGED = "changed"
+UNCHANGED = "unchanged"
+
+
+def manifest_fingerprint(folder_path):
+    """Hash of the (path, md5sum, size) of every file in a child folder's manifest."""
+    files = load_manifest_files(folder_path)
+    if files is None:
+        return None
+    entries = sorted(
+        (entry.get("path", ""), entry.get("md5sum", ""), int(entry.get("size", 0)))
+        for entry in files
+    )
+    return hashlib.sha1(json.dumps(entries).encode()).hexdigest()
+
+
+def load_parent(parent):
+    """
+    Return (ndaheader, header, {folder: (record, manifest fingerprint)}) for a
+    prepared parent, or None if records.py has not been run on it.
+    """
+    complete_records = parent + ".complete_records.csv"
+    complete_folders = parent + ".complete_folders.txt"
+    if not (os.path.isfile(complete_records) and os.path.isfile(complete_folders)):
+        return None
+
+    ndaheader, header, records = read_records_csv(complete_records)
+    folders = read_folders_txt(complete_folders)
+    children = {
+        folder: (record, manifest_fingerprint(os.path.join(parent, folder)))
+        for folder, record in zip(folders, records)
+    }
+    return ndaheader, header, children
+
+
+def _record_fields(record):
+    return {k: v for k, v in record.items() if k not in LOCATION_COLUMNS}
+
+
+def classify(previous_children, new_children):
+    """Map every child folder of the new parent to NEW, CHANGED or UNCHANGED."""
+    status = {}
+    for folder, (record, fingerprint) in new_children.items():
+        if folder not in previous_children:
+            status[folder] = NEW
+            continue
+        previous_record, previous_fingerprint = previous_children[folder]
+        if (
+            fingerprint is None
+            or fingerprint != previous_fingerprint
+            or _record_fields(record) != _record_fields(previous_record)
+        ):
+            status[folder] = CHANGED
+        else:
+            status[folder] = UNCHANGED
+    return status
+
+
+def delta_parent(previous_parent, new_parent):
+    """Write the delta records, folders and batches for one parent and return its classification."""
+    ndaheader, header, new_children = load_parent(new_parent)
+    previous = load_parent(previous_parent)
+    previous_children = previous[2] if previous else {}
+
+    status = classify(previous_children, new_children)
+    delta_folders = [folder for folder in new_children if status[folder] != UNCHANGED]
+    delta_records = [new_children[folder][0] for folder in delta_folders]
+
+    # remove delta batches left over from an earlier comparison
+    for stale in glob(escape(new_parent) + ".records_delta_*") + glob(escape(new_parent) + ".folders_delta_*"):
+        os.remove(stale)
+
+    write_records_csv(new_parent + ".delta_records.csv", ndaheader, header, delta_records)
+    write_folders_txt(new_parent + ".delta_folders.txt", delta_folders)
+    write_batches(
+        new_parent,
+        ndaheader,
+        header,
+        delta_records,
+        delta_folders,
+        prefix="delta_",
+    )
+    return status
+
+
+def delta_release(previous_destination, new_destination):
+    """Compare every prepared parent of new_destination with previous_destination."""
+    previous_destination = Path(previous_destination)
+    new_destination = Path(new_destination)
+    report = []
+
+    suffix = ".complete_records.csv"
+    for complete_csv in sorted(glob(os.path.join(escape(str(new_destination)), "*" + suffix))):
+        new_parent = complete_csv[: -len(suffix)]
+        if not os.path.isdir(new_parent):
+            continue
+        previous_parent = str(previous_destination / os.path.basename(new_parent))
+
+        status = delta_parent(previous_parent, new_parent)
+        counts = {label: 0 for label in (NEW, CHANGED, UNCHANGED)}
+        for folder, label in status.items():
+            counts[label] += 1
+            report.append((os.path.basename(new_parent), folder, label))
+        print(
+            f"{os.path.basename(new_parent)}: {counts[NEW]} new, "
+            f"{counts[CHANGED]} changed, {counts[UNCHANGED]} unchanged"
+        )
+
+    report_path = new_destination / "delta_report.tsv"
+    with open(report_path, "w", newline="") as f:
+        writer = csv.writer(f, delimiter="\t")
+        writer.writerow(["parent", "folder", "status"])
+        writer.writerows(report)
+
+    return report
+
+
+def cli():
+    parser = ArgumentParser(
+        description="Write delta upload batches holding only the child folders "
+        "that are new or changed since a previous prepared release."
+    )
+    parser.add_argument(
+        "previous_destination", type=Path, help="Prepared destination of the previous release"
+    )
+    parser.add_argument(
+        "new_destination", type=Path, help="Prepared destination of the new release"
+    )
+    args = parser.parse_args()
+    report = delta_release(args.previous_destination, args.new_destination)
+    delta = sum(1 for _, _, label in report if label != UNCHANGED)
+    print(f"{delta} of {len(report)} child folders need uploading.")
+    print("Upload them with: upload.py --delta -d " + str(args.new_destination) + " ...")
+
+
+if __name__ == "__main__":
+    cli()
@@ -1,88 +1,398 @@
-#! /usr/bin/env python3
-
-"""
-DCAN Labs DICOM to TAR.GZ conversion utility
-
-Created  12/19/2021 by Eric Earl
-"""
-
-import argparse   # For command line arguments
-import csv        # For CSV file handling
-import os         # For file system operations
-import pydicom    # For DICOM file handling
-import subprocess # For calling external programs
-
-from datetime import datetime # For timestamping
-from glob import glob # For globbing file names
-
-
-HERE = os.path.dirname(os.path.realpath(__file__))
-
-__doc__ = """
-This command-line tool allows the user to easily convert a directory of only 
-DICOM files into a TAR.GZ archive in a rough approximation of a BIDS hierarchy.
-"""
-
-parser = argparse.ArgumentParser(description=__doc__)
-parser.add_argument('-i', '--input-csv', metavar='CSV' , required=True,
-                    help='Input directory of only valid DICOM files')
-
-parser.add_argument('-o', '--output-dir', metavar='DIRECTORY', required=True,
-                    help='Output directory to deposit TAR.GZ files in a '
-                         'BIDS-like hierarchy')
-
-args = parser.parse_args()
-
-input_csv = os.path.abspath(args.input_csv)
-output_dir = os.path.abspath(args.output_dir)
-
-subjects = []
-sessions = []
-combos = []
-
-with open(input_csv, 'r') as f:
-    reader = csv.DictReader(f)
-    for series in reader:
-        # read columns from CSV file
-        source = series['source'] # e.g. /path/to/dicom/series/4-REST2/
-        nda_bids_subject = series['nda_bids_subject'] # e.g. sub-01
-        bids_session = series['bids_session'] # e.g. ses-01
-        bids_name = series['bids_name'] # e.g. task-rest
-        bids_modality = series['bids_modality'] # e.g. func
-
-        # append to lists
-        subjects.append(nda_bids_subject)
-        sessions.append(bids_session)
-        combos.append((bids_modality, bids_name))
-
-        # grab any one DICOM file from source directory (index 0)
-        dicom_file = glob(os.path.join(source, '*'))[0]
-
-        # grab the series number for the DICOM file
-        series_number = str(pydicom.dcmread(dicom_file).SeriesNumber)
-
-        # create output TAR.GZ file
-        output_basename = '_'.join([nda_bids_subject, bids_session, bids_name, 
-                                    'series-' + series_number + '.tar.gz'])
-        output = os.path.join(output_dir, 'sourcedata', nda_bids_subject, 
-                              bids_session, bids_modality, output_basename)
-
-        # create output directories
-        os.makedirs(os.path.dirname(output), exist_ok=True)
-
-        print(datetime.now(), 'Creating TAR.GZ file: ' + output)
-        subprocess.run(['tar', '-czf', output, '-C', source, '.'])
-
-# report back to user
-print('DICOM to TAR.GZ conversion complete!' + '\n')
-print('Output directory: ' + output_dir)
-
-print('Subjects:')
-print('\t' + ', '.join(list(set(subjects))) + '\n')
-
-print('Sessions:')
-print('\t' + ', '.join(list(set(sessions))) + '\n')
-
-print('Combinations:')
-for combo in list(set(combos)):
-    print('\t' + ', '.join(combo))
+#! /usr/bin/env python3
+
+"""
+DCAN Labs DICOM to TAR.GZ conversion utility
+
+Created  12/19/2021 by Eric Earl
+"""
+
+import argparse   # For command line arguments
+import csv        # For CSV file handling
+import hashlib    # For checksumming archives as they are written
+import json       # For series fingerprints
+import os         # For file system operations
+import shutil     # For finding compression programs
+import subprocess # For calling external programs
+import sys        # For exit codes
+import time       # For per-series timing
+
+from concurrent.futures import ProcessPoolExecutor, as_completed # For parallel archiving
+from datetime import datetime # For timestamping
+
+if __package__ in (None, ''):
+    # run as `python utilities/dicom2targz.py`: make the utilities package importable
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utilities.dicom_probe import load_probe_cache, probe_series, save_probe_cache
+from utilities.manifests import CHUNK_SIZE, DEFAULT_DIGEST_STORE, DigestStore
+
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+
+__doc__ = """
+This command-line tool allows the user to easily convert a directory of only
+DICOM files into a TAR.GZ archive in a rough approximation of a BIDS hierarchy.
+Series are archived in parallel, one tar process per series.  Series whose
+source directory is unchanged since their archive was written are skipped.
+"""
+
+# gzip: single-threaded gzip, pigz: multi-threaded gzip (same .tar.gz output),
+# store: plain .tar without compression, for already-compressed pixel data
+CODECS = ('gzip', 'pigz', 'store')
+DEFAULT_LEVEL = 6 # gzip's own default
+
+REPORT_NAME = 'dicom2targz_report.tsv'
+# header probes of every series, reused while a series directory is unchanged
+PROBE_CACHE_NAME = '.dicom_probe_cache.json'
+# archive fingerprints, outside the sourcedata tree that gets uploaded
+FINGERPRINT_DIR = '.dicom2targz'
+REPORT_COLUMNS = ['output', 'source', 'status', 'files', 'input_bytes',
+                  'output_bytes', 'ratio', 'seconds', 'md5sum']
+
+
+def generate_parser():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-i', '--input-csv', metavar='CSV' , required=True,
+                        help='Input directory of only valid DICOM files')
+
+    parser.add_argument('-o', '--output-dir', metavar='DIRECTORY', required=True,
+                        help='Output directory to deposit TAR.GZ files in a '
+                             'BIDS-like hierarchy')
+
+    parser.add_argument('-j', '--jobs', metavar='N', type=int, default=None,
+                        help='Series to archive at the same time (default: '
+                             'number of CPUs)')
+
+    parser.add_argument('-c', '--codec', choices=CODECS, default='gzip',
+                        help='gzip (default), pigz (multi-threaded gzip, '
+                             'needs pigz installed) or store (uncompressed '
+                             '.tar, for already-compressed pixel data)')
+
+    parser.add_argument('-l', '--level', metavar='1-9', type=int,
+                        choices=range(1, 10), default=DEFAULT_LEVEL,
+                        help='Compression level for gzip and pigz (default 6)')
+
+    parser.add_argument('--digest-store', metavar='TSV', default=DEFAULT_DIGEST_STORE,
+                        help='Where to record the md5sum of every archive for '
+                             'records.py manifests (default: ' + DEFAULT_DIGEST_STORE + ')')
+
+    parser.add_argument('--force', action='store_true', default=False,
+                        help='Archive every series again, even when its source '
+                             'is unchanged since its archive was written')
+    return parser
+
+
+def read_series_csv(input_csv):
+    """Rows of the input CSV: source, nda_bids_subject, bids_session, bids_name, bids_modality."""
+    with open(input_csv, 'r') as f:
+        return list(csv.DictReader(f))
+
+
+def series_number(probe):
+    """SeriesNumber from a probe_series() result."""
+    return probe['tags']['SeriesNumber']
+
+
+def archive_extension(codec):
+    return '.tar' if codec == 'store' else '.tar.gz'
+
+
+def archive_command(source, output='-', codec='gzip', level=DEFAULT_LEVEL, threads=1,
+                    dereference=False):
+    """
+    tar command line that archives the contents of source into output (- for
+    stdout), storing the files symlinks point to instead of the symlinks
+    with dereference.
+    """
+    flags = ['-h'] if dereference else []
+    if codec == 'store':
+        return ['tar'] + flags + ['-cf', output, '-C', source, '.']
+    if codec == 'pigz':
+        program = 'pigz -p ' + str(threads) + ' -' + str(level)
+    else:
+        program = 'gzip -' + str(level)
+    return ['tar', '--use-compress-program=' + program] + flags + [
+        '-cf', output, '-C', source, '.']
+
+
+def series_fingerprint(source):
+    """File count, total size and newest mtime of everything under a series directory."""
+    files = 0
+    size = 0
+    max_mtime_ns = 0
+    for root, dirs, names in os.walk(source):
+        for name in names:
+            stat = os.stat(os.path.join(root, name))
+            files += 1
+            size += stat.st_size
+            max_mtime_ns = max(max_mtime_ns, stat.st_mtime_ns)
+    return {'files': files, 'input_bytes': size, 'max_mtime_ns': max_mtime_ns}
+
+
+def fingerprint_path(output, output_dir):
+    """
+    Where the fingerprint of an archive under output_dir is kept: in
+    <output_dir>/.dicom2targz/, not next to the archive, where manifests
+    would list it and it would be uploaded with the archives.
+    """
+    return os.path.join(output_dir, FINGERPRINT_DIR,
+                        os.path.relpath(output, output_dir) + '.fingerprint')
+
+
+def legacy_fingerprint_path(output):
+    """Hidden file next to an archive, where fingerprints used to be kept."""
+    return os.path.join(os.path.dirname(output),
+                        '.' + os.path.basename(output) + '.fingerprint')
+
+
+def read_fingerprint(output, fingerprint_file):
+    """The fingerprint recorded for an archive, or None if the archive or fingerprint is missing."""
+    try:
+        with open(fingerprint_file, 'r') as f:
+            recorded = json.load(f)
+        if os.path.getsize(output) != recorded['output_bytes']:
+            return None
+    except (OSError, ValueError, KeyError):
+        return None
+    return recorded
+
+
+def write_archive(command, output):
+    """
+    Run a tar command writing to stdout, save the stream to output and
+    checksum it on the way, so the archive never has to be read back.
+    Returns (md5sum, size).
+    """
+    md5 = hashlib.md5()
+    size = 0
+    with open(output, 'wb') as f:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE)
+        try:
+            for chunk in iter(lambda: process.stdout.read(CHUNK_SIZE), b''):
+                md5.update(chunk)
+                f.write(chunk)
+                size += len(chunk)
+        except BaseException:
+            # e.g. a full disk: stop tar rather than leave it blocked on the pipe
+            process.kill()
+            process.wait()
+            raise
+        finally:
+            process.stdout.close()
+        if process.wait() != 0:
+            raise subprocess.CalledProcessError(process.returncode, command)
+    return md5.hexdigest(), size
+
+
+def pack_directory(source, output, fingerprint_file, codec='gzip', level=DEFAULT_LEVEL,
+                   threads=1, force=False, dereference=False):
+    """
+    Archive the contents of source into output, unless force is not set and
+    the fingerprint recorded for output in fingerprint_file still matches
+    source and level.  The archive is written under a temporary name and
+    renamed when tar succeeded; when tar or writing fails, the partial
+    archive is removed, so no manifest picks it up.  Returns the fingerprint
+    with status (archived or up-to-date), md5sum and output_bytes.
+    """
+    fingerprint = dict(series_fingerprint(source), level=level)
+    recorded = None if force else read_fingerprint(output, fingerprint_file)
+    if recorded is not None and all(recorded.get(k) == v for k, v in fingerprint.items()):
+        return dict(recorded, status='up-to-date')
+
+    # create output directories
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+
+    partial = output + '.partial'
+    try:
+        md5sum, output_bytes = write_archive(
+            archive_command(source, '-', codec, level, threads, dereference), partial)
+        os.replace(partial, output)
+    except BaseException:
+        if os.path.exists(partial):
+            os.unlink(partial)
+        raise
+    fingerprint.update(md5sum=md5sum, output_bytes=output_bytes)
+    os.makedirs(os.path.dirname(fingerprint_file), exist_ok=True)
+    with open(fingerprint_file, 'w') as f:
+        json.dump(fingerprint, f)
+    return dict(fingerprint, status='archived')
+
+
+def archive_series(series, output_dir, codec='gzip', level=DEFAULT_LEVEL, threads=1,
+                   probe=None, force=False):
+    """
+    Archive one series (a row of the input CSV) and return a row for the
+    report: output path, file count, input and output bytes, compression
+    ratio and seconds taken, plus the series' header probe (reusing the
+    cached probe when it is still valid).
+
+    A fingerprint of the source (file count, total size, newest mtime) is
+    recorded in output_dir/.dicom2targz/.  Unless force is set, a series whose
+    fingerprint and compression level still match is not archived again
+    and its row is marked up-to-date.
+    """
+    start = time.perf_counter()
+    source = series['source']                     # e.g. /path/to/dicom/series/4-REST2/
+    nda_bids_subject = series['nda_bids_subject'] # e.g. sub-01
+    bids_session = series['bids_session']         # e.g. ses-01
+    bids_name = series['bids_name']               # e.g. task-rest
+    bids_modality = series['bids_modality']       # e.g. func
+
+    # header-only read of the first file the directory scan yields
+    probe = probe_series(source, probe)
+
+    # create output TAR.GZ file
+    output_basename = '_'.join([nda_bids_subject, bids_session, bids_name,
+                                'series-' + series_number(probe)
+                                + archive_extension(codec)])
+    output = os.path.join(output_dir, 'sourcedata', nda_bids_subject,
+                          bids_session, bids_modality, output_basename)
+
+    packed = pack_directory(source, output, fingerprint_path(output, output_dir),
+                            codec, level, threads, force)
+    # earlier runs kept the fingerprint next to the archive, in the upload
+    legacy = legacy_fingerprint_path(output)
+    if os.path.exists(legacy):
+        os.remove(legacy)
+
+    input_bytes = packed['input_bytes']
+    output_bytes = packed['output_bytes']
+    return {
+        'output': output,
+        'source': source,
+        'status': packed['status'],
+        'files': packed['files'],
+        'input_bytes': input_bytes,
+        'output_bytes': output_bytes,
+        'ratio': round(input_bytes / output_bytes, 3) if output_bytes else 0.0,
+        'seconds': round(time.perf_counter() - start, 3),
+        'md5sum': packed['md5sum'],
+        'mtime_ns': os.stat(output).st_mtime_ns,
+        'probe': probe,
+    }
+
+
+def archive_all(rows, output_dir, codec='gzip', level=DEFAULT_LEVEL, jobs=None,
+                digest_store=DEFAULT_DIGEST_STORE, force=False):
+    """
+    Archive every series across a pool of jobs worker processes, skipping
+    unchanged series unless force is set, and record each new archive's
+    digest in digest_store (None to skip).  Returns
+    (results, failures): one report row per archived series, and
+    (series, error) for every series that failed.
+    """
+    if codec == 'pigz' and shutil.which('pigz') is None:
+        raise RuntimeError('pigz was not found on the PATH, install it or use '
+                           '--codec gzip')
+    jobs = jobs or os.cpu_count() or 1
+    # share the cores between pigz processes instead of oversubscribing them
+    threads = max(1, (os.cpu_count() or 1) // jobs)
+
+    probe_cache_path = os.path.join(output_dir, PROBE_CACHE_NAME)
+    probe_cache = load_probe_cache(probe_cache_path)
+    store = DigestStore(digest_store) if digest_store else None
+
+    results = []
+    failures = []
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = {
+            pool.submit(archive_series, series, output_dir, codec, level, threads,
+                        probe_cache.get(series['source']), force): series
+            for series in rows
+        }
+        for future in as_completed(futures):
+            series = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                print(datetime.now(), 'FAILED ' + series['source'] + ': ' + str(e))
+                failures.append((series, e))
+                continue
+            results.append(result)
+            probe_cache[result['source']] = result['probe']
+            if result['status'] == 'up-to-date':
+                print(datetime.now(), 'Up to date ' + result['output'])
+                continue
+            print(datetime.now(), 'Created ' + result['output']
+                  + ' ({:.1f} s, ratio {:.2f})'.format(result['seconds'], result['ratio']))
+            if store is not None:
+                store.add(result['output'], result['md5sum'],
+                          result['output_bytes'], result['mtime_ns'])
+                # one archive can take minutes, keep its digest if the run stops
+                store.flush()
+
+    save_probe_cache(probe_cache_path, probe_cache)
+    return results, failures
+
+
+def write_report(results, output_dir):
+    """Per-series timing and compression ratio as a TSV in the output directory."""
+    report = os.path.join(output_dir, REPORT_NAME)
+    with open(report, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=REPORT_COLUMNS, delimiter='\t',
+                                extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(sorted(results, key=lambda r: r['output']))
+    return report
+
+
+def convert(series, output_dir, codec='gzip', level=DEFAULT_LEVEL, jobs=None,
+            digest_store=DEFAULT_DIGEST_STORE, force=False):
+    """
+    Archive a series CSV (a path) or its rows (e.g. from
+    dicom_index.index_dicom_tree) into output_dir and write the report, for
+    pipelines calling dicom2targz without going through the command line.
+    Returns (results, failures, report) as archive_all() and write_report().
+    """
+    rows = read_series_csv(series) if isinstance(series, (str, os.PathLike)) else list(series)
+    output_dir = os.path.abspath(output_dir)
+    results, failures = archive_all(rows, output_dir, codec, level, jobs,
+                                    digest_store, force)
+    return results, failures, write_report(results, output_dir)
+
+
+def main():
+    args = generate_parser().parse_args()
+
+    input_csv = os.path.abspath(args.input_csv)
+    output_dir = os.path.abspath(args.output_dir)
+
+    rows = read_series_csv(input_csv)
+    subjects = [series['nda_bids_subject'] for series in rows]
+    sessions = [series['bids_session'] for series in rows]
+    combos = [(series['bids_modality'], series['bids_name']) for series in rows]
+
+    results, failures, report = convert(rows, output_dir, args.codec, args.level,
+                                        args.jobs, args.digest_store, args.force)
+
+    # report back to user
+    print('DICOM to TAR.GZ conversion complete!' + '\n')
+    print('Output directory: ' + output_dir)
+
+    print('Subjects:')
+    print('\t' + ', '.join(list(set(subjects))) + '\n')
+
+    print('Sessions:')
+    print('\t' + ', '.join(list(set(sessions))) + '\n')
+
+    print('Combinations:')
+    for combo in list(set(combos)):
+        print('\t' + ', '.join(combo))
+
+    input_bytes = sum(r['input_bytes'] for r in results)
+    output_bytes = sum(r['output_bytes'] for r in results)
+    up_to_date = sum(r['status'] == 'up-to-date' for r in results)
+    print('\nArchived ' + str(len(results) - up_to_date) + ' series ('
+          + str(up_to_date) + ' already up to date), '
+          + '{:.2f}'.format(input_bytes / output_bytes if output_bytes else 0)
+          + ' compression ratio, per-series timing in ' + report)
+
+    if failures:
+        print(str(len(failures)) + ' series failed:')
+        for series, e in failures:
+            print('\t' + series['source'] + ': ' + str(e))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
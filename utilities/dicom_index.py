@@ -0,0 +1,206 @@
+"""
+Build the dicom2targz input CSV from a raw DICOM tree.
+
+    nda-dicom-index <dicom_root> <rules.json> -o series.csv
+
+The tree is walked once and the headers of all files are read in parallel
+(header tags only, never pixel data).  Files are grouped by
+SeriesInstanceUID, and every series is named by the first rule whose
+pattern matches its SeriesDescription (or another tag):
+
+    [
+        {"match": "(?i)mprage|t1w", "bids_name": "T1w", "bids_modality": "anat"},
+        {"match": "(?i)rest", "tag": "ProtocolName", "bids_name": "task-rest_bold", "bids_modality": "func"}
+    ]
+
+The subject and session of a series come from its PatientID and StudyDate
+(other tags can be chosen), reduced to the alphanumeric characters BIDS
+labels allow.  dicom2targz archives one directory per series, so a series
+whose files are spread over several directories, or share a directory with
+another series, is reported and left out, as are series no rule matches.
+"""
+import csv
+import json
+import os
+import re
+import sys
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+
+if __package__ in (None, ""):
+    # run as `python utilities/dicom_index.py`: make the utilities package importable
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utilities.dicom_probe import PROBE_TAGS, probe_file
+
+CSV_COLUMNS = [
+    "source",
+    "nda_bids_subject",
+    "bids_session",
+    "bids_name",
+    "bids_modality",
+    "series_number",
+    "series_description",
+    "files",
+]
+
+
+def walk_files(root):
+    """Every regular, non-hidden file under root, yielded as the scan goes."""
+    stack = [str(root)]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.name.startswith("."):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file():
+                    yield entry.path
+
+
+def read_header(path):
+    """(path, header tags), or (path, None) for files that are not DICOM."""
+    try:
+        return path, probe_file(path, PROBE_TAGS)
+    except Exception:
+        return path, None
+
+
+def load_rules(rules_path):
+    """Rules from a JSON list, with their patterns compiled."""
+    with open(rules_path, "r") as f:
+        rules = json.load(f)
+    for rule in rules:
+        for key in ("match", "bids_name", "bids_modality"):
+            if key not in rule:
+                raise ValueError(f"Rule {rule} in {rules_path} has no {key}")
+        rule["pattern"] = re.compile(rule["match"])
+    return rules
+
+
+def apply_rules(rules, tags):
+    """The first rule matching a series' tags, or None."""
+    for rule in rules:
+        if rule["pattern"].search(tags.get(rule.get("tag", "SeriesDescription"), "")):
+            return rule
+    return None
+
+
+def bids_label(value):
+    return re.sub(r"[^a-zA-Z0-9]", "", value)
+
+
+def group_series(headers):
+    """{SeriesInstanceUID: {"tags": first file's tags, "directories": {dir: file count}}}."""
+    series = {}
+    for path, tags in headers:
+        if not tags or "SeriesInstanceUID" not in tags:
+            continue
+        group = series.setdefault(
+            tags["SeriesInstanceUID"], {"tags": tags, "directories": {}}
+        )
+        directory = os.path.dirname(path)
+        group["directories"][directory] = group["directories"].get(directory, 0) + 1
+    return series
+
+
+def index_dicom_tree(
+    dicom_root, rules, jobs=None, subject_tag="PatientID", session_tag="StudyDate"
+):
+    """
+    Walk dicom_root once, reading headers across jobs processes, and return
+    (rows, skipped): the dicom2targz input rows, and (SeriesInstanceUID,
+    reason) for every series left out.
+    """
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        series = group_series(pool.map(read_header, walk_files(dicom_root), chunksize=64))
+
+    # directories holding more than one series cannot be archived per series
+    series_per_directory = {}
+    for group in series.values():
+        for directory in group["directories"]:
+            series_per_directory[directory] = series_per_directory.get(directory, 0) + 1
+
+    rows = []
+    skipped = []
+    for uid, group in series.items():
+        tags = group["tags"]
+        rule = apply_rules(rules, tags)
+        if rule is None:
+            skipped.append((uid, "no rule matches " + repr(tags.get("SeriesDescription", ""))))
+            continue
+        if len(group["directories"]) > 1:
+            skipped.append((uid, "files in several directories"))
+            continue
+        (directory, files), = group["directories"].items()
+        if series_per_directory[directory] > 1:
+            skipped.append((uid, "directory shared with other series: " + directory))
+            continue
+        subject = bids_label(tags.get(subject_tag, ""))
+        session = bids_label(tags.get(session_tag, ""))
+        if not subject or not session:
+            skipped.append((uid, f"no {subject_tag} or {session_tag}"))
+            continue
+        rows.append(
+            {
+                "source": directory,
+                "nda_bids_subject": "sub-" + subject,
+                "bids_session": "ses-" + session,
+                "bids_name": rule["bids_name"],
+                "bids_modality": rule["bids_modality"],
+                "series_number": tags.get("SeriesNumber", ""),
+                "series_description": tags.get("SeriesDescription", ""),
+                "files": files,
+            }
+        )
+    rows.sort(key=lambda row: (row["nda_bids_subject"], row["bids_session"], row["source"]))
+    return rows, skipped
+
+
+def write_series_csv(rows, output_csv):
+    with open(output_csv, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=CSV_COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def cli(argv=None):
+    parser = ArgumentParser(
+        description="Index a raw DICOM tree into the series CSV dicom2targz archives."
+    )
+    parser.add_argument("dicom_root", help="Directory tree of raw DICOM files")
+    parser.add_argument(
+        "rules", help="JSON list of {match, bids_name, bids_modality[, tag]} rules"
+    )
+    parser.add_argument(
+        "-o", "--output-csv", required=True, help="Series CSV to write for dicom2targz"
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=None, help="Processes reading headers (default: number of CPUs)"
+    )
+    parser.add_argument(
+        "--subject-tag", default="PatientID", help="Header tag holding the subject label (default PatientID)"
+    )
+    parser.add_argument(
+        "--session-tag", default="StudyDate", help="Header tag holding the session label (default StudyDate)"
+    )
+    args = parser.parse_args(argv)
+
+    rows, skipped = index_dicom_tree(
+        args.dicom_root,
+        load_rules(args.rules),
+        args.jobs,
+        args.subject_tag,
+        args.session_tag,
+    )
+    write_series_csv(rows, args.output_csv)
+    print(f"{len(rows)} series written to {args.output_csv}")
+    if skipped:
+        print(f"{len(skipped)} series skipped:")
+        for uid, reason in skipped:
+            print(f"\t{uid}: {reason}")
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,81 @@
+"""
+Cheap DICOM series metadata for dicom2targz.
+
+Getting a series' SeriesNumber used to list the whole series directory
+(often 10k+ slices) and read one file in full, pixel data included.
+probe_series() instead takes the first regular file a lazy os.scandir
+yields and reads only the header tags in PROBE_TAGS, stopping before the
+pixel data.  Results are kept per series directory, keyed by the
+directory's mtime, in a JSON cache so later runs and steps reuse them.
+"""
+import json
+import os
+
+# header tags every probe reads, enough to name and group a series
+PROBE_TAGS = [
+    "SeriesInstanceUID",
+    "SeriesNumber",
+    "SeriesDescription",
+    "ProtocolName",
+    "Modality",
+    "PatientID",
+    "StudyDate",
+    "SeriesDate",
+    "ImageType",
+]
+
+
+def first_file(directory):
+    """Path of the first regular, non-hidden file in directory, without listing all of it."""
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if not entry.name.startswith(".") and entry.is_file():
+                return entry.path
+    raise FileNotFoundError(f"No files in {directory}")
+
+
+def probe_file(path, tags=PROBE_TAGS):
+    """The given header tags of one DICOM file as strings; missing tags are left out."""
+    # imported here so the nda-* commands start without loading pydicom
+    import pydicom
+
+    dataset = pydicom.dcmread(path, stop_before_pixels=True, specific_tags=tags)
+    values = {}
+    for tag in tags:
+        value = dataset.get(tag)
+        if value is None:
+            continue
+        if isinstance(value, pydicom.multival.MultiValue):
+            value = "\\".join(str(v) for v in value)
+        values[tag] = str(value)
+    return values
+
+
+def probe_series(source, cached=None, tags=PROBE_TAGS):
+    """
+    Header tags of a series directory as {"mtime_ns", "file", "tags"}.  A
+    cached entry for the same directory is returned as-is while the
+    directory's mtime is unchanged (files added or removed change it).
+    """
+    mtime_ns = os.stat(source).st_mtime_ns
+    if cached and cached.get("mtime_ns") == mtime_ns and set(tags) <= set(cached.get("probed", [])):
+        return cached
+    path = first_file(source)
+    return {"mtime_ns": mtime_ns, "file": path, "probed": list(tags), "tags": probe_file(path, tags)}
+
+
+def load_probe_cache(path):
+    """{series directory: probe_series() entry}, empty when there is no cache yet."""
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def save_probe_cache(path, cache):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(cache, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
@@ -0,0 +1,77 @@
+"""
+Content-addressed ledger of files already delivered to the NDA.
+
+Every file listed in a prepared folder's manifest carries an md5sum and a
+size.  After a batch uploads successfully, upload.py appends those digests to
+a tab-separated ledger together with the collection and the batch
+(submission) title they went to:
+
+    md5sum<TAB>size<TAB>collection_id<TAB>description
+
+Because the ledger is keyed by content rather than path, the same anatomical
+input or BIDS top-level file prepared under a different parent, or in a later
+release, is recognized as already delivered.
+"""
+import csv
+import json
+import os
+
+from glob import escape, glob
+
+DEFAULT_LEDGER = os.path.join(
+    os.path.expanduser("~"), ".nda-bids-upload", "uploaded_digests.tsv"
+)
+
+
+def load_manifest_files(folder_path):
+    """Return the "files" entries of a prepared folder's manifest, or None if it has none."""
+    manifests = glob(os.path.join(escape(folder_path), "*.manifest.json"))
+    if not manifests:
+        return None
+    with open(manifests[0], "r") as f:
+        return json.load(f).get("files", [])
+
+
+def file_digest(entry):
+    """(md5sum, size) key for a manifest file entry, or None without a checksum."""
+    md5sum = entry.get("md5sum")
+    if not md5sum:
+        return None
+    return (md5sum, int(entry.get("size", 0)))
+
+
+class DigestLedger:
+    def __init__(self, path=DEFAULT_LEDGER):
+        self.path = str(path)
+        # (md5sum, size) -> set of collection ids
+        self.delivered = {}
+        if os.path.isfile(self.path):
+            with open(self.path, "r", newline="") as f:
+                for row in csv.reader(f, delimiter="\t"):
+                    if len(row) < 3:
+                        continue
+                    key = (row[0], int(row[1]))
+                    self.delivered.setdefault(key, set()).add(row[2])
+
+    def is_delivered(self, key, collection_id) -> bool:
+        return key is not None and str(collection_id) in self.delivered.get(key, ())
+
+    def folder_delivered(self, files, collection_id) -> bool:
+        """True if every file of a folder's manifest already went to this collection."""
+        if not files:
+            return False
+        return all(
+            self.is_delivered(file_digest(entry), collection_id) for entry in files
+        )
+
+    def add(self, files, collection_id, description) -> None:
+        """Append the digests of a successfully uploaded set of manifest entries."""
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path, "a", newline="") as f:
+            writer = csv.writer(f, delimiter="\t")
+            for entry in files:
+                key = file_digest(entry)
+                if key is None or self.is_delivered(key, collection_id):
+                    continue
+                writer.writerow([key[0], key[1], collection_id, description])
+                self.delivered.setdefault(key, set()).add(str(collection_id))
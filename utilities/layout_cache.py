@@ -0,0 +1,145 @@
+"""
+Persistent pybids index shared by nda-lookup and nda-mapping.
+
+Indexing a large BIDS dataset takes minutes, and every tool used to build a
+fresh BIDSLayout.  load_layout() stores the pybids SQLite database in a
+cache directory (by default .pybids_cache in the NDA destination) together
+with a signature of the dataset: the mtime of every directory in the tree.
+Adding, removing or renaming a file changes its directory's mtime, so a
+matching signature means the cached index is still valid and is loaded in
+milliseconds.  Otherwise the dataset is re-indexed and the cache replaced.
+"""
+import hashlib
+import json
+import os
+
+from pathlib import Path
+
+from utilities.scanner import BIDSScanner
+
+CACHE_DIRNAME = ".pybids_cache"
+
+# "pybids" builds (or reuses) a full BIDSLayout index, "scandir" uses the
+# lightweight BIDSScanner, which is fast enough to need no cache
+BACKENDS = ("pybids", "scandir")
+
+
+def default_cache_dir(bids_dataset, destination_path=None) -> Path:
+    """
+    Cache location for a dataset: inside the destination directory when one
+    is given (a destination ending in .csv means its folder), otherwise next to the dataset.
+    """
+    if destination_path:
+        destination = Path(destination_path)
+        if destination.suffix.lower() == ".csv":
+            destination = destination.parent
+        return destination / CACHE_DIRNAME
+    dataset = Path(bids_dataset).resolve()
+    return dataset.parent / f".{dataset.name}{CACHE_DIRNAME}"
+
+
+def dataset_signature(bids_dataset, files=False) -> str:
+    """
+    Hash of the relative path and mtime of every directory under the dataset.
+    With files, the size and mtime of every file (through symlinks) are
+    included too, so a file edited in place changes the signature as well.
+    """
+    root = str(Path(bids_dataset).resolve())
+    digest = hashlib.sha1()
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+            entries = list(os.scandir(directory))
+        except OSError:
+            continue
+        digest.update(f"{os.path.relpath(directory, root)}\0{mtime}\n".encode())
+        if files:
+            for entry in sorted(entries, key=lambda e: e.name):
+                if entry.is_dir(follow_symlinks=False):
+                    continue
+                try:
+                    stat = entry.stat()
+                    signature = f"{stat.st_size}\0{stat.st_mtime_ns}"
+                except OSError:
+                    signature = "missing"
+                digest.update(f"{os.path.relpath(entry.path, root)}\0{signature}\n".encode())
+        stack.extend(
+            sorted(
+                (e.path for e in entries if e.is_dir(follow_symlinks=False)),
+                reverse=True,
+            )
+        )
+    return digest.hexdigest()
+
+
+def subject_signatures(bids_dataset) -> dict:
+    """dataset_signature() of every sub-* folder, keyed by subject label."""
+    signatures = {}
+    for entry in os.scandir(bids_dataset):
+        if entry.name.startswith("sub-") and entry.is_dir():
+            signatures[entry.name[4:]] = dataset_signature(entry.path)
+    return signatures
+
+
+def load_layout(
+    bids_dataset,
+    cache_dir=None,
+    reindex=False,
+    backend="pybids",
+    subjects=None,
+    io_limits=None,
+):
+    """
+    Return a BIDSLayout for bids_dataset, reusing the index stored in
+    cache_dir when the dataset has not changed since it was built.  Without
+    a cache_dir this is a plain, uncached BIDSLayout.  With the "scandir"
+    backend a BIDSScanner is returned instead and cache_dir is not used;
+    it only scans the given subjects when there are any (pybids always
+    indexes the whole dataset), with io_limits listings in flight.
+    """
+    if backend == "scandir":
+        return BIDSScanner(bids_dataset, subjects, io_limits)
+    if backend != "pybids":
+        raise ValueError(f"Unknown BIDS backend {backend}, choose from {BACKENDS}")
+
+    # pybids takes seconds to import, only load it for this backend
+    import bids
+
+    if cache_dir is None:
+        return bids.BIDSLayout(str(bids_dataset))
+
+    cache_dir = Path(cache_dir)
+    signature_path = cache_dir / "signature.json"
+    signature = {
+        "root": str(Path(bids_dataset).resolve()),
+        "pybids": bids.__version__,
+        "directories": dataset_signature(bids_dataset),
+    }
+
+    fresh = False
+    if not reindex and signature_path.is_file():
+        try:
+            with open(signature_path, "r") as infile:
+                fresh = json.load(infile) == signature
+        except (OSError, json.JSONDecodeError):
+            fresh = False
+
+    if fresh:
+        print(f"Using cached BIDS index in {cache_dir}")
+    else:
+        print(f"Indexing {bids_dataset}, caching the index in {cache_dir}")
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        # drop the old signature first so an interrupted index is never trusted
+        signature_path.unlink(missing_ok=True)
+
+    layout = bids.BIDSLayout(
+        str(bids_dataset), database_path=str(cache_dir), reset_database=not fresh
+    )
+
+    if not fresh:
+        with open(signature_path, "w") as outfile:
+            json.dump(signature, outfile, indent=4)
+
+    return layout
@@ -1,25 +1,73 @@
-import bids
 import pathlib
 import os
-import pandas
 import json
+import sys
 from argparse import ArgumentParser
-from math import floor
+
+if __package__ in (None, ""):
+    # run as `python utilities/lookup.py`: make the utilities package importable
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utilities.aiofs import parse_io_limit
+from utilities.layout_cache import (
+    BACKENDS,
+    default_cache_dir,
+    load_layout,
+    subject_signatures,
+)
+from utilities.profiling import add_profile_arguments, profiling, stage
+
+# columns identifying a row of lookup.csv when merging an update into it
+LOOKUP_KEY = ["bids_subject_session", "datatype"]
+
+
+def lookup_csv_path(destination_path="") -> pathlib.Path:
+    """lookup.csv itself, or lookup.csv inside the destination folder."""
+    if not destination_path:
+        return pathlib.Path("lookup.csv")
+    dest_path = pathlib.Path(destination_path)
+    if dest_path.suffix.lower() == ".csv":
+        return dest_path
+    return dest_path / "lookup.csv"
+
+
+def signatures_path(lookup_path) -> pathlib.Path:
+    """
+    Where the subject folder signatures of a lookup.csv are kept, e.g.
+    lookup.subjects.tsv (not JSON: prepare.py reads every JSON in the
+    destination as a file-mapper JSON).
+    """
+    lookup_path = pathlib.Path(lookup_path)
+    return lookup_path.with_name(lookup_path.stem + ".subjects.tsv")
 
 
 class LookUpTable:
-    def __init__(self, bids_dataset: str, destination_path=""):
+    def __init__(
+        self,
+        bids_dataset: str,
+        destination_path="",
+        layout_cache=None,
+        reindex=False,
+        backend="pybids",
+        subjects=None,
+        io_limits=None,
+    ):
+        # pandas is imported here rather than at module level to keep CLI startup fast
+        import pandas
+
         self.path_to_bids_dataset = str(bids_dataset)
-        self.bids_layout = bids.BIDSLayout(self.path_to_bids_dataset)
-        if not destination_path:
-            self.destination_path = "lookup.csv"
-        else:
-            dest_path = pathlib.Path(destination_path) 
-            if dest_path.suffix.lower() == '.csv':
-                self.destination_path = dest_path
-            else:
-                self.destination_path = pathlib.Path(destination_path) / "lookup.csv"
-        
+        # only these subject labels (without "sub-") go in the table, all when None
+        self.subjects = subjects
+        self.bids_layout = load_layout(
+            self.path_to_bids_dataset,
+            layout_cache,
+            reindex,
+            backend,
+            subjects,
+            io_limits,
+        )
+        self.destination_path = lookup_csv_path(destination_path)
+
         self.participants_tsv = pandas.DataFrame()
         self.participants_json = None
         self.subject_list = self.bids_layout.get_subjects()
@@ -27,6 +75,9 @@ class LookUpTable:
         self.lookup_table = pandas.DataFrame()
 
     def create_lookup_table(self):
+        import numpy
+        import pandas
+
         # check for a participants.tsv and .json
         if self.bids_layout.get(suffix="participants", extension="tsv"):
             try:
@@ -80,33 +131,50 @@ class LookUpTable:
             )
             self.participants_json["sex"] = self.participants_json.pop(gender_col)
 
-        # create a subject/session list
-        for s in self.subject_list:
-            for entities in self.bids_layout.get(subject=s):
-                ents = entities.get_entities()
-                bids_subject_session = "sub-" + ents.get("subject")
-                if ents.get("session"):
-                    bids_subject_session += f'_ses-{ents.get("session")}'
-
-                info = {
-                    "bids_subject_session": bids_subject_session,
-                    "subjectkey": "",
-                    "src_subject_id": f"sub-{s}",
-                    "interview_date": "",
-                    "interview_age": floor(
-                        age_multiplier * float(self.participants_tsv["age"][f"sub-{s}"])
-                    ),
-                    "sex": self.participants_tsv["sex"][f"sub-{s}"],
-                    "datatype": ents.get("datatype", ""),
-                }
-                # We're ignoring folders that don't have a datatype for now as their
-                # contents are covered by folders that do have a datatype
-                if info.get("datatype"):
-                    self.subject_session_list.append(info)
+        # one tabular query over the whole layout instead of a get() per subject,
+        # collapsed to one row per subject/session/datatype
+        files = self.bids_layout.to_df(metadata=False).reindex(
+            columns=["subject", "session", "datatype"]
+        )
+        # We're ignoring folders that don't have a datatype for now as their
+        # contents are covered by folders that do have a datatype
+        files = files.dropna(subset=["subject", "datatype"])
+        if self.subjects is not None:
+            files = files[files["subject"].isin(self.subjects)]
+        files = files[files["datatype"] != ""]
+        groups = (
+            files.groupby(["subject", "session", "datatype"], dropna=False, sort=True)
+            .size()
+            .reset_index()
+        )
 
-        self.lookup_table = pandas.DataFrame(self.subject_session_list)
+        src_subject_id = "sub-" + groups["subject"].astype(str)
+        session_suffix = ("_ses-" + groups["session"].astype(str)).where(
+            groups["session"].notna() & (groups["session"] != ""), ""
+        )
+
+        # vectorized join with participants.tsv; a subject missing from it is a KeyError
+        participants = self.participants_tsv.loc[
+            src_subject_id.unique(), ["age", "sex"]
+        ]
+        ages = participants["age"].astype(float)
+
+        self.lookup_table = pandas.DataFrame(
+            {
+                "bids_subject_session": src_subject_id + session_suffix,
+                "subjectkey": "",
+                "src_subject_id": src_subject_id,
+                "interview_date": "",
+                "interview_age": numpy.floor(
+                    age_multiplier * src_subject_id.map(ages)
+                ).astype(int),
+                "sex": src_subject_id.map(participants["sex"]),
+                "datatype": groups["datatype"].astype(str),
+            }
+        )
+        self.subject_session_list = self.lookup_table.to_dict("records")
 
-        return self.lookup_table.drop_duplicates(inplace=True)
+        return self.lookup_table
 
     def write_lookup_table(self):
         if self.lookup_table.empty:
@@ -116,11 +184,107 @@ class LookUpTable:
         self.lookup_table.to_csv(
             self.destination_path, sep=",", na_rep="n/a", index=False
         )
+        write_signatures(
+            self.destination_path, subject_signatures(self.path_to_bids_dataset)
+        )
         return self.destination_path
 
 
+def write_signatures(lookup_path, signatures):
+    """Record the state of every subject folder so update_lookup_table can skip unchanged ones."""
+    with open(signatures_path(lookup_path), "w") as outfile:
+        for subject in sorted(signatures):
+            outfile.write(f"{subject}\t{signatures[subject]}\n")
+
+
+def merge_lookup_tables(existing, scanned, subjects):
+    """
+    Merge freshly scanned rows for the given subjects into an existing lookup
+    table.  Existing rows are kept as they are, with every edited field; rows
+    of rescanned subjects whose subject/session/datatype is gone are dropped
+    and new rows are appended, inheriting the subject's GUID when one was entered.
+    """
+    import pandas
+
+    scanned = scanned.astype(object).where(scanned.notna(), "n/a").astype(str)
+    key = [column for column in LOOKUP_KEY if column in existing.columns]
+
+    rescanned = existing["src_subject_id"].isin(["sub-" + s for s in subjects])
+    scanned_keys = pandas.MultiIndex.from_frame(scanned[key])
+    existing_keys = pandas.MultiIndex.from_frame(existing[key])
+    keep = ~rescanned | existing_keys.isin(scanned_keys)
+    new = scanned[~scanned_keys.isin(existing_keys)].copy()
+
+    guids = existing[existing["subjectkey"] != ""].groupby("src_subject_id")["subjectkey"].first()
+    new["subjectkey"] = new["src_subject_id"].map(guids).fillna(new["subjectkey"])
+
+    removed = len(existing) - int(keep.sum())
+    print(f"Adding {len(new)} rows, removing {removed} rows of {len(subjects)} rescanned subjects.")
+    return pandas.concat([existing[keep], new], ignore_index=True).fillna("")
+
+
+def update_lookup_table(
+    bids_dataset,
+    destination_path="",
+    layout_cache=None,
+    reindex=False,
+    backend="pybids",
+    io_limits=None,
+):
+    """
+    Bring an existing lookup.csv up to date without regenerating it: only
+    subject folders that are not in it yet, or whose directories changed
+    since it was written, are scanned and merged in (see merge_lookup_tables).
+    Without an existing lookup.csv a new one is written.
+    """
+    import pandas
+
+    lookup_path = lookup_csv_path(destination_path)
+    if not lookup_path.is_file():
+        return LookUpTable(
+            bids_dataset, destination_path, layout_cache, reindex, backend, io_limits=io_limits
+        ).write_lookup_table()
+
+    existing = pandas.read_csv(lookup_path, dtype=str, keep_default_na=False)
+    current = subject_signatures(bids_dataset)
+    try:
+        with open(signatures_path(lookup_path), "r") as infile:
+            recorded = dict(line.rstrip("\n").split("\t", 1) for line in infile if line.strip())
+    except FileNotFoundError:
+        # a lookup.csv from before signatures were kept: trust the subjects it has
+        known = set(existing["src_subject_id"])
+        recorded = {s: sig for s, sig in current.items() if "sub-" + s in known}
+
+    changed = sorted(s for s, signature in current.items() if recorded.get(s) != signature)
+    if not changed:
+        print(f"{lookup_path} is up to date.")
+    else:
+        print(f"Scanning {len(changed)} new or changed subjects: " + ", ".join(changed))
+        scanned = LookUpTable(
+            bids_dataset,
+            lookup_path,
+            layout_cache,
+            reindex,
+            backend,
+            subjects=changed,
+            io_limits=io_limits,
+        ).create_lookup_table()
+        merged = merge_lookup_tables(existing, scanned, changed)
+        merged.to_csv(lookup_path, sep=",", na_rep="n/a", index=False)
+    write_signatures(lookup_path, current)
+    return lookup_path
+
+
 def cli():
-    parser = ArgumentParser()
+    # `nda-lookup attach ...` fills an existing lookup.csv from external tables
+    if sys.argv[1:2] == ["attach"]:
+        from utilities.lookup_attach import cli as attach_cli
+
+        return attach_cli(sys.argv[2:])
+
+    parser = ArgumentParser(
+        epilog="Run `nda-lookup attach --help` to fill GUIDs and interview dates from CSV/TSV tables."
+    )
     parser.add_argument("bids_dataset", 
     help="Path to BIDS dataset", 
     type=pathlib.Path)
@@ -135,17 +299,78 @@ def cli():
         default=False,
         help="Add interview dates and GUID's to lookup csv now",
     )
-    args = parser.parse_args()
-    lookup_table = LookUpTable(
-        str(args.bids_dataset), destination_path=str(args.destination_path)
+    parser.add_argument(
+        "--page-size",
+        type=int,
+        default=50,
+        help="Rows per page in the --edit-now editor (default 50)",
+    )
+    parser.add_argument(
+        "--update",
+        action="store_true",
+        default=False,
+        help="Merge new or changed subjects into an existing lookup.csv, keeping entered GUIDs and dates",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=BACKENDS,
+        default="scandir",
+        help="How to read the BIDS dataset: scandir (fast path scan, default) or pybids (full index)",
     )
-    df = lookup_table.create_lookup_table()
-    lookup_table_path = lookup_table.write_lookup_table()
+    parser.add_argument(
+        "--no-layout-cache",
+        action="store_true",
+        default=False,
+        help="With the pybids backend, index without reading or writing the shared index cache",
+    )
+    parser.add_argument(
+        "--reindex",
+        action="store_true",
+        default=False,
+        help="With the pybids backend, rebuild the shared index cache even if the dataset looks unchanged",
+    )
+    parser.add_argument(
+        "--io-limit",
+        type=parse_io_limit,
+        action="append",
+        default=[],
+        metavar="[PATH=]N",
+        help="With the scandir backend, list at most N folders at once (default 16), or N under PATH; repeatable per filesystem",
+    )
+    add_profile_arguments(parser, "destination_path")
+    args = parser.parse_args()
+    layout_cache = None
+    if not args.no_layout_cache:
+        layout_cache = default_cache_dir(args.bids_dataset, args.destination_path)
+    with profiling(args.profile, args.destination_path, "lookup", args.profile_memory):
+        if args.update:
+            lookup_table_path = update_lookup_table(
+                str(args.bids_dataset),
+                destination_path=str(args.destination_path),
+                layout_cache=layout_cache,
+                reindex=args.reindex,
+                backend=args.backend,
+                io_limits=dict(args.io_limit),
+            )
+        else:
+            with stage("layout"):
+                lookup_table = LookUpTable(
+                    str(args.bids_dataset),
+                    destination_path=str(args.destination_path),
+                    layout_cache=layout_cache,
+                    reindex=args.reindex,
+                    backend=args.backend,
+                    io_limits=dict(args.io_limit),
+                )
+            with stage("lookup-table"):
+                df = lookup_table.create_lookup_table()
+            with stage("write"):
+                lookup_table_path = lookup_table.write_lookup_table()
 
     if args.edit_now:
         from utilities.lookup_editor import run_lookup_editor
 
-        run_lookup_editor(pathlib.Path(lookup_table_path))
+        run_lookup_editor(pathlib.Path(lookup_table_path), page_size=args.page_size)
 
 
 if __name__ == "__main__":
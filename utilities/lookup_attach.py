@@ -0,0 +1,242 @@
+"""
+Bulk-fill lookup.csv columns (subjectkey, interview_date, ...) from external tables.
+
+    nda-lookup attach <lookup.csv> <table> [<table> ...] [--on KEY] [--column COLUMN]
+
+Every table is a CSV or TSV, e.g. a GUID tool export, or a BIDS
+sub-<x>[_ses-<y>]_scans.tsv whose earliest acq_time becomes the
+interview_date of that subject/session.  Rows are matched on the --on key
+columns (src_subject_id by default) with one join per table, and the
+--column columns (subjectkey and interview_date by default) are filled
+where lookup.csv is still empty.
+
+Key and value columns are given as LOOKUP_COLUMN[=TABLE_COLUMN[,TABLE_COLUMN...]]
+when a table names them differently, e.g. --on src_subject_id=participant_id
+--column subjectkey=GUID,guid.  A value that differs from one already in
+lookup.csv, or a key with several different values in the tables, is a
+conflict: it is reported and left alone (--overwrite replaces existing
+values instead).  Lookup rows no table matched and table rows that match
+no lookup row are reported as unmatched.
+"""
+import os
+import pathlib
+import re
+from argparse import ArgumentParser
+
+DEFAULT_KEYS = ["src_subject_id"]
+DEFAULT_COLUMNS = ["subjectkey", "interview_date"]
+
+# what counts as not filled in yet in lookup.csv
+EMPTY_VALUES = {"", "n/a", "nan"}
+
+SCANS_TSV = re.compile(r"^(sub-[a-zA-Z0-9]+(?:_ses-[a-zA-Z0-9]+)?)_scans\.tsv$")
+
+
+def parse_column_spec(spec):
+    """"subjectkey=GUID,guid" -> ("subjectkey", ["GUID", "guid", "subjectkey"])."""
+    column, _, aliases = spec.partition("=")
+    names = [name.strip() for name in aliases.split(",") if name.strip()]
+    return column.strip(), names + [column.strip()]
+
+
+def format_interview_dates(values):
+    """Dates in any format pandas understands as MM/DD/YYYY, anything else unchanged."""
+    import pandas
+
+    parsed = pandas.to_datetime(values, errors="coerce", format="mixed")
+    return parsed.dt.strftime("%m/%d/%Y").where(parsed.notna(), values)
+
+
+def read_table(path):
+    """A CSV or TSV as strings; a BIDS scans.tsv becomes one interview_date per subject/session."""
+    import pandas
+
+    path = pathlib.Path(path)
+    sep = "\t" if path.suffix.lower() == ".tsv" else ","
+    table = pandas.read_csv(path, sep=sep, dtype=str, keep_default_na=False)
+
+    match = SCANS_TSV.match(path.name)
+    if match and "acq_time" in table.columns:
+        acquired = pandas.to_datetime(table["acq_time"], errors="coerce").dropna()
+        if acquired.empty:
+            return pandas.DataFrame(columns=["bids_subject_session", "src_subject_id"])
+        sub_ses = match.group(1)
+        return pandas.DataFrame(
+            {
+                "bids_subject_session": [sub_ses],
+                "src_subject_id": [sub_ses.split("_")[0]],
+                "interview_date": [acquired.min().strftime("%m/%d/%Y")],
+            }
+        )
+    return table
+
+
+def attach_tables(
+    lookup_path,
+    tables,
+    keys=DEFAULT_KEYS,
+    columns=DEFAULT_COLUMNS,
+    overwrite=False,
+    output_path=None,
+):
+    """
+    Fill lookup.csv from the tables and write the result to output_path (the
+    lookup itself by default).  keys and columns are LOOKUP_COLUMN[=TABLE_COLUMN,...]
+    specs.  Returns (filled, conflicts, unmatched): the number of cells
+    filled, and data frames of the conflicts and unmatched rows.
+    """
+    import pandas
+
+    lookup = pandas.read_csv(lookup_path, dtype=str, keep_default_na=False)
+    keys = [parse_column_spec(spec) for spec in keys]
+    columns = [parse_column_spec(spec) for spec in columns]
+    key_names = [key for key, _ in keys]
+    for key in key_names:
+        if key not in lookup.columns:
+            raise ValueError(f"Key column {key} is not in {lookup_path}")
+    for column, _ in columns:
+        if column not in lookup.columns:
+            lookup[column] = ""
+
+    # gather (keys, column, value) from every table in one long frame
+    values = []
+    unmatched = []
+    for table_path in tables:
+        table = read_table(table_path)
+        renamed = {}
+        for lookup_column, names in keys + columns:
+            found = next((name for name in names if name in table.columns), None)
+            if found is not None:
+                renamed[found] = lookup_column
+        table = table.rename(columns=renamed)
+        missing = [key for key in key_names if key not in table.columns]
+        present = [column for column, _ in columns if column in table.columns]
+        if missing or not present:
+            print(f"Skipping {table_path}: no {', '.join(missing) or 'value'} columns")
+            continue
+
+        table = table[key_names + present]
+        known = table.set_index(key_names).index.isin(lookup.set_index(key_names).index)
+        if (~known).any():
+            unmatched.append(table.loc[~known, key_names].assign(source=str(table_path)))
+        long = table[known].melt(id_vars=key_names, var_name="column", value_name="value")
+        long["value"] = long["value"].str.strip()
+        long = long[~long["value"].str.lower().isin(EMPTY_VALUES)]
+        values.append(long.assign(source=str(table_path)))
+
+    conflict_columns = key_names + ["column", "lookup_value", "table_value", "source"]
+    if values:
+        values = pandas.concat(values, ignore_index=True)
+        dates = values["column"] == "interview_date"
+        values.loc[dates, "value"] = format_interview_dates(values.loc[dates, "value"])
+    else:
+        values = pandas.DataFrame(columns=key_names + ["column", "value", "source"])
+
+    # a key that gets different values from the tables is ambiguous, drop it
+    distinct = values.drop_duplicates(key_names + ["column", "value"])
+    ambiguous = distinct.duplicated(key_names + ["column"], keep=False)
+    conflicts = [
+        distinct[ambiguous]
+        .rename(columns={"value": "table_value"})
+        .assign(lookup_value="")
+        .reindex(columns=conflict_columns)
+    ]
+    values = distinct[~ambiguous]
+
+    # one join per column against the whole lookup
+    filled = 0
+    for column, _ in columns:
+        incoming = values.loc[values["column"] == column, key_names + ["value", "source"]]
+        merged = lookup[key_names + [column]].merge(incoming, on=key_names, how="left")
+        has_value = merged["value"].notna().to_numpy()
+        empty = merged[column].str.strip().str.lower().isin(EMPTY_VALUES).to_numpy()
+        differs = has_value & ~empty & (merged[column] != merged["value"]).to_numpy()
+
+        conflicts.append(
+            merged[differs]
+            .rename(columns={column: "lookup_value", "value": "table_value"})
+            .assign(column=column)
+            .reindex(columns=conflict_columns)
+        )
+        replace = has_value & (empty | (overwrite & differs))
+        lookup.loc[replace, column] = merged.loc[replace, "value"].to_numpy()
+        filled += int(replace.sum())
+
+    conflicts = pandas.concat(conflicts, ignore_index=True)
+
+    matched_keys = values.set_index(key_names).index.unique()
+    unmatched_lookup = lookup.loc[
+        ~lookup.set_index(key_names).index.isin(matched_keys), key_names
+    ].assign(source=str(lookup_path))
+    unmatched = pandas.concat(unmatched + [unmatched_lookup], ignore_index=True)
+    unmatched = unmatched.drop_duplicates()
+
+    output_path = output_path or lookup_path
+    lookup.to_csv(output_path, sep=",", index=False)
+    return filled, conflicts, unmatched
+
+
+def cli(argv=None):
+    parser = ArgumentParser(
+        prog="nda-lookup attach",
+        description="Fill lookup.csv columns such as subjectkey and interview_date from CSV/TSV tables.",
+    )
+    parser.add_argument("lookup_csv", type=pathlib.Path, help="Path to lookup.csv")
+    parser.add_argument(
+        "tables",
+        nargs="+",
+        type=pathlib.Path,
+        help="CSV/TSV tables to take values from, e.g. a GUID tool export or BIDS *_scans.tsv files",
+    )
+    parser.add_argument(
+        "--on",
+        action="append",
+        metavar="KEY[=TABLE_COLUMN,...]",
+        help="Key column to match rows on, repeat for several (default src_subject_id)",
+    )
+    parser.add_argument(
+        "--column",
+        action="append",
+        metavar="COLUMN[=TABLE_COLUMN,...]",
+        help="Column to fill, repeat for several (default subjectkey and interview_date)",
+    )
+    parser.add_argument(
+        "--overwrite",
+        action="store_true",
+        default=False,
+        help="Replace values already in lookup.csv when a table disagrees with them",
+    )
+    parser.add_argument(
+        "--output", type=pathlib.Path, default=None, help="Write here instead of updating lookup.csv"
+    )
+    parser.add_argument(
+        "--report",
+        type=pathlib.Path,
+        default=None,
+        help="Directory for attach_conflicts.tsv and attach_unmatched.tsv (default: next to the output)",
+    )
+    args = parser.parse_args(argv)
+
+    filled, conflicts, unmatched = attach_tables(
+        args.lookup_csv,
+        args.tables,
+        keys=args.on or DEFAULT_KEYS,
+        columns=args.column or DEFAULT_COLUMNS,
+        overwrite=args.overwrite,
+        output_path=args.output,
+    )
+    output = args.output or args.lookup_csv
+    print(f"Filled {filled} cells in {output}.")
+
+    report_dir = args.report or pathlib.Path(output).parent
+    os.makedirs(report_dir, exist_ok=True)
+    for name, frame, what in (
+        ("attach_conflicts.tsv", conflicts, "conflicting values"),
+        ("attach_unmatched.tsv", unmatched, "unmatched rows"),
+    ):
+        path = pathlib.Path(report_dir) / name
+        if frame.empty:
+            path.unlink(missing_ok=True)
+            continue
+        frame.to_csv(path, sep="\t", index=False)
+        print(f"{len(frame)} {what}, see {path}")
@@ -3,12 +3,23 @@ Simple Toga editor for the lookup CSV.
 Table layout: first row = column names, then one row per record with editable cells.
 Text fields for most columns; number input for numeric columns (e.g. interview_age).
 Loads the file written by LookUpTable.write_lookup_table(); Save writes back the full CSV.
+
+Only one page of rows has widgets: the same cells are refilled when paging or
+searching, so large lookups open as quickly as small ones.  Loading and saving
+run in a worker thread so the window stays responsive.
 """
+import asyncio
 import pathlib
 
-import pandas
 import toga
 
+from utilities.lookup_pages import (
+    DEFAULT_PAGE_SIZE,
+    LookupPages,
+    load_lookup_csv,
+    save_lookup_csv,
+)
+
 
 # Columns that should use NumberInput; everything else is TextInput
 NUMERIC_COLUMNS = {"interview_age"}
@@ -22,15 +33,17 @@ SUBJECT_LIKE_COLUMNS = {"bids_subject_session", "src_subject_id", "subjectkey"}
 PIXELS_PER_CHAR = 10
 
 
-def run_lookup_editor(csv_path: pathlib.Path) -> None:
+def run_lookup_editor(csv_path: pathlib.Path, page_size: int = DEFAULT_PAGE_SIZE) -> None:
     """Run the Toga app that opens and edits the given lookup CSV. Blocks until the window is closed."""
-    app = LookupEditorApp(str(csv_path))
+    app = LookupEditorApp(str(csv_path), page_size=page_size)
     app.main_loop()
 
 
 class LookupEditorApp(toga.App):
-    def __init__(self, csv_path: str, **kwargs):
+    def __init__(self, csv_path: str, page_size: int = DEFAULT_PAGE_SIZE, **kwargs):
         self.csv_path = pathlib.Path(csv_path)
+        self.page_size = page_size
+        self.pages = None
         super().__init__("Lookup CSV Editor", "org.ndabids.lookup_editor", **kwargs)
 
     def startup(self):
@@ -39,76 +52,60 @@ class LookupEditorApp(toga.App):
         # Resolve ~ and any relative path so we read/write the actual file
         self.csv_path = self.csv_path.expanduser().resolve()
 
+        self.status = toga.Label(f"Loading {self.csv_path} ...", margin=5)
+        self.main_window.content = toga.Box(
+            children=[self.status], direction="column", margin=10
+        )
+        self.main_window.show()
+        self.loop.create_task(self._load())
+
+    async def _load(self):
         try:
-            df = pandas.read_csv(self.csv_path)
+            columns, rows = await asyncio.to_thread(load_lookup_csv, self.csv_path)
         except Exception as e:
-            self.main_window.content = toga.Box(
-                children=[toga.Label(f"Cannot load CSV: {e}", margin=10)],
-                direction="column",
-                margin=10,
-            )
-            self.main_window.show()
+            self.status.text = f"Cannot load CSV: {e}"
             return
 
-        columns = list(df.columns)
-        df = df.fillna("")
-
-        # Calculate minimum width for each column based on longest entry
-        # Include column name in the max calculation
-        column_widths = {}
-        for col in columns:
-            max_length = len(col)
-            for _, row in df.iterrows():
-                val = row[col]
-                if not pandas.isna(val) and val != "":
-                    val_str = str(val).strip()
-                    max_length = max(max_length, len(val_str))
-            # Convert to pixels with minimum; subject-like columns get a higher floor
-            min_w = MIN_WIDTH_SUBJECT_COLUMNS if col in SUBJECT_LIKE_COLUMNS else MIN_COLUMN_WIDTH
-            column_widths[col] = max(min_w, max_length * PIXELS_PER_CHAR)
+        self.pages = LookupPages(columns, rows, self.page_size)
+        column_widths = await asyncio.to_thread(
+            self.pages.column_widths,
+            PIXELS_PER_CHAR,
+            MIN_COLUMN_WIDTH,
+            SUBJECT_LIKE_COLUMNS,
+            MIN_WIDTH_SUBJECT_COLUMNS,
+        )
+        self._build_table(column_widths)
+        self._show_page()
 
+    def _build_table(self, column_widths):
         # Build table as a ROW of COLUMNS (not row-by-row). Each column is one fixed-width Box
         # so Cocoa applies width to every column, not just the first.
-        self.columns = columns
-        num_rows = len(df)
+        # Cells are created for one page only; cell_rows[i] shows pages.visible()[i].
+        columns = self.pages.columns
+        num_rows = min(self.pages.page_size, len(self.pages.rows))
         self.cell_rows = [{} for _ in range(num_rows)]
-        self._initial_values = [{} for _ in range(num_rows)]
+        self.shown_rows = []
         column_boxes = []
 
         for col in columns:
-            # Header for this column
             header_label = toga.Label(col, margin=3, flex=1)
             col_cell_widgets = []
-            # One cell per data row
-            for row_idx, (_, row) in enumerate(df.iterrows()):
-                raw = row[col]
-                if pandas.isna(raw) or raw == "" or raw is None:
-                    cell_val = ""
-                else:
-                    cell_val = str(raw).strip()
-
+            for row_idx in range(num_rows):
                 if col in NUMERIC_COLUMNS:
-                    try:
-                        default_num = int(float(cell_val)) if cell_val else None
-                    except (TypeError, ValueError):
-                        default_num = None
-                    w = toga.NumberInput(value=default_num, margin=3, flex=1)
-                    self.cell_rows[row_idx][col] = w
-                    self._initial_values[row_idx][col] = default_num
+                    w = toga.NumberInput(value=None, margin=3, flex=1)
                 else:
-                    default_text = cell_val if isinstance(cell_val, str) else str(cell_val)
                     w = toga.TextInput(value="", margin=3, flex=1)
-                    self.cell_rows[row_idx][col] = w
-                    self._initial_values[row_idx][col] = default_text
+                self.cell_rows[row_idx][col] = w
                 col_cell_widgets.append(w)
-            # One column = one fixed-width Box with header + all cells
-            column_box = toga.Box(
-                children=[header_label] + col_cell_widgets,
-                direction="column",
-                width=column_widths[col],
-                margin=3,
+            # One column = one fixed-width Box with header + one page of cells
+            column_boxes.append(
+                toga.Box(
+                    children=[header_label] + col_cell_widgets,
+                    direction="column",
+                    width=column_widths[col],
+                    margin=3,
+                )
             )
-            column_boxes.append(column_box)
 
         # Force row to explicit total width so Pack allocates each column its width (Cocoa fix).
         total_table_width = sum(column_widths[col] for col in columns) + (len(columns) * 6)  # 3px margin each side per col
@@ -119,51 +116,88 @@ class LookupEditorApp(toga.App):
             width=total_table_width,
         )
 
-        async def save_handler(widget, **kwargs):
-            rows = []
-            for row_widgets_by_col in self.cell_rows:
-                out_row = {}
-                for col in self.columns:
-                    w = row_widgets_by_col[col]
-                    if isinstance(w, toga.NumberInput):
-                        v = w.value
-                        out_row[col] = int(v) if v is not None and not pandas.isna(v) else ""
-                    else:
-                        out_row[col] = (w.value or "")
-                rows.append(out_row)
-            out = pandas.DataFrame(rows, columns=self.columns)
-            out.to_csv(self.csv_path, sep=",", na_rep="n/a", index=False)
-            await self.main_window.dialog(toga.InfoDialog("Saved", f"Saved to {self.csv_path}"))
-
-        save_btn = toga.Button("Save", on_press=save_handler, margin=5)
-
+        self.search_input = toga.TextInput(
+            placeholder="Search, or column:text (e.g. subjectkey: for missing GUIDs)",
+            on_confirm=self._on_search,
+            margin=5,
+            flex=1,
+        )
+        self.page_label = toga.Label("", margin=5)
         top_bar = toga.Box(
             children=[
                 toga.Label(f"Editing: {self.csv_path}", margin=5),
-                save_btn,
+                toga.Button("Save", on_press=self._on_save, margin=5),
+            ],
+            direction="row",
+            margin=5,
+        )
+        nav_bar = toga.Box(
+            children=[
+                self.search_input,
+                toga.Button("Search", on_press=self._on_search, margin=5),
+                toga.Button("<", on_press=lambda widget: self._turn_page(-1), margin=5),
+                self.page_label,
+                toga.Button(">", on_press=lambda widget: self._turn_page(1), margin=5),
             ],
             direction="row",
             margin=5,
         )
 
         content = toga.Box(
-            children=[top_bar, table_content],
+            children=[top_bar, nav_bar, self.status, table_content],
             direction="column",
             margin=10,
         )
-        scroll = toga.ScrollContainer(content=content)
-        self.main_window.content = scroll
-        self.main_window.show()
-        # Set initial values after window is shown so native controls have correct content
-        self._apply_initial_values()
-
-    def _apply_initial_values(self) -> None:
-        """Set each cell widget's value from the loaded CSV. Call after window is shown."""
-        for row_widgets_by_col, initial_vals in zip(self.cell_rows, self._initial_values):
-            for col in self.columns:
-                w = row_widgets_by_col[col]
-                val = initial_vals.get(col, "")
+        self.main_window.content = toga.ScrollContainer(content=content)
+        self.status.text = ""
+
+    def _store_page(self) -> None:
+        """Copy the cells back into the rows they are showing."""
+        for widgets, row_index in zip(self.cell_rows, self.shown_rows):
+            for col in self.pages.columns:
+                v = widgets[col].value
+                if isinstance(widgets[col], toga.NumberInput):
+                    v = int(v) if v is not None else ""
+                self.pages.set_value(row_index, col, v)
+
+    def _show_page(self) -> None:
+        """Fill the cells with the current page; cells past the last row are cleared and disabled."""
+        self.shown_rows = self.pages.visible()
+        for i, widgets in enumerate(self.cell_rows):
+            row = self.pages.rows[self.shown_rows[i]] if i < len(self.shown_rows) else None
+            for col, w in widgets.items():
+                val = row[col] if row else ""
                 if isinstance(w, toga.NumberInput):
-                    w.value = val if val is not None else None
+                    try:
+                        w.value = int(float(val)) if val else None
+                    except (TypeError, ValueError):
+                        w.value = None
                 else:
-                    w.value = str(val) if val != "" else ""
+                    w.value = val
+                w.enabled = row is not None
+        self.page_label.text = (
+            f"Page {self.pages.page + 1} of {self.pages.page_count} "
+            f"({len(self.pages.matches)} of {len(self.pages.rows)} rows)"
+        )
+
+    def _turn_page(self, step) -> None:
+        self._store_page()
+        self.pages.go_to(self.pages.page + step)
+        self._show_page()
+
+    def _on_search(self, widget, **kwargs) -> None:
+        self._store_page()
+        self.pages.search(self.search_input.value or "")
+        self._show_page()
+
+    async def _on_save(self, widget, **kwargs):
+        if self.pages is None:
+            return
+        self._store_page()
+        columns = list(self.pages.columns)
+        rows = [dict(row) for row in self.pages.rows]
+        self.status.text = f"Saving {self.csv_path} ..."
+        await asyncio.to_thread(save_lookup_csv, self.csv_path, columns, rows)
+        self.pages.modified = False
+        self.status.text = ""
+        await self.main_window.dialog(toga.InfoDialog("Saved", f"Saved to {self.csv_path}"))
@@ -0,0 +1,105 @@
+"""
+Paged, searchable view of a lookup CSV for the lookup editor.
+
+The editor only builds widgets for one page of rows and shows the rows of
+a LookupPages page in them, so opening a lookup with tens of thousands of
+rows costs the same as opening a small one.  Loading and saving use the csv
+module and touch no widgets, so the editor can run them in a worker thread.
+"""
+import csv
+import math
+import os
+
+DEFAULT_PAGE_SIZE = 50
+
+
+def load_lookup_csv(csv_path):
+    """(columns, rows) of a lookup CSV, every value a stripped string."""
+    with open(csv_path, "r", newline="") as f:
+        reader = csv.DictReader(f)
+        columns = list(reader.fieldnames or [])
+        rows = [
+            {column: (row.get(column) or "").strip() for column in columns}
+            for row in reader
+        ]
+    return columns, rows
+
+
+def save_lookup_csv(csv_path, columns, rows):
+    """Write the rows back, replacing the file only once it is completely written."""
+    tmp_path = str(csv_path) + ".tmp"
+    with open(tmp_path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=columns, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(rows)
+    os.replace(tmp_path, csv_path)
+
+
+class LookupPages:
+    def __init__(self, columns, rows, page_size=DEFAULT_PAGE_SIZE):
+        self.columns = columns
+        self.rows = rows
+        self.page_size = max(1, page_size)
+        self.query = ""
+        # indices into rows that match the current search, in file order
+        self.matches = list(range(len(rows)))
+        self.page = 0
+        self.modified = False
+
+    def search(self, query):
+        """
+        Keep only rows containing query (case-insensitive) in any column, or in
+        one column with "column:text", e.g. "src_subject_id:sub-0042" jumps to
+        one subject and "subjectkey:" lists the rows still missing a GUID.  An
+        empty query shows every row.  Goes back to the first page.
+        """
+        self.query = query.strip()
+        column, colon, text = self.query.partition(":")
+        text = text.strip().lower()
+        if colon and column in self.columns:
+            if text:
+                self.matches = [
+                    i for i, row in enumerate(self.rows) if text in row[column].lower()
+                ]
+            else:
+                self.matches = [i for i, row in enumerate(self.rows) if not row[column]]
+        elif self.query:
+            text = self.query.lower()
+            self.matches = [
+                i
+                for i, row in enumerate(self.rows)
+                if any(text in row[c].lower() for c in self.columns)
+            ]
+        else:
+            self.matches = list(range(len(self.rows)))
+        self.page = 0
+        return len(self.matches)
+
+    @property
+    def page_count(self):
+        return max(1, math.ceil(len(self.matches) / self.page_size))
+
+    def go_to(self, page):
+        """Show page (clamped to the existing pages), returns the page shown."""
+        self.page = min(max(0, page), self.page_count - 1)
+        return self.page
+
+    def visible(self):
+        """Indices into rows of the rows on the current page."""
+        start = self.page * self.page_size
+        return self.matches[start : start + self.page_size]
+
+    def set_value(self, row_index, column, value):
+        value = "" if value is None else str(value).strip()
+        if self.rows[row_index][column] != value:
+            self.rows[row_index][column] = value
+            self.modified = True
+
+    def column_widths(self, pixels_per_char, minimum, wider=(), wider_minimum=0):
+        """Pixel width of every column from its longest value (and its name)."""
+        widths = {}
+        for column in self.columns:
+            longest = max([len(column)] + [len(row[column]) for row in self.rows])
+            floor = wider_minimum if column in wider else minimum
+            widths[column] = max(floor, longest * pixels_per_char)
+        return widths
@@ -0,0 +1,158 @@
+"""
+NDA manifests built from a shared store of file digests.
+
+A prepared child folder's manifest lists every file under it with its size
+and md5sum:
+
+    {"files": [{"path": "sub-NDAR.../anat/...nii.gz", "name": "...nii.gz", "size": 123, "md5sum": "..."}]}
+
+Checksumming means reading every file in full, which for large sourcedata
+archives costs as much as writing them.  Tools that write files anyway
+(dicom2targz hashes each archive as it streams it to disk) record the
+digest in a DigestStore, a tab-separated file of
+
+    realpath<TAB>size<TAB>mtime_ns<TAB>md5sum
+
+create_manifest() trusts a stored digest while the file's size and mtime
+are unchanged and only reads the files it has no valid digest for, adding
+those to the store so the next manifest of the same files is free as well.
+Apart from where the digests come from, its output is that of
+nda_manifests.Manifest.create_from_dir(), which it replaces: entries in
+os.walk() order, symlinked folders not descended into, and paths relative
+to the folder with a leading "./", which records.py strips as before.
+New digests are buffered and appended in one write per manifest (or per
+flush()).  Several processes append to the same store at once, e.g. the
+prepare stages nda-pipeline runs concurrently and --shard array jobs: each
+flush() is a single write() to the file opened for appending, so their
+lines do not interleave.  Lines that do not parse, e.g. one cut short by an
+interrupted run, are skipped with a warning.
+"""
+import csv
+import hashlib
+import io
+import json
+import os
+
+DEFAULT_DIGEST_STORE = os.path.join(
+    os.path.expanduser("~"), ".nda-bids-upload", "file_digests.tsv"
+)
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def md5_file(path):
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+class DigestStore:
+    def __init__(self, path=DEFAULT_DIGEST_STORE):
+        self.path = str(path)
+        # realpath -> (size, mtime_ns, md5sum), the last line for a path wins
+        self.digests = {}
+        # rows added since the last flush()
+        self._pending = []
+        malformed = 0
+        if os.path.isfile(self.path):
+            with open(self.path, "r", newline="", encoding="utf-8") as f:
+                for row in csv.reader(f, delimiter="\t"):
+                    try:
+                        realpath, size, mtime_ns, md5sum = row
+                        self.digests[realpath] = (int(size), int(mtime_ns), md5sum)
+                    except ValueError:
+                        malformed += 1
+        if malformed:
+            print(f"Warning: skipped {malformed} malformed line(s) in digest store {self.path}")
+
+    def lookup(self, path):
+        """Stored md5sum of a file (through symlinks), or None if unknown or the file changed since."""
+        realpath = os.path.realpath(path)
+        stored = self.digests.get(realpath)
+        if stored is None:
+            return None
+        stat = os.stat(realpath)
+        if (stat.st_size, stat.st_mtime_ns) != stored[:2]:
+            return None
+        return stored[2]
+
+    def add(self, path, md5sum, size=None, mtime_ns=None) -> None:
+        """Record the digest of a file as it is now (size and mtime are read when not given)."""
+        realpath = os.path.realpath(path)
+        if size is None or mtime_ns is None:
+            stat = os.stat(realpath)
+            size, mtime_ns = stat.st_size, stat.st_mtime_ns
+        self.digests[realpath] = (size, mtime_ns, md5sum)
+        self._pending.append([realpath, size, mtime_ns, md5sum])
+
+    def flush(self) -> None:
+        """
+        Append the digests added since the last flush to the store file, in
+        one write() that other processes appending to it cannot split.
+        """
+        if not self._pending:
+            return
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, delimiter="\t", lineterminator="\n")
+        writer.writerows(self._pending)
+        data = buffer.getvalue().encode("utf-8")
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o666)
+        try:
+            # start on a new line if an interrupted writer left a partial one
+            size = os.fstat(fd).st_size
+            if size and os.pread(fd, 1, size - 1) != b"\n":
+                data = b"\n" + data
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+        self._pending = []
+
+    def digest(self, path):
+        """md5sum of a file, from the store when still valid, otherwise read and stored."""
+        md5sum = self.lookup(path)
+        if md5sum is None:
+            md5sum = md5_file(path)
+            self.add(path, md5sum)
+        return md5sum
+
+
+def create_manifest(upload_dir, store=None, top_level_only=False):
+    """
+    Manifest of every file under upload_dir, or only the files directly in
+    it with top_level_only.  Existing *.manifest.json files are left out.
+    Without a store every file is read.
+    """
+    files = []
+    try:
+        _manifest_files(upload_dir, store, top_level_only, files)
+    finally:
+        if store is not None:
+            store.flush()
+    return {"files": files}
+
+
+def _manifest_files(upload_dir, store, top_level_only, files):
+    for root, dirs, names in os.walk(upload_dir):
+        if top_level_only:
+            dirs.clear()
+        for name in names:
+            if name.endswith(".manifest.json"):
+                continue
+            path = os.path.join(root, name)
+            md5sum = store.digest(path) if store is not None else md5_file(path)
+            files.append(
+                {
+                    "path": "./" + os.path.relpath(path, upload_dir).replace(os.sep, "/"),
+                    "name": name,
+                    "size": os.path.getsize(path),
+                    "md5sum": md5sum,
+                }
+            )
+
+
+def write_manifest(path, manifest) -> None:
+    with open(path, "w") as f:
+        json.dump(manifest, f, indent=4)
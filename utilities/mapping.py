@@ -21,30 +21,68 @@ Example (PET with session) from nda_ds004869 image03_sourcedata.pet.pet.json:
     }
 """
 
-from copy import copy
-
-from pandas._libs.lib import fast_multiget
-import bids
 import re
-import yaml
 import json
+import sys
+import os
 
-from copy import copy
-from typing import Union
+from typing import TYPE_CHECKING, Optional, Union
 from pathlib import Path
 from argparse import ArgumentParser
 
+if __package__ in (None, ""):
+    # run as `python utilities/mapping.py`: make the utilities package importable
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utilities.aiofs import parse_io_limit
+from utilities.layout_cache import BACKENDS, default_cache_dir, load_layout
+from utilities.profiling import add_profile_arguments, profiling, stage
+from utilities.scanner import BIDSScanner
+
+# pybids and yaml are imported where they are used so that `nda-mapping --help`
+# and the scandir backend never pay for them
+if TYPE_CHECKING:
+    import bids
+
 supported_bids_datatypes = ["anat", "pet"]
 
+# BIDS entities written as file-mapper placeholders; {RUN} is optional since
+# prepare.py has to expand it from the files present for each subject/session
+PLACEHOLDERS = {"sub": "SUBJECT", "ses": "SESSION", "run": "RUN"}
+
+# an entity is key-<alphanumeric label> starting a path component or following
+# an underscore, e.g. both sub-01 in sub-01/anat/sub-01_T1w.nii.gz
+ENTITY_PATTERNS = {
+    key: re.compile(rf"(?<![^/_]){re.escape(key)}-[a-zA-Z0-9]+(?=[/_.]|$)")
+    for key in PLACEHOLDERS
+}
+
+
+def generalize_path(relpath: str, entities=("sub", "ses")) -> str:
+    """sub-01/ses-a/pet/sub-01_ses-a_pet.json -> sub-{SUBJECT}/ses-{SESSION}/pet/sub-{SUBJECT}_ses-{SESSION}_pet.json"""
+    relpath = relpath.replace("\\", "/")
+    for key in entities:
+        relpath = ENTITY_PATTERNS[key].sub(f"{key}-{{{PLACEHOLDERS[key]}}}", relpath)
+    return relpath
+
 
 class MappingTemplator:
     def __init__(
         self,
-        bids_dataset: Union[bids.BIDSLayout, Path, str],
+        bids_dataset: Union["bids.BIDSLayout", BIDSScanner, Path, str],
         destination_path: Union[Path, str] = "",
+        layout_cache: Union[Path, str, None] = None,
+        reindex: bool = False,
+        backend: str = "pybids",
+        generalize_runs: bool = False,
+        io_limits: Optional[dict] = None,
     ):
-        if type(bids_dataset) is not bids.BIDSLayout:
-            self.bids_layout = bids.BIDSLayout(bids_dataset)
+        self.entities = ("sub", "ses", "run") if generalize_runs else ("sub", "ses")
+        if isinstance(bids_dataset, (str, Path)):
+            with stage("layout"):
+                self.bids_layout = load_layout(
+                    bids_dataset, layout_cache, reindex, backend, io_limits=io_limits
+                )
         else:
             self.bids_layout = bids_dataset
         self.bids_dataset_path = Path(self.bids_layout.root)
@@ -58,23 +96,21 @@ class MappingTemplator:
         Path(self.destination_path).mkdir(exist_ok=True, parents=True)
 
         self.datatypes = self.bids_layout.get_datatypes()
-        self.subject_mappings = {
-            subject: {datatype: [] for datatype in self.datatypes}
-            for subject in self.bids_layout.get_subjects()
-        }
-        self.general_mappings = {modality: [] for modality in self.datatypes}
+        self.general_mappings = {modality: set() for modality in self.datatypes}
         self.finished_product = {modality: {} for modality in self.datatypes}
-        self.populate_subject_mappings()
-        self.aggregate_mappings()
+        with stage("mappings"):
+            self.populate_subject_mappings()
+            self.aggregate_mappings()
         self.destination_path = destination_path
         # ultimately we'll want to support these as well: CT; SPECT; ultrasound; FA; X-Ray; spectroscopy; microscopy; DEXA; fNIRS; External Camera Photography
         self.bids_to_nda_image = {"anat": "MRI", "pet": "PET"}
         self.nda_file_descriptor = "image03_sourcedata.{}.{}"
 
-        self.create_jsons()
-        self.create_yamls()
-        self.create_toplevel_json()
-        self.create_toplevel_yaml()
+        with stage("write"):
+            self.create_jsons()
+            self.create_yamls()
+            self.create_toplevel_json()
+            self.create_toplevel_yaml()
 
     def create_toplevel_json(self):
         """Create identity mapping for BIDS dataset top-level files only."""
@@ -94,6 +130,8 @@ class MappingTemplator:
 
     def create_toplevel_yaml(self):
         """Create content YAML for image03_sourcedata.bids.toplevel."""
+        import yaml
+
         template = {
             "image_description": "bids toplevel",
             "scan_type": "BIDS dataset metadata",
@@ -107,31 +145,28 @@ class MappingTemplator:
             yaml.dump(template, f)
 
     def populate_subject_mappings(self):
-        for subject, datatype in self.subject_mappings.items():
-            for d in datatype.keys():
-                self.subject_mappings[subject][d] = [
-                    re.sub(f"sub-{subject}", "sub-{SUBJECT}", file.relpath)
-                    for file in self.bids_layout.get(subject=subject, datatype=d)
-                ]
+        """
+        Generalize the path of every file of every datatype and collect them
+        in self.general_mappings, a set per datatype, so only the unique
+        templates are ever held, not one path per subject and session.
+        """
+        for datatype, mappings in self.general_mappings.items():
+            for file in self.bids_layout.get(datatype=datatype):
+                mappings.add(generalize_path(file.relpath, self.entities))
 
     def aggregate_mappings(self):
         """
-        Collects ever bids subject/session and organizes them by subject, datatype,
-        and file. These set of unique bids file paths will be used to create the 
-        jsons for filemapper to symlink the nda datastructure from the BIDS dataset.
+        Turns the unique generalized bids file paths of every datatype into the
+        mappings filemapper uses to symlink the nda datastructure from the BIDS dataset.
 
-        For subject sub-example with a set of pet images will return the following:
-        Transforms self.subject_mappings ->
+        Transforms self.general_mappings ->
         {
-            'example': {
-                'pet': [
-                    'sub-example_session-a_pet.nii.gz',
-                    'sub-example_session-a_pet.json',
-                ],
-                'anat': [
-                    'sub-example_T1w.nii.gz',
-                    'sub-example_T1w.json'
-                ]
+            'anat': {
+                'sub-{SUBJECT}/anat/sub-{SUBJECT}_T1w.nii.gz',
+                'sub-{SUBJECT}/anat/sub-{SUBJECT}_T1w.json'
+            },
+            'pet': {
+                'sub-{SUBJECT}/ses-{SESSION}/pet/sub-{SUBJECT}_ses-{SESSION}_pet.nii.gz'
             }
         }
 
@@ -147,17 +182,10 @@ class MappingTemplator:
             }
         }
         """
-        for subject, datatype in self.subject_mappings.items():
-            for d in datatype.keys():
-                self.general_mappings[d].extend(self.subject_mappings[subject][d])
-        # create a set of all unique mappings
-        for datatype, mappings in self.general_mappings.items():
-            self.general_mappings[datatype] = list(set(mappings))
-
         # extend the mappings into a dictionary with their nda targets
         for datatype, mappings in self.general_mappings.items():
             self.finished_product[datatype] = {
-                m: re.sub("SUBJECT", "GUID", m) for m in mappings
+                m: m.replace("{SUBJECT}", "{GUID}") for m in sorted(mappings)
             }
 
     def create_jsons(self):
@@ -171,6 +199,8 @@ class MappingTemplator:
                 json.dump(mapper_json, outfile, indent=4)
 
     def create_yamls(self):
+        import yaml
+
         templates = {
             "anat": {
                 "image_description": "anatomical",
@@ -201,11 +231,35 @@ class MappingTemplator:
                 yaml.dump(templates[datatype], outfile)
 
 def cli():
-    parser = ArgumentParser()
+    # `nda-mapping coverage ...` reports how often every mapping key matches
+    if sys.argv[1:2] == ["coverage"]:
+        from utilities.mapping_coverage import cli as coverage_cli
+
+        return coverage_cli(sys.argv[2:])
+
+    parser = ArgumentParser(epilog="Run `nda-mapping coverage --help` to check how often each mapping key matches.")
     parser.add_argument("bids_dataset", type=Path, help="BIDS directory to preprep for nda upload")
     parser.add_argument("destination_path", type=Path, help="Destination directory to place lookup.csv, file mapper jsons, and nda yaml files")
+    parser.add_argument("--backend", choices=BACKENDS, default="scandir", help="How to read the BIDS dataset: scandir (fast path scan, default) or pybids (full index)")
+    parser.add_argument("--no-layout-cache", action="store_true", default=False, help="With the pybids backend, index without reading or writing the shared index cache")
+    parser.add_argument("--reindex", action="store_true", default=False, help="With the pybids backend, rebuild the shared index cache even if the dataset looks unchanged")
+    parser.add_argument("--generalize-runs", action="store_true", default=False, help="Also write run-<label> as run-{RUN}, expanded per subject/session by prepare.py")
+    parser.add_argument("--io-limit", type=parse_io_limit, action="append", default=[], metavar="[PATH=]N", help="With the scandir backend, list at most N folders at once (default 16), or N under PATH; repeatable per filesystem")
+    add_profile_arguments(parser, "destination_path")
     args = parser.parse_args()
-    MappingTemplator(bids_dataset=args.bids_dataset, destination_path=args.destination_path)
+    layout_cache = None
+    if not args.no_layout_cache:
+        layout_cache = default_cache_dir(args.bids_dataset, args.destination_path)
+    with profiling(args.profile, args.destination_path, "mapping", args.profile_memory):
+        MappingTemplator(
+            bids_dataset=args.bids_dataset,
+            destination_path=args.destination_path,
+            layout_cache=layout_cache,
+            reindex=args.reindex,
+            backend=args.backend,
+            generalize_runs=args.generalize_runs,
+            io_limits=dict(args.io_limit),
+        )
 
 if __name__ == "__main__":
     cli()
\ No newline at end of file
@@ -0,0 +1,188 @@
+"""
+How many subject/session combinations every file-mapper JSON key resolves for.
+
+    nda-mapping coverage <bids_dataset> <mapping.json or directory> [...]
+
+prepare.py tries every key of a mapping for every subject/session in
+lookup.csv, so keys that match only a few of them, or none, cost as much as
+keys that match them all.  The dataset is read once: the relative path of
+every file is generalized to the {SUBJECT}/{SESSION}/{RUN} forms a key can
+take and each form remembers the subject/session combinations it was seen
+in.  Looking up a key is then a dictionary access.
+
+The counts are written to mapping_coverage.tsv.  Keys that never match are
+listed; --drop-unmatched removes them from their mapping, and --split-below
+moves keys matching fewer than that fraction of the combinations into a
+separate <parent>rare.json mapping (with a copy of the parent's YAML), so
+the common mapping stays short.
+"""
+import csv
+import json
+import os
+import shutil
+from argparse import ArgumentParser
+from pathlib import Path
+
+from utilities.layout_cache import BACKENDS, load_layout
+from utilities.mapping import ENTITY_PATTERNS, generalize_path
+
+# entity subsets a key may have turned into placeholders, e.g. a key with
+# {SUBJECT} but a literal ses-baseline
+GENERALIZATIONS = [(), ("sub",), ("sub", "ses"), ("sub", "run"), ("sub", "ses", "run")]
+
+RARE_SUFFIX = "rare"
+
+
+def entity_label(key, relpath):
+    match = ENTITY_PATTERNS[key].search(relpath)
+    return match.group(0)[len(key) + 1 :] if match else None
+
+
+def coverage_index(bids_layout):
+    """
+    One pass over the layout: {generalized relpath: set of (subject, session)}
+    and the set of all subject/session combinations in the dataset.
+    """
+    index = {}
+    combinations = set()
+    for file in bids_layout.get():
+        relpath = file.relpath.replace("\\", "/")
+        combination = (entity_label("sub", relpath), entity_label("ses", relpath))
+        if combination[0] is not None:
+            combinations.add(combination)
+        for entities in GENERALIZATIONS:
+            index.setdefault(generalize_path(relpath, entities), set()).add(combination)
+    return index, combinations
+
+
+def mapping_files(paths):
+    """Mapping JSONs given directly or found in the given directories."""
+    files = []
+    for path in map(Path, paths):
+        if path.is_dir():
+            files.extend(sorted(path.glob("*.json")))
+        else:
+            files.append(path)
+    return files
+
+
+def mapping_coverage(bids_layout, mappings):
+    """Rows of (mapping, key, hits, combinations, fraction) for every key of every mapping."""
+    index, combinations = coverage_index(bids_layout)
+    total = len(combinations)
+    rows = []
+    for mapping in mappings:
+        with open(mapping, "r") as f:
+            keys = json.load(f)
+        for key in keys:
+            hits = len(index.get(key, ()))
+            if "{SUBJECT}" in key or entity_label("sub", key):
+                fraction = hits / total if total else 0.0
+            else:
+                # dataset-level file, e.g. README: present or not
+                fraction = float(hits > 0)
+            rows.append((str(mapping), key, hits, total, fraction))
+    return rows
+
+
+def split_mapping(mapping, rare_keys, drop_keys):
+    """
+    Move rare_keys into <parent>rare.json (copying the YAML) and remove
+    drop_keys.  Keys moved by earlier splits stay in <parent>rare.json.
+    """
+    mapping = Path(mapping)
+    with open(mapping, "r") as f:
+        keys = json.load(f)
+
+    moved = {key: keys.pop(key) for key in rare_keys if key in keys}
+    for key in drop_keys:
+        keys.pop(key, None)
+
+    with open(mapping, "w") as f:
+        json.dump(keys, f, indent=4)
+    if not moved:
+        return None
+
+    rare_mapping = mapping.with_name(mapping.stem + RARE_SUFFIX + ".json")
+    rare = {}
+    if rare_mapping.is_file():
+        with open(rare_mapping, "r") as f:
+            rare = json.load(f)
+    rare.update(moved)
+    with open(rare_mapping, "w") as f:
+        json.dump(rare, f, indent=4)
+    content_yaml = mapping.with_suffix(".yaml")
+    rare_yaml = rare_mapping.with_suffix(".yaml")
+    # an existing rare YAML may have been edited since the first split
+    if content_yaml.is_file() and not rare_yaml.is_file():
+        shutil.copyfile(content_yaml, rare_yaml)
+    return rare_mapping
+
+
+def cli(argv=None):
+    parser = ArgumentParser(
+        prog="nda-mapping coverage",
+        description="Count the subject/session combinations every file-mapper JSON key matches.",
+    )
+    parser.add_argument("bids_dataset", type=Path, help="BIDS dataset the mappings are applied to")
+    parser.add_argument(
+        "mappings", nargs="+", type=Path, help="Mapping JSONs, or directories holding them"
+    )
+    parser.add_argument(
+        "--backend",
+        choices=BACKENDS,
+        default="scandir",
+        help="How to read the BIDS dataset: scandir (fast path scan, default) or pybids (full index)",
+    )
+    parser.add_argument(
+        "--report",
+        type=Path,
+        default=None,
+        help="Where to write the coverage TSV (default: mapping_coverage.tsv next to the first mapping)",
+    )
+    parser.add_argument(
+        "--split-below",
+        type=float,
+        default=None,
+        metavar="FRACTION",
+        help="Move keys matching fewer than this fraction of subject/sessions (but at least one) into <parent>rare.json",
+    )
+    parser.add_argument(
+        "--drop-unmatched",
+        action="store_true",
+        default=False,
+        help="Remove keys that match nothing from their mapping",
+    )
+    args = parser.parse_args(argv)
+
+    mappings = [
+        m for m in mapping_files(args.mappings) if not m.stem.endswith(RARE_SUFFIX)
+    ]
+    if not mappings:
+        parser.error("no mapping JSONs found")
+    rows = mapping_coverage(load_layout(args.bids_dataset, backend=args.backend), mappings)
+
+    report = args.report or mappings[0].parent / "mapping_coverage.tsv"
+    with open(report, "w", newline="") as f:
+        writer = csv.writer(f, delimiter="\t")
+        writer.writerow(["mapping", "key", "hits", "combinations", "fraction"])
+        writer.writerows(rows)
+    print(f"Coverage of {len(rows)} keys written to {report}")
+
+    unmatched = [(mapping, key) for mapping, key, hits, _, _ in rows if hits == 0]
+    for mapping, key in unmatched:
+        print(f"Never matches: {os.path.basename(mapping)} {key}")
+
+    if args.split_below is None and not args.drop_unmatched:
+        return
+    for mapping in mappings:
+        keys = [row for row in rows if row[0] == str(mapping)]
+        rare = []
+        if args.split_below is not None:
+            rare = [key for _, key, hits, _, fraction in keys if 0 < hits and fraction < args.split_below]
+        drop = [key for _, key, hits, _, _ in keys if hits == 0] if args.drop_unmatched else []
+        rare_mapping = split_mapping(mapping, rare, drop)
+        if rare_mapping:
+            print(f"Moved {len(rare)} rarely matched keys of {mapping.name} to {rare_mapping.name}")
+        if drop:
+            print(f"Removed {len(drop)} unmatched keys from {mapping.name}")
@@ -0,0 +1,133 @@
+"""
+Pack directories of many small files in sourcedata children into archives.
+
+Raw DICOM sourcedata can put tens of thousands of small files in one child
+folder, and the manifest, vtcmd validation and the upload all pay per file.
+When a child of a sourcedata parent holds more than max_small_files files
+under small_file_bytes, every leaf directory in it (one holding files but
+no subdirectories, e.g. a DICOM series) is archived with dicom2targz's
+pack_directory() into <leaf>.tar.gz next to it, and the leaf directory is
+removed from the child.  Only the child's directory and symlinks are
+removed; the files they point to are archived, never touched.  Leaves
+reached through a symlinked folder, e.g. a session folder linked into the
+BIDS dataset, resolve outside the child and are left alone.
+
+The archives' fingerprints are kept outside the children, under
+<destination>/.packing/<parent>/, so they are not uploaded.  When file
+mapping runs again and recreates a leaf directory, it is archived again
+only if its files changed.  Digests of new archives go to the digest store,
+so records.py does not read them back for the manifest.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from utilities.dicom2targz import DEFAULT_LEVEL, archive_extension, pack_directory
+from utilities.manifests import DEFAULT_DIGEST_STORE, DigestStore
+from utilities.shards import in_shard
+
+DEFAULT_MAX_SMALL_FILES = 1000
+DEFAULT_SMALL_FILE_BYTES = 1024 * 1024
+
+PACKING_DIR = ".packing"
+
+
+def is_sourcedata_parent(parent_name):
+    return (
+        "_sourcedata." in parent_name
+        and parent_name != "image03_sourcedata.bids.toplevel"
+    )
+
+
+def small_file_leaves(child_dir, small_file_bytes=DEFAULT_SMALL_FILE_BYTES):
+    """({leaf directory: small files in it}, small files in the whole child)."""
+    leaves = {}
+    total = 0
+    inside = os.path.realpath(child_dir).rstrip(os.sep) + os.sep
+    for root, dirs, names in os.walk(child_dir, followlinks=True):
+        small = sum(
+            os.path.getsize(os.path.join(root, name)) < small_file_bytes
+            for name in names
+        )
+        total += small
+        # the leaf itself may be a symlink, but the folder holding it must be
+        # the child's own, or removing the leaf would remove source files
+        holder = os.path.realpath(os.path.dirname(root)) + os.sep
+        if small and not dirs and root != child_dir and holder.startswith(inside):
+            leaves[root] = small
+    return leaves, total
+
+
+def remove_leaf(leaf):
+    """
+    Remove a leaf directory of the child, or the symlink standing in for one.
+    Only links and the child's own entries are unlinked, nothing is removed
+    recursively.
+    """
+    if os.path.islink(leaf):
+        os.unlink(leaf)
+        return
+    for name in os.listdir(leaf):
+        os.unlink(os.path.join(leaf, name))
+    os.rmdir(leaf)
+
+
+def pack_leaf(leaf, output, fingerprint_file, codec, level):
+    packed = pack_directory(
+        leaf,
+        output,
+        fingerprint_file,
+        codec,
+        level,
+        dereference=True,
+    )
+    remove_leaf(leaf)
+    return dict(packed, leaf=leaf, output=output)
+
+
+def pack_parent(
+    parent_dir,
+    max_small_files=DEFAULT_MAX_SMALL_FILES,
+    small_file_bytes=DEFAULT_SMALL_FILE_BYTES,
+    codec="gzip",
+    level=DEFAULT_LEVEL,
+    jobs=None,
+    digest_store=DEFAULT_DIGEST_STORE,
+    shard=None,
+):
+    """
+    Pack the leaf directories of every child of parent_dir (of shard (i, N)
+    only, when given) holding more than max_small_files small files.  Returns one row per packed leaf: leaf,
+    output, status (archived or up-to-date), files, input_bytes,
+    output_bytes and md5sum.
+    """
+    parent_dir = os.path.abspath(parent_dir)
+    fingerprint_dir = os.path.join(
+        os.path.dirname(parent_dir), PACKING_DIR, os.path.basename(parent_dir)
+    )
+    store = DigestStore(digest_store) if digest_store else None
+
+    tasks = []
+    for child in sorted(os.listdir(parent_dir)):
+        child_dir = os.path.join(parent_dir, child)
+        if not os.path.isdir(child_dir) or not in_shard(child, shard):
+            continue
+        leaves, total = small_file_leaves(child_dir, small_file_bytes)
+        if total <= max_small_files:
+            continue
+        for leaf in sorted(leaves):
+            output = leaf + archive_extension(codec)
+            fingerprint_file = os.path.join(
+                fingerprint_dir, os.path.relpath(output, parent_dir) + ".fingerprint"
+            )
+            tasks.append((leaf, output, fingerprint_file, codec, level))
+
+    results = []
+    if not tasks:
+        return results
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        for result in pool.map(pack_leaf, *zip(*tasks)):
+            results.append(result)
+            if store is not None and result["status"] == "archived":
+                store.add(result["output"], result["md5sum"], result["output_bytes"])
+                store.flush()
+    return results
@@ -0,0 +1,380 @@
+"""
+Run lookup, mapping, prepare and upload as one make-style pipeline.
+
+    nda-pipeline <bids_dataset> <destination> [--collection ID --vtcmd VTCMD]
+
+Stages, with the inputs and outputs they declare:
+
+    lookup             BIDS dataset                       -> lookup.csv
+    mapping            BIDS dataset                       -> file mapper JSONs and YAMLs
+    prepare:<parent>   BIDS dataset, lookup.csv,           -> <parent>/ and its
+                       <parent>.json, <parent>.yaml           records and batches,
+                                                              once its links check out
+    upload             every <parent>.complete_records.csv -> uploaded batches
+
+A stage runs when the fingerprint of its inputs (the size and mtime of a
+file, or of every file and folder under a directory) differs from the one
+recorded in <destination>/.pipeline/ when it last succeeded, or when one of
+its outputs is missing.  A file edited in place, e.g. a fixed sidecar JSON,
+changes its mtime and so reruns the stages reading the BIDS dataset; an
+edit that keeps both size and mtime needs --force.  Stages whose
+dependencies are done run at the same time in separate processes, so
+parents are prepared concurrently, and a stage that fails blocks only the
+stages after it.  The concurrent prepare stages share the digest store
+~/.nda-bids-upload/file_digests.tsv, which takes appends from several
+processes at once (see utilities/manifests.py).
+
+lookup.csv is brought up to date with nda-lookup --update, keeping entered
+GUIDs and dates.  The mapping stage only runs while the destination has no
+mapping JSONs: mappings and YAMLs are edited by hand once written, and
+regenerating them would lose those edits.  Delete them to regenerate.
+"""
+import hashlib
+import os
+import subprocess
+import sys
+from argparse import ArgumentParser
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from pathlib import Path
+
+if __package__ in (None, ""):
+    # run as `python utilities/pipeline.py`: make the utilities package importable
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utilities.aiofs import parse_io_limit
+from utilities.layout_cache import BACKENDS, dataset_signature, default_cache_dir
+
+HERE = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+STATE_DIR = ".pipeline"
+
+RAN = "ran"
+UP_TO_DATE = "up-to-date"
+FAILED = "failed"
+BLOCKED = "blocked"
+
+
+class Stage:
+    """
+    One step of a pipeline: action(*args) run in a worker process once the
+    stages named in after are done.  An action returning False counts as failed.
+    """
+
+    def __init__(self, name, action, args=(), inputs=(), outputs=(), after=()):
+        self.name = name
+        self.action = action
+        self.args = tuple(args)
+        self.inputs = [str(path) for path in inputs]
+        self.outputs = [str(path) for path in outputs]
+        self.after = list(after)
+
+
+class Pipeline:
+    def __init__(self, destination, jobs=None, force=False):
+        self.state_dir = os.path.join(str(destination), STATE_DIR)
+        self.jobs = jobs
+        self.force = force
+        # directory signatures stat the whole tree, compute each once per run
+        self._directory_signatures = {}
+
+    def _path_signature(self, path):
+        if os.path.isdir(path):
+            if path not in self._directory_signatures:
+                self._directory_signatures[path] = dataset_signature(path, files=True)
+            return self._directory_signatures[path]
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return "missing"
+        return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+    def fingerprint(self, stage):
+        digest = hashlib.sha1(stage.name.encode())
+        for path in stage.inputs:
+            digest.update(f"{path}\t{self._path_signature(path)}\n".encode())
+        return digest.hexdigest()
+
+    def stamp_path(self, stage):
+        return os.path.join(self.state_dir, stage.name.replace(os.sep, "_") + ".stamp")
+
+    def up_to_date(self, stage, fingerprint):
+        if self.force or not all(os.path.exists(path) for path in stage.outputs):
+            return False
+        try:
+            with open(self.stamp_path(stage), "r") as f:
+                return f.read().strip() == fingerprint
+        except FileNotFoundError:
+            return False
+
+    def record(self, stage, fingerprint):
+        os.makedirs(self.state_dir, exist_ok=True)
+        with open(self.stamp_path(stage), "w") as f:
+            f.write(fingerprint + "\n")
+
+    def run(self, stages):
+        """Run the stages in dependency order and return {stage name: status}."""
+        names = {stage.name for stage in stages}
+        for stage in stages:
+            unknown = set(stage.after) - names
+            if unknown:
+                raise ValueError(f"Stage {stage.name} runs after unknown stages {sorted(unknown)}")
+
+        statuses = {}
+        pending = list(stages)
+        running = {}
+        with ProcessPoolExecutor(max_workers=self.jobs) as pool:
+            while pending or running:
+                progressed = False
+                for stage in list(pending):
+                    after = [statuses.get(name) for name in stage.after]
+                    if any(status in (FAILED, BLOCKED) for status in after):
+                        statuses[stage.name] = BLOCKED
+                    elif all(status in (RAN, UP_TO_DATE) for status in after):
+                        fingerprint = self.fingerprint(stage)
+                        if self.up_to_date(stage, fingerprint):
+                            statuses[stage.name] = UP_TO_DATE
+                        else:
+                            print(f"Running {stage.name}")
+                            future = pool.submit(stage.action, *stage.args)
+                            running[future] = (stage, fingerprint)
+                    else:
+                        continue
+                    if stage.name in statuses:
+                        print(f"{stage.name}: {statuses[stage.name]}")
+                    pending.remove(stage)
+                    progressed = True
+
+                if not running:
+                    if pending and not progressed:
+                        raise ValueError(
+                            "Stages depend on each other in a cycle: "
+                            + ", ".join(stage.name for stage in pending)
+                        )
+                    continue
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage, fingerprint = running.pop(future)
+                    try:
+                        succeeded = future.result() is not False
+                    except Exception as e:
+                        print(f"{stage.name} failed: {e}")
+                        succeeded = False
+                    if succeeded:
+                        self.record(stage, fingerprint)
+                    statuses[stage.name] = RAN if succeeded else FAILED
+                    print(f"{stage.name}: {statuses[stage.name]}")
+        return statuses
+
+
+def mapping_jsons(destination):
+    # prepare.py treats every JSON in the destination as a file mapper JSON
+    return sorted(
+        name for name in os.listdir(destination) if name.endswith(".json")
+    )
+
+
+def lookup_stage(bids_dataset, destination, backend, io_limits=None):
+    from utilities.lookup import update_lookup_table
+
+    update_lookup_table(
+        bids_dataset,
+        destination_path=destination,
+        layout_cache=default_cache_dir(bids_dataset, destination),
+        backend=backend,
+        io_limits=io_limits,
+    )
+
+
+def mapping_stage(bids_dataset, destination, backend, generalize_runs, io_limits=None):
+    from utilities.mapping import MappingTemplator
+
+    MappingTemplator(
+        bids_dataset=Path(bids_dataset),
+        destination_path=Path(destination),
+        layout_cache=default_cache_dir(bids_dataset, destination),
+        backend=backend,
+        generalize_runs=generalize_runs,
+        io_limits=io_limits,
+    )
+
+
+def prepare_stage(bids_dataset, destination, parent_name, pack_small_files, small_file_size):
+    from prepare import filemap_parent, read_lookup, records_parent
+    from utilities.packing import is_sourcedata_parent, pack_parent
+
+    filemap_parent(destination, bids_dataset, parent_name + ".json", read_lookup(destination))
+    if pack_small_files is not None and is_sourcedata_parent(parent_name):
+        pack_parent(os.path.join(destination, parent_name), pack_small_files, small_file_size)
+    return records_parent(destination, parent_name, source_dir=bids_dataset)
+
+
+def upload_stage(destination, collection_id, vtcmd):
+    command = [
+        sys.executable,
+        os.path.join(HERE, "upload.py"),
+        "--destination",
+        destination,
+        "--collection",
+        str(collection_id),
+        "--ndavtcmd",
+        vtcmd,
+    ]
+    return subprocess.run(command).returncode == 0
+
+
+def setup_stages(
+    bids_dataset, destination, backend="scandir", generalize_runs=False, io_limits=None
+):
+    lookup_csv = os.path.join(destination, "lookup.csv")
+    stages = [
+        Stage(
+            "lookup",
+            lookup_stage,
+            (bids_dataset, destination, backend, io_limits),
+            inputs=[bids_dataset],
+            outputs=[lookup_csv],
+        )
+    ]
+    if not mapping_jsons(destination):
+        stages.append(
+            Stage(
+                "mapping",
+                mapping_stage,
+                (bids_dataset, destination, backend, generalize_runs, io_limits),
+                inputs=[bids_dataset],
+            )
+        )
+    return stages
+
+
+def release_stages(
+    bids_dataset,
+    destination,
+    pack_small_files=None,
+    small_file_size=1024 * 1024,
+    collection_id=None,
+    vtcmd=None,
+):
+    """One prepare stage per mapping JSON in the destination, then the upload when requested."""
+    lookup_csv = os.path.join(destination, "lookup.csv")
+    stages = []
+    for filename in mapping_jsons(destination):
+        parent_name = filename[: -len(".json")]
+        parent = os.path.join(destination, parent_name)
+        stages.append(
+            Stage(
+                "prepare:" + parent_name,
+                prepare_stage,
+                (bids_dataset, destination, parent_name, pack_small_files, small_file_size),
+                inputs=[bids_dataset, lookup_csv, parent + ".json", parent + ".yaml"],
+                outputs=[parent, parent + ".complete_records.csv"],
+            )
+        )
+    if collection_id is not None:
+        stages.append(
+            Stage(
+                "upload",
+                upload_stage,
+                (destination, collection_id, vtcmd),
+                inputs=[stage.outputs[1] for stage in stages],
+                after=[stage.name for stage in stages],
+            )
+        )
+    return stages
+
+
+def cli(argv=None):
+    parser = ArgumentParser(
+        prog="nda-pipeline",
+        description="Run lookup, mapping, prepare and upload, skipping every stage whose inputs are unchanged.",
+    )
+    parser.add_argument("bids_dataset", type=Path, help="BIDS dataset to upload")
+    parser.add_argument("destination", type=Path, help="Destination directory of the upload preparation")
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=None, help="Stages to run at the same time (default: number of CPUs)"
+    )
+    parser.add_argument(
+        "--force", action="store_true", default=False, help="Run every stage, even if its inputs are unchanged"
+    )
+    parser.add_argument(
+        "--backend",
+        choices=BACKENDS,
+        default="scandir",
+        help="How to read the BIDS dataset: scandir (fast path scan, default) or pybids (full index)",
+    )
+    parser.add_argument(
+        "--generalize-runs",
+        action="store_true",
+        default=False,
+        help="Write run-<label> as run-{RUN} in new mappings (see nda-mapping)",
+    )
+    parser.add_argument(
+        "--io-limit",
+        type=parse_io_limit,
+        action="append",
+        default=[],
+        metavar="[PATH=]N",
+        help="With the scandir backend, list at most N folders at once (default 16), or N under PATH; repeatable per filesystem",
+    )
+    parser.add_argument(
+        "--pack-small-files",
+        type=int,
+        default=None,
+        metavar="N",
+        help="Pack sourcedata child folders holding more than N small files (see nda-prepare)",
+    )
+    parser.add_argument(
+        "--small-file-size",
+        type=int,
+        default=1024 * 1024,
+        metavar="BYTES",
+        help="Files under this size count as small for --pack-small-files (default 1 MiB)",
+    )
+    parser.add_argument(
+        "--collection", type=int, default=None, help="NDA collection ID, to upload once prepared"
+    )
+    parser.add_argument("--vtcmd", default=None, help="Path to vtcmd, required with --collection")
+    args = parser.parse_args(argv)
+    if args.collection is not None and args.vtcmd is None:
+        parser.error("--collection needs --vtcmd")
+
+    bids_dataset = str(args.bids_dataset.resolve())
+    destination = str(args.destination.resolve())
+    os.makedirs(destination, exist_ok=True)
+    pipeline = Pipeline(destination, args.jobs, args.force)
+
+    # which parents there are is only known once the mappings exist
+    statuses = pipeline.run(
+        setup_stages(
+            bids_dataset,
+            destination,
+            args.backend,
+            args.generalize_runs,
+            dict(args.io_limit),
+        )
+    )
+    if FAILED not in statuses.values():
+        statuses.update(
+            pipeline.run(
+                release_stages(
+                    bids_dataset,
+                    destination,
+                    args.pack_small_files,
+                    args.small_file_size,
+                    args.collection,
+                    args.vtcmd,
+                )
+            )
+        )
+
+    counts = {}
+    for status in statuses.values():
+        counts[status] = counts.get(status, 0) + 1
+    print(", ".join(f"{n} {status}" for status, n in sorted(counts.items())))
+    if FAILED in statuses.values() or BLOCKED in statuses.values():
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    cli()
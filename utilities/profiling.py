@@ -0,0 +1,218 @@
+"""
+Opt-in profiling of the nda-* commands: --profile and --profile-memory.
+
+    nda-prepare -s SOURCE -d DESTINATION --profile [--profile-memory]
+
+prepare.py, records.py, upload.py, nda-lookup and nda-mapping take these
+options and write into <destination>/.profile/<command>-<time>/:
+
+    <stage>.pstats        cProfile statistics of each stage, for pstats or snakeviz
+    <stage>.txt           its 40 functions with the highest cumulative time
+    stacks.collapsed      sampled stacks of the main thread, one "a;b;c count"
+                          line per distinct stack, for flamegraph.pl or speedscope
+    memory.tsv            with --profile-memory, the peak traced memory of each stage
+    <stage>.tracemalloc   with --profile-memory, a tracemalloc snapshot taken at
+                          the end of the stage, for tracemalloc.Snapshot.load()
+
+Stages are the steps a command marks with stage(), e.g. filemap:<parent>
+and records:<parent> in prepare.py; time outside any stage belongs to the
+stage named after the command.  A stage entered more than once adds up.
+Stage statistics exclude the stages nested in them, but the memory peak
+of a stage includes theirs.  Only the calling process is profiled, not the
+worker processes it starts, and only the main thread is sampled.
+
+stage() costs nothing while no profile is being recorded.
+"""
+import os
+import re
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+PROFILE_DIR = ".profile"
+
+# seconds between stack samples for stacks.collapsed
+SAMPLE_INTERVAL = 0.005
+
+# frames kept per tracemalloc allocation
+TRACEMALLOC_FRAMES = 10
+
+_active = None
+
+
+def add_profile_arguments(parser, dest_name="the destination"):
+    """Add --profile and --profile-memory to an ArgumentParser."""
+    parser.add_argument(
+        "--profile",
+        dest="profile",
+        action="store_true",
+        default=False,
+        help=(
+            "Write cProfile statistics of every stage and sampled stacks for flame graphs "
+            "to " + PROFILE_DIR + "/ in " + dest_name + "."
+        ),
+    )
+    parser.add_argument(
+        "--profile-memory",
+        dest="profile_memory",
+        action="store_true",
+        default=False,
+        help="With --profile, also trace memory allocations and write per-stage peaks and snapshots (slow).",
+    )
+
+
+def stage_filename(name):
+    return re.sub(r"[^\w.:+-]+", "_", name)
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    # ";" separates frames in collapsed stacks
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(";", ":")
+
+
+class Profiler:
+    def __init__(self, output_dir, command, memory=False, interval=SAMPLE_INTERVAL):
+        self.output_dir = output_dir
+        self.command = command
+        self.memory = memory
+        self.interval = interval
+        # stage name -> cProfile.Profile, reused when a stage is entered again
+        self.profiles = {}
+        # entered stages, innermost last, as [name, peak memory so far]
+        self._stack = []
+        self.peaks = {}
+        self.stacks = {}
+        self._thread_id = threading.get_ident()
+        self._sampling = threading.Event()
+        self._sampler = None
+
+    def _profile(self, name):
+        import cProfile
+
+        if name not in self.profiles:
+            self.profiles[name] = cProfile.Profile()
+        return self.profiles[name]
+
+    def start(self):
+        if self.memory:
+            import tracemalloc
+
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        self._sampler = threading.Thread(target=self._sample, name="nda-profile-sampler", daemon=True)
+        self._sampler.start()
+        self.enter(self.command)
+
+    def stop(self):
+        while self._stack:
+            self.exit()
+        self._sampling.set()
+        self._sampler.join()
+        if self.memory:
+            import tracemalloc
+
+            tracemalloc.stop()
+
+    def enter(self, name):
+        if self._stack:
+            self._profile(self._stack[-1][0]).disable()
+            if self.memory:
+                import tracemalloc
+
+                # the peak so far belongs to the stage being left
+                self._stack[-1][1] = max(self._stack[-1][1], tracemalloc.get_traced_memory()[1])
+                tracemalloc.reset_peak()
+        self._stack.append([name, 0])
+        self._profile(name).enable()
+
+    def exit(self):
+        name, peak = self._stack.pop()
+        self._profile(name).disable()
+        if self.memory:
+            import tracemalloc
+
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+            # keep the snapshot of the stage's highest peak only
+            if peak > self.peaks.get(name, -1):
+                self.peaks[name] = peak
+                tracemalloc.take_snapshot().dump(
+                    os.path.join(self.output_dir, stage_filename(name) + ".tracemalloc")
+                )
+            tracemalloc.reset_peak()
+            if self._stack:
+                self._stack[-1][1] = max(self._stack[-1][1], peak)
+        if self._stack:
+            self._profile(self._stack[-1][0]).enable()
+
+    def _sample(self):
+        while not self._sampling.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            stack = list(self._stack)
+            if frame is None or not stack:
+                continue
+            frames = []
+            while frame is not None:
+                frames.append(_frame_name(frame))
+                frame = frame.f_back
+            key = ";".join([stack[-1][0].replace(";", ":")] + frames[::-1])
+            self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def write(self):
+        import pstats
+
+        for name, profile in self.profiles.items():
+            path = os.path.join(self.output_dir, stage_filename(name))
+            profile.dump_stats(path + ".pstats")
+            # a stage without a single call has nothing to print
+            if profile.getstats():
+                with open(path + ".txt", "w") as f:
+                    pstats.Stats(profile, stream=f).sort_stats("cumulative").print_stats(40)
+        with open(os.path.join(self.output_dir, "stacks.collapsed"), "w") as f:
+            for key, count in sorted(self.stacks.items()):
+                f.write(f"{key} {count}\n")
+        if self.memory:
+            with open(os.path.join(self.output_dir, "memory.tsv"), "w") as f:
+                f.write("stage\tpeak_bytes\n")
+                for name, peak in sorted(self.peaks.items()):
+                    f.write(f"{name}\t{peak}\n")
+
+
+@contextmanager
+def stage(name):
+    """Attribute what runs inside to the named stage of the active profile, if any."""
+    profiler = _active
+    if profiler is None or threading.get_ident() != profiler._thread_id:
+        yield
+        return
+    profiler.enter(name)
+    try:
+        yield
+    finally:
+        profiler.exit()
+
+
+@contextmanager
+def profiling(enabled, destination, command, memory=False):
+    """
+    Profile what runs inside into <destination>/.profile/<command>-<time>/
+    when enabled, and do nothing otherwise.
+    """
+    global _active
+    if not enabled or _active is not None:
+        yield None
+        return
+    output_dir = os.path.join(
+        str(destination), PROFILE_DIR, f"{command}-{time.strftime('%Y%m%d-%H%M%S')}"
+    )
+    os.makedirs(output_dir, exist_ok=True)
+    profiler = Profiler(output_dir, command, memory)
+    _active = profiler
+    profiler.start()
+    try:
+        yield profiler
+    finally:
+        profiler.stop()
+        _active = None
+        profiler.write()
+        print(f"Profile written to {output_dir}")
@@ -0,0 +1,171 @@
+"""
+Lightweight BIDS entity scanner, an alternative to pybids for lookup and mapping.
+
+nda-lookup and nda-mapping only need the subject, session, datatype and
+relative path of every file.  BIDSScanner walks the tree once with
+os.scandir, reads those entities from the directory layout
+(sub-<x>/[ses-<y>/]<datatype>/) and the key-value pairs of the file names,
+and answers the handful of BIDSLayout queries the tools make (root,
+get_subjects, get_datatypes, get, to_df).  There is no SQL index, no
+metadata indexing and no validation, which is what makes it fast on
+datasets with millions of files.
+
+Like pybids' defaults, only top-level files and sub-* folders are scanned
+(code/, derivatives/, sourcedata/ and dot files are skipped).  Folders are
+listed concurrently through AsyncFS, which pays off on network storage
+where every listing is a round trip.
+"""
+import asyncio
+import os
+
+from utilities.aiofs import AsyncFS
+
+# BIDS datatype folder names
+DATATYPES = {
+    "anat",
+    "beh",
+    "dwi",
+    "eeg",
+    "fmap",
+    "func",
+    "ieeg",
+    "meg",
+    "micr",
+    "motion",
+    "mrs",
+    "nirs",
+    "perf",
+    "pet",
+}
+
+# file name keys and the pybids entity names they map to
+ENTITY_NAMES = {
+    "sub": "subject",
+    "ses": "session",
+    "dir": "direction",
+    "trc": "tracer",
+    "mod": "modality",
+}
+
+
+def parse_filename(filename):
+    """Entities, suffix and extension of a BIDS file name, e.g. sub-01_ses-a_T1w.nii.gz."""
+    stem, dot, extension = filename.partition(".")
+    entities = {}
+    parts = stem.split("_")
+    for part in parts:
+        key, dash, value = part.partition("-")
+        if dash:
+            entities[ENTITY_NAMES.get(key, key)] = value
+        else:
+            entities["suffix"] = part
+    if dot:
+        entities["extension"] = "." + extension
+    return entities
+
+
+class ScannedFile:
+    """One file found by BIDSScanner, shaped like the parts of pybids' BIDSFile the tools use."""
+
+    __slots__ = ("path", "relpath", "entities")
+
+    def __init__(self, path, relpath, entities):
+        self.path = path
+        self.relpath = relpath
+        self.entities = entities
+
+    def get_entities(self):
+        return dict(self.entities)
+
+    def __fspath__(self):
+        return self.path
+
+    def __repr__(self):
+        return f"<ScannedFile filename='{self.path}'>"
+
+
+class BIDSScanner:
+    def __init__(self, root, subjects=None, io_limits=None):
+        """
+        Scan root, or with subjects (labels without "sub-") only those subject
+        folders, with at most io_limits listings in flight (see AsyncFS).
+        """
+        self.root = os.path.abspath(str(root))
+        if not os.path.isdir(self.root):
+            raise ValueError(f"BIDS root does not exist: {self.root}")
+        self.subjects = None if subjects is None else set(subjects)
+        with AsyncFS(io_limits) as fs:
+            self.files = fs.run(self._scan(fs))
+
+    def _file(self, path, context):
+        relpath = os.path.relpath(path, self.root).replace(os.sep, "/")
+        entities = dict(context)
+        entities.update(parse_filename(os.path.basename(path)))
+        return ScannedFile(path, relpath, entities)
+
+    async def _walk(self, fs, directory, context):
+        """Scan below a subject or session folder, picking up the datatype from the path."""
+        files = []
+        subfolders = []
+        for name, path, is_dir in await fs.entries(directory):
+            if name.startswith("."):
+                continue
+            if is_dir:
+                child = dict(context)
+                if name.startswith("ses-") and "session" not in context:
+                    child["session"] = name[4:]
+                elif name in DATATYPES and "datatype" not in context:
+                    child["datatype"] = name
+                subfolders.append(self._walk(fs, path, child))
+            else:
+                files.append(self._file(path, context))
+        for found in await asyncio.gather(*subfolders):
+            files.extend(found)
+        return files
+
+    async def _scan(self, fs):
+        files = []
+        subjects = []
+        for name, path, is_dir in await fs.entries(self.root):
+            if name.startswith("."):
+                continue
+            if is_dir:
+                if name.startswith("sub-") and (
+                    self.subjects is None or name[4:] in self.subjects
+                ):
+                    subjects.append(self._walk(fs, path, {"subject": name[4:]}))
+            else:
+                files.append(self._file(path, {}))
+        for found in await asyncio.gather(*subjects):
+            files.extend(found)
+        return files
+
+    def get(self, **filters):
+        """Files whose entities equal every given filter (None filters are ignored)."""
+        selected = self.files
+        for key, value in filters.items():
+            if value is None:
+                continue
+            if key == "extension":
+                value = "." + str(value).lstrip(".")
+            selected = [f for f in selected if f.entities.get(key) == value]
+        return selected
+
+    def get_subjects(self):
+        return sorted({f.entities["subject"] for f in self.files if "subject" in f.entities})
+
+    def get_sessions(self):
+        return sorted({f.entities["session"] for f in self.files if "session" in f.entities})
+
+    def get_datatypes(self):
+        return sorted({f.entities["datatype"] for f in self.files if "datatype" in f.entities})
+
+    def to_df(self, metadata=False):
+        """One row per file with its path and entities, like BIDSLayout.to_df()."""
+        import pandas
+
+        rows = [dict(f.entities, path=f.path) for f in self.files]
+        df = pandas.DataFrame(rows)
+        if "path" in df.columns:
+            df = df[["path"] + [c for c in df.columns if c != "path"]]
+        return df
@@ -0,0 +1,182 @@
+"""
+Bandwidth and concurrency scheduling for upload.py.
+
+vtcmd manages its own sockets, so upload.py cannot throttle the transfer
+itself.  Instead the scheduler controls *when* batches start and *how many*
+run at once: it measures the throughput of finished batches (bytes / seconds),
+adjusts the number of concurrent batches so the estimated aggregate rate stays
+under the cap, and inserts a cool-down after a batch that ran faster than the
+cap allows on its own.
+
+Time windows scale the cap by a percentage, e.g. "20:00-06:00=100%,*=20%"
+means full speed overnight and 20% of the cap otherwise.  A window at 0%
+pauses the start of new batches until the window ends.
+"""
+import time
+
+from datetime import datetime
+from datetime import time as dtime
+
+# Weight given to the newest per-batch throughput sample
+EWMA_WEIGHT = 0.3
+
+UNITS = {
+    "": 1,
+    "B": 1,
+    "K": 1024,
+    "KB": 1024,
+    "M": 1024**2,
+    "MB": 1024**2,
+    "G": 1024**3,
+    "GB": 1024**3,
+}
+
+
+def parse_bandwidth(value: str) -> float:
+    """Parse a bandwidth like "50MB", "1.5G" or "200K" (per second) into bytes per second."""
+    text = str(value).strip().upper()
+    if text.endswith("/S"):
+        text = text[:-2]
+    number = text.rstrip("KMGB")
+    unit = text[len(number):]
+    if unit not in UNITS or not number:
+        raise ValueError(f"Unrecognized bandwidth: {value}")
+    return float(number) * UNITS[unit]
+
+
+def _parse_clock(text: str) -> dtime:
+    hour, minute = text.strip().split(":")
+    return dtime(int(hour), int(minute))
+
+
+def _parse_fraction(text: str) -> float:
+    text = text.strip()
+    if text.endswith("%"):
+        fraction = float(text[:-1]) / 100
+    else:
+        fraction = float(text)
+    if fraction < 0:
+        raise ValueError(f"Negative schedule fraction: {text}")
+    return fraction
+
+
+def parse_schedule(spec: str):
+    """
+    Parse a schedule string into (windows, default_fraction).
+
+    The spec is a comma-separated list of "HH:MM-HH:MM=P" windows plus an
+    optional "*=P" default, where P is a percentage ("20%") or a fraction
+    ("0.2").  Windows may wrap past midnight.  The default is 100%.
+
+    "20:00-06:00=100%,*=20%" -> ([(20:00, 06:00, 1.0)], 0.2)
+    """
+    windows = []
+    default_fraction = 1.0
+    if not spec:
+        return windows, default_fraction
+
+    for entry in spec.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        if "=" not in entry:
+            raise ValueError(f'Schedule entry "{entry}" must look like HH:MM-HH:MM=P')
+        span, fraction = entry.split("=", 1)
+        span = span.strip()
+        if span == "*":
+            default_fraction = _parse_fraction(fraction)
+            continue
+        start, end = span.split("-", 1)
+        windows.append((_parse_clock(start), _parse_clock(end), _parse_fraction(fraction)))
+
+    return windows, default_fraction
+
+
+def _in_window(moment: dtime, start: dtime, end: dtime) -> bool:
+    if start <= end:
+        return start <= moment < end
+    # window wraps past midnight
+    return moment >= start or moment < end
+
+
+class BandwidthScheduler:
+    """
+    Decide how many upload batches may run at once and when the next may start.
+
+    max_bandwidth is in bytes per second (None for no cap), max_concurrent is
+    the hard ceiling on simultaneous batches.  Call record() after every
+    finished batch so the throughput estimate tracks reality.
+    """
+
+    def __init__(
+        self,
+        max_bandwidth=None,
+        max_concurrent: int = 1,
+        schedule: str = "",
+        clock=time.time,
+    ):
+        self.max_bandwidth = max_bandwidth
+        self.max_concurrent = max(1, int(max_concurrent))
+        self.windows, self.default_fraction = parse_schedule(schedule)
+        self.clock = clock
+        # estimated throughput of a single batch in bytes per second
+        self.batch_rate = None
+        self._not_before = 0.0
+
+    def fraction(self, now=None) -> float:
+        """Fraction of the cap allowed at time now (epoch seconds)."""
+        if now is None:
+            now = self.clock()
+        moment = datetime.fromtimestamp(now).time()
+        for start, end, fraction in self.windows:
+            if _in_window(moment, start, end):
+                return fraction
+        return self.default_fraction
+
+    def bandwidth_cap(self, now=None):
+        """Current cap in bytes per second, or None if uncapped."""
+        if self.max_bandwidth is None:
+            return None
+        return self.max_bandwidth * self.fraction(now)
+
+    def concurrency_limit(self, now=None) -> int:
+        """Number of batches allowed to run at once right now (0 means paused)."""
+        fraction = self.fraction(now)
+        if fraction <= 0:
+            return 0
+
+        cap = self.bandwidth_cap(now)
+        if cap is None:
+            # without a bandwidth cap the window scales the concurrency ceiling
+            return max(1, min(self.max_concurrent, int(round(self.max_concurrent * fraction))))
+
+        if not self.batch_rate:
+            # no measurement yet, start with a single batch and learn
+            return 1
+        return max(1, min(self.max_concurrent, int(cap // self.batch_rate)))
+
+    def may_start(self, running: int, now=None) -> bool:
+        """True if another batch may start given the number currently running."""
+        if now is None:
+            now = self.clock()
+        if now < self._not_before:
+            return False
+        return running < self.concurrency_limit(now)
+
+    def record(self, nbytes: int, seconds: float, now=None) -> None:
+        """Feed back a finished batch's size and duration."""
+        if now is None:
+            now = self.clock()
+        if nbytes <= 0 or seconds <= 0:
+            return
+
+        rate = nbytes / seconds
+        if self.batch_rate is None:
+            self.batch_rate = rate
+        else:
+            self.batch_rate = EWMA_WEIGHT * rate + (1 - EWMA_WEIGHT) * self.batch_rate
+
+        cap = self.bandwidth_cap(now)
+        if cap and rate > cap:
+            # a single batch outran the cap; idle long enough to bring the average down
+            self._not_before = max(self._not_before, now + nbytes / cap - seconds)
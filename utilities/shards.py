@@ -0,0 +1,177 @@
+"""
+Split prepare.py and records.py over cluster array jobs, then merge.
+
+With --shard i/N (0 <= i < N) a run only handles the work units whose
+subject/session hashes to shard i: the child folders it file-maps and the
+manifests and records it writes.  The unit key is the part of the child
+folder name before the first period, e.g. sub-NDARABC123_ses-baseline, so
+prepare and records agree on which shard owns a folder, and the same key
+always lands in the same shard on every node.
+
+Instead of the complete records and batches, a shard writes
+
+    <parent>.shard_records_<i>_<N>.csv
+    <parent>.shard_folders_<i>_<N>.txt
+
+Once every shard is done, `nda-records merge <parent> [...]` checks all N
+shards are there and writes <parent>.complete_records.csv,
+<parent>.complete_folders.txt and the upload batches, as records.py does
+for a single process.  Rows are ordered by child folder, so the result does
+not depend on the number of shards.  `nda-records verify <parent> [...]`
+reports the same problems without merging: missing shards, a shard with
+more or fewer records than folders, and a folder listed more than once.
+"""
+import hashlib
+import os
+import re
+import sys
+from argparse import ArgumentParser, ArgumentTypeError
+from glob import escape, glob
+
+from utilities.batches import (
+    read_folders_txt,
+    read_records_csv,
+    write_batches,
+    write_folders_txt,
+    write_records_csv,
+)
+
+SHARD_FILES = re.compile(r"\.shard_records_(\d+)_(\d+)\.csv$")
+
+
+def parse_shard(value):
+    """argparse type for i/N, returning (i, N)."""
+    match = re.fullmatch(r"(\d+)/(\d+)", value)
+    if not match or not int(match.group(1)) < int(match.group(2)):
+        raise ArgumentTypeError(f"{value} is not a shard i/N with 0 <= i < N")
+    return int(match.group(1)), int(match.group(2))
+
+
+def unit_key(child_folder):
+    """Subject/session a child folder (name or path) is sharded by."""
+    return os.path.basename(child_folder).split(".", 1)[0]
+
+
+def shard_of(key, count):
+    # a stable hash, Python's hash() of a str differs between processes
+    return int(hashlib.sha1(key.encode()).hexdigest(), 16) % count
+
+
+def in_shard(child_folder, shard):
+    """Whether a child folder belongs to shard (i, N); everything does without a shard."""
+    if shard is None:
+        return True
+    index, count = shard
+    return shard_of(unit_key(child_folder), count) == index
+
+
+def shard_paths(parent, shard):
+    index, count = shard
+    return (
+        f"{parent}.shard_records_{index}_{count}.csv",
+        f"{parent}.shard_folders_{index}_{count}.txt",
+    )
+
+
+def write_shard(parent, shard, ndaheader, header, records, folders):
+    records_path, folders_path = shard_paths(parent, shard)
+    write_records_csv(records_path, ndaheader, header, records)
+    write_folders_txt(folders_path, folders)
+    return records_path
+
+
+def has_shards(parent):
+    parent = os.path.abspath(os.path.realpath(parent))
+    return any(
+        SHARD_FILES.search(path) for path in glob(escape(parent) + ".shard_records_*_*.csv")
+    )
+
+
+def read_shards(parent):
+    """
+    (ndaheader, header, [(folder, record)], problems) of the shards of a
+    parent; the shards can be merged when problems is empty.
+    """
+    # records.py names shard files after the resolved parent
+    parent = os.path.abspath(os.path.realpath(parent))
+    shards = {}
+    for path in glob(escape(parent) + ".shard_records_*_*.csv"):
+        match = SHARD_FILES.search(path)
+        if match:
+            shards[int(match.group(1)), int(match.group(2))] = path
+    if not shards:
+        raise FileNotFoundError(f"No shard records for {parent}")
+    counts = {count for _, count in shards}
+    if len(counts) != 1:
+        return None, None, [], [f"Shards of {parent} were written with different N: {sorted(counts)}"]
+    count = counts.pop()
+    problems = []
+    missing = [index for index in range(count) if (index, count) not in shards]
+    if missing:
+        problems.append(
+            f"Shards {', '.join(f'{i}/{count}' for i in missing)} of {parent} are missing"
+        )
+
+    rows = []
+    ndaheader = header = None
+    owners = {}
+    for index in range(count):
+        if (index, count) not in shards:
+            continue
+        shard_ndaheader, shard_header, records = read_records_csv(shards[index, count])
+        if ndaheader is None:
+            ndaheader, header = shard_ndaheader, shard_header
+        elif (shard_ndaheader, shard_header) != (ndaheader, header):
+            problems.append(f"Shard {index}/{count} of {parent} has a different header")
+        folders = read_folders_txt(shard_paths(parent, (index, count))[1])
+        if len(folders) != len(records):
+            problems.append(
+                f"Shard {index}/{count} of {parent} has {len(records)} records but {len(folders)} folders"
+            )
+        for folder in folders:
+            owners.setdefault(folder, []).append(f"{index}/{count}")
+        rows.extend(zip(folders, records))
+    for folder, listed in sorted(owners.items()):
+        if len(listed) > 1:
+            problems.append(f"{folder} of {parent} is listed {len(listed)} times, by shards {', '.join(listed)}")
+    return ndaheader, header, rows, problems
+
+
+def merge_shards(parent):
+    """
+    Combine the shard records and folders of a parent into its complete
+    records, folders and batches.  Returns the number of records.
+    """
+    parent = os.path.abspath(os.path.realpath(parent))
+    ndaheader, header, rows, problems = read_shards(parent)
+    if problems:
+        raise ValueError("\n".join(problems))
+
+    rows.sort(key=lambda row: row[0])
+    folders = [folder for folder, _ in rows]
+    records = [record for _, record in rows]
+    write_records_csv(parent + ".complete_records.csv", ndaheader, header, records)
+    write_folders_txt(parent + ".complete_folders.txt", folders)
+    write_batches(parent, ndaheader, header, records, folders)
+    return len(records)
+
+
+def cli(argv=None):
+    parser = ArgumentParser(
+        prog="nda-records merge",
+        description="Merge the shard records of prepared parents into their complete records and batches.",
+    )
+    parser.add_argument("parents", nargs="+", help="Parent folders prepared with --shard")
+    args = parser.parse_args(argv)
+
+    failed = False
+    for parent in args.parents:
+        try:
+            total = merge_shards(parent)
+        except (FileNotFoundError, ValueError) as e:
+            print(e)
+            failed = True
+            continue
+        print(f"Merged {total} records of {os.path.basename(parent.rstrip(os.sep))}")
+    if failed:
+        sys.exit(1)
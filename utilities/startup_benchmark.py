@@ -0,0 +1,91 @@
+"""
+Import-time benchmark for the nda-* commands.
+
+Every command listed under [project.scripts] in pyproject.toml is imported
+in a fresh interpreter several times and the median wall time is reported,
+after subtracting the median startup of a bare interpreter.  This is the
+latency every `--help`, sanity check or per-subject cluster array task pays
+before doing any work, so heavy dependencies (pandas, pybids, yaml, toga)
+should only be imported on the code paths that need them.
+
+    python -m utilities.startup_benchmark [--repeat N] [--max-ms MS]
+
+With --max-ms the exit status is 1 when any command is slower than MS, so
+the benchmark can guard against regressions in CI.
+"""
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+from argparse import ArgumentParser
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+
+def project_scripts(pyproject=REPO_ROOT / "pyproject.toml"):
+    """Command name -> "module:function" from the [project.scripts] table."""
+    scripts = {}
+    in_table = False
+    with open(pyproject, "r") as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("["):
+                in_table = line == "[project.scripts]"
+                continue
+            match = re.match(r'^"?([\w.-]+)"?\s*=\s*"([^"]+)"', line)
+            if in_table and match:
+                scripts[match.group(1)] = match.group(2)
+    return scripts
+
+
+def time_command(code, repeat=5):
+    """Median seconds to run `python -c code` from the repository root."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], cwd=REPO_ROOT, check=True)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def benchmark(repeat=5):
+    """Command name -> (entry point, median import milliseconds above bare startup)."""
+    baseline = time_command("pass", repeat)
+    results = {}
+    for name, entry_point in project_scripts().items():
+        module, _, function = entry_point.partition(":")
+        seconds = time_command(f"from {module} import {function}", repeat)
+        results[name] = (entry_point, max(seconds - baseline, 0.0) * 1000)
+    return results
+
+
+def cli():
+    parser = ArgumentParser(description="Measure the import time of every nda-* command.")
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="Fresh interpreters per command (default 5)"
+    )
+    parser.add_argument(
+        "--max-ms",
+        type=float,
+        default=None,
+        help="Exit with status 1 if any command takes longer than this to import",
+    )
+    args = parser.parse_args()
+
+    results = benchmark(args.repeat)
+    slow = []
+    for name, (entry_point, ms) in results.items():
+        print(f"{name:<16}{entry_point:<28}{ms:8.1f} ms")
+        if args.max_ms is not None and ms > args.max_ms:
+            slow.append(name)
+
+    if slow:
+        print(f"Slower than {args.max_ms} ms: " + ", ".join(slow))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    cli()
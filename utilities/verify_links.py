@@ -0,0 +1,182 @@
+"""
+Find dangling and out-of-tree symlinks in prepared parents before records.
+
+    nda-records verify <parent> [<parent> ...] [--source SOURCE_DIR]
+
+prepare.py symlinks every mapped file into the parents.  When a source path
+is moved or unmounted afterwards, the links dangle and only manifest
+creation or vtcmd notices, hours into a run.  This walks the parents with
+AsyncFS, many listings and lstats in flight at once, and resolves every
+link target.  The realpath() of target folders is cached, so the thousands
+of links into the same source folders cost one lstat each plus one
+realpath() per distinct folder, instead of a full realpath() per link.
+
+A link is reported as
+
+    dangling      its target, or a folder on the way to it, does not exist
+    outside       with --source, its target resolves outside every source folder
+    loop          resolving it runs into a symlink loop
+
+prepare.py (and nda-pipeline) run this on every parent before its records
+and leave out parents with broken links.  Problems are written to
+<parent>.broken_links.tsv.
+
+For parents prepared with --shard, `nda-records verify` also reports what
+would stop `nda-records merge`: missing shards and missing or duplicated
+shard rows (see utilities/shards.py).
+"""
+import asyncio
+import csv
+import errno
+import os
+import stat
+import sys
+import time
+from argparse import ArgumentParser
+
+from utilities.aiofs import AsyncFS, parse_io_limit
+from utilities.shards import has_shards, read_shards
+
+DANGLING = "dangling"
+OUTSIDE = "outside"
+LOOP = "loop"
+
+
+class LinkVerifier:
+    def __init__(self, fs, roots=()):
+        """roots: folders link targets must resolve into; any target is fine without roots."""
+        self.fs = fs
+        self.roots = [os.path.realpath(root) for root in roots]
+        # directory -> task resolving it, shared by every link into that directory
+        self._directories = {}
+        self.links = 0
+
+    def realdir(self, directory):
+        """realpath() of a directory, computed once however many links point into it."""
+        if directory not in self._directories:
+            self._directories[directory] = asyncio.ensure_future(
+                self.fs.call(directory, os.path.realpath, directory)
+            )
+        return self._directories[directory]
+
+    async def resolve(self, link):
+        """Resolved target of a link; raises OSError when it does not exist."""
+        target = os.path.join(os.path.dirname(link), await self.fs.readlink(link))
+        directory, name = os.path.split(target)
+        if name in ("", ".", ".."):
+            # a link to a folder, resolve the whole target
+            directory, name = target, ""
+        path = os.path.join(await self.realdir(directory), name)
+        if stat.S_ISLNK((await self.fs.lstat(path)).st_mode):
+            # a link to a link: rare enough to resolve in full
+            path = await self.fs.call(path, os.path.realpath, path)
+            await self.fs.stat(path)
+        return path
+
+    def outside(self, resolved):
+        return bool(self.roots) and not any(
+            resolved == root or resolved.startswith(root.rstrip(os.sep) + os.sep)
+            for root in self.roots
+        )
+
+    async def check(self, link):
+        """(link, target, problem) for a broken link, None for a good one."""
+        self.links += 1
+        try:
+            resolved = await self.resolve(link)
+        except OSError as e:
+            problem = LOOP if e.errno == errno.ELOOP else DANGLING
+            return link, e.filename or "", problem
+        if self.outside(resolved):
+            return link, resolved, OUTSIDE
+        return None
+
+    async def verify(self, tree):
+        """Every broken link under tree, without following symlinked folders."""
+        checks = []
+        walks = []
+        for name, path, is_dir, is_symlink in await self.fs.lentries(tree):
+            if is_symlink:
+                checks.append(self.check(path))
+            elif is_dir:
+                walks.append(self.verify(path))
+        problems = [p for p in await asyncio.gather(*checks) if p is not None]
+        for found in await asyncio.gather(*walks):
+            problems.extend(found)
+        return problems
+
+
+def verify_links(trees, roots=(), io_limits=None):
+    """Broken links under every tree, as (link, target, problem), and the number of links checked."""
+    with AsyncFS(io_limits) as fs:
+
+        async def main():
+            verifier = LinkVerifier(fs, roots)
+            found = await asyncio.gather(*(verifier.verify(tree) for tree in trees))
+            return [problem for problems in found for problem in problems], verifier.links
+
+        return fs.run(main())
+
+
+def write_report(path, problems):
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f, delimiter="\t")
+        writer.writerow(["link", "target", "problem"])
+        writer.writerows(sorted(problems))
+
+
+def verify_parent(parent, roots=(), children=None, io_limits=None):
+    """
+    Check the links of a parent (or only of the given child folders) and
+    write <parent>.broken_links.tsv when there are broken ones.  Returns the
+    broken links.
+    """
+    parent = os.path.abspath(parent).rstrip(os.sep)
+    start = time.perf_counter()
+    trees = [parent] if children is None else [os.path.join(parent, c) for c in children]
+    problems, links = verify_links(trees, roots, io_limits)
+    report = parent + ".broken_links.tsv"
+    print(
+        f"Checked {links} links of {os.path.basename(parent)} in "
+        f"{time.perf_counter() - start:.1f} s, {len(problems)} broken"
+    )
+    if problems:
+        write_report(report, problems)
+        print(f"Broken links listed in {report}")
+    elif os.path.exists(report):
+        os.remove(report)
+    return problems
+
+
+def cli(argv=None):
+    parser = ArgumentParser(
+        prog="nda-records verify",
+        description="Report dangling and out-of-tree symlinks, and incomplete shards, in prepared parents.",
+    )
+    parser.add_argument("parents", nargs="+", help="Parent folders to check")
+    parser.add_argument(
+        "--source",
+        action="append",
+        default=[],
+        help="Folder every link must point into, e.g. the BIDS dataset; repeatable",
+    )
+    parser.add_argument(
+        "--io-limit",
+        type=parse_io_limit,
+        action="append",
+        default=[],
+        metavar="[PATH=]N",
+        help="At most N filesystem calls at once (default 16), or N under PATH; repeatable per filesystem",
+    )
+    args = parser.parse_args(argv)
+
+    broken = 0
+    for parent in args.parents:
+        broken += len(verify_parent(parent, args.source, io_limits=dict(args.io_limit)))
+        if has_shards(parent):
+            problems = read_shards(parent)[3]
+            for problem in problems:
+                print(problem)
+            broken += len(problems)
+    if broken:
+        sys.exit(1)